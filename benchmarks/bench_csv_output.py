@@ -0,0 +1,83 @@
+"""
+Benchmark flattening wide OCDS-like releases to CSV, comparing CSVOutput's
+row writer against the csv.DictWriter it replaced.
+
+Run from the repository root with::
+
+    python benchmarks/bench_csv_output.py [release_count]
+
+release_count defaults to 20000.
+
+"""
+from __future__ import print_function
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+sys.path.insert(0, '.')
+
+from flattentool.json_input import JSONParser  # noqa
+from flattentool.output import CSVOutput  # noqa
+
+if sys.version > '3':
+    import csv
+else:
+    import unicodecsv as csv  # pylint: disable=F0401
+
+
+class DictWriterCSVOutput(CSVOutput):
+    """
+    A CSVOutput that writes each sheet with csv.DictWriter, from a dict for
+    each line, and default sized file buffers, as CSVOutput used to.
+
+    """
+    buffer_size = -1
+
+    def write_sheet(self, sheet_name, sheet, sheet_lines=None):
+        sheet_header = list(sheet)
+        with self.open_sheet_file(self.sheet_file_name(sheet_name)) as csv_file:
+            if sys.version > '3':
+                dictwriter = csv.DictWriter(csv_file, sheet_header)
+            else:
+                dictwriter = csv.DictWriter(csv_file, sheet_header, encoding='utf-8')
+            dictwriter.writeheader()
+            for sheet_line in (sheet.lines if sheet_lines is None else sheet_lines):
+                dictwriter.writerow(sheet_line)
+
+
+def make_release(i):
+    return OrderedDict([
+        ('ocid', 'ocds-213czf-{:06d}'.format(i)),
+        ('id', str(i)),
+        ('date', '2017-01-01T00:00:00Z'),
+        ('buyer', OrderedDict([('id', 'GB-LAC-{}'.format(i % 100)), ('name', 'Buyer {}'.format(i % 100))])),
+        ('tender', OrderedDict(
+            [('id', 'tender-{}'.format(i)), ('title', 'Tender number {}'.format(i))] +
+            [('field{}'.format(j), OrderedDict([('value', Decimal(i + j)), ('text', 'text {}'.format(j))]))
+             for j in range(100)] +
+            [('items', [
+                OrderedDict([('id', str(j)), ('description', 'Item {}'.format(j)), ('quantity', j)])
+                for j in range(3)
+            ])]
+        )),
+    ])
+
+
+def main():
+    release_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    parser = JSONParser(root_json_dict=[make_release(i) for i in range(release_count)], root_id='ocid')
+    parser.parse()
+    print('{} releases, {} columns in the main sheet:'.format(release_count, len(list(parser.main_sheet))))
+    for name, output_class in [('DictWriter', DictWriterCSVOutput), ('row writer', CSVOutput)]:
+        output_name = tempfile.mkdtemp()
+        start = time.time()
+        output_class(parser=parser, output_name=output_name).write_sheets()
+        print('  {}: {:.2f}s'.format(name, time.time() - start))
+        shutil.rmtree(output_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Benchmark writing flattened output with many sub-sheets, one sheet after
+another and with the sheets spread across worker processes.
+
+Run from the repository root with::
+
+    python benchmarks/bench_parallel_sheets.py [release_count] [workers]
+
+release_count defaults to 2000, and workers to 4.
+
+"""
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, '.')
+
+from flattentool.json_input import JSONParser  # noqa
+from flattentool.output import CSVOutput, NativeXLSXOutput  # noqa
+
+SUB_SHEET_COUNT = 24
+
+
+def make_release(i):
+    # Each list becomes its own sub-sheet
+    return OrderedDict(
+        [('ocid', 'ocds-213czf-{:06d}'.format(i)), ('id', str(i))] +
+        [('list{}'.format(j), [
+            OrderedDict([('id', str(k)), ('title', 'Item {} {}'.format(j, k)), ('value', k * j), ('note', 'n' * 20)])
+            for k in range(10)
+        ]) for j in range(SUB_SHEET_COUNT)]
+    )
+
+
+def main():
+    release_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    parser = JSONParser(root_json_dict=[make_release(i) for i in range(release_count)], root_id='ocid')
+    parser.parse()
+    print('{} releases, {} sub-sheets:'.format(release_count, len(parser.sub_sheets)))
+    for name, output_class, suffix in [('csv', CSVOutput, ''), ('xlsx-native', NativeXLSXOutput, '.xlsx')]:
+        for worker_count in [1, workers]:
+            directory = tempfile.mkdtemp()
+            start = time.time()
+            output_class(parser=parser, output_name=os.path.join(directory, 'flattened' + suffix), workers=worker_count).write_sheets()
+            print('  {}, {} worker(s): {:.2f}s'.format(name, worker_count, time.time() - start))
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Benchmark flattening records with a lot of columns, comparing the Sheet
+column index against the plain list it replaced.
+
+Run from the repository root with::
+
+    python benchmarks/bench_sheet_columns.py
+
+"""
+from __future__ import print_function
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, '.')
+
+from flattentool import json_input  # noqa
+from flattentool.json_input import JSONParser  # noqa
+from flattentool.sheet import Sheet  # noqa
+
+
+class ListSheet(Sheet):
+    """
+    A Sheet that checks for existing columns by scanning lists, as Sheet used
+    to.
+
+    """
+
+    def add_field(self, field, id_field=False):
+        columns = self.id_columns if id_field else self.columns
+        if field not in columns:
+            columns.append(field)
+
+    def __contains__(self, item):
+        return any(item == column for column in self)
+
+
+def make_records(record_count, column_count):
+    return [
+        OrderedDict(
+            [('id', str(i))] +
+            [('field{}'.format(j), OrderedDict([('value', j)])) for j in range(column_count)]
+        )
+        for i in range(record_count)
+    ]
+
+
+def run(sheet_class, records):
+    json_input.Sheet = sheet_class
+    try:
+        parser = JSONParser(root_json_dict=records)
+        parser.main_sheet = sheet_class()
+        start = time.time()
+        parser.parse()
+        return time.time() - start
+    finally:
+        json_input.Sheet = Sheet
+
+
+def main():
+    record_count = 500
+    for column_count in [50, 200, 500, 1000]:
+        records = make_records(record_count, column_count)
+        list_time = run(ListSheet, records)
+        index_time = run(Sheet, records)
+        print('{} records x {} columns: list {:.3f}s, index {:.3f}s ({:.1f}x faster)'.format(
+            record_count, column_count, list_time, index_time, list_time / index_time))
+
+
+if __name__ == '__main__':
+    main()
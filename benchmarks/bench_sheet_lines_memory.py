@@ -0,0 +1,97 @@
+"""
+Benchmark the memory used by the lines of flattened sheets, comparing the
+compact SheetLines storage against the list of dicts it replaced.
+
+Run from the repository root with::
+
+    python benchmarks/bench_sheet_lines_memory.py [release_count]
+
+release_count defaults to 100000. This needs Python 3, for tracemalloc.
+
+"""
+from __future__ import print_function
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from decimal import Decimal
+
+sys.path.insert(0, '.')
+
+from flattentool import json_input  # noqa
+from flattentool.json_input import JSONParser  # noqa
+from flattentool.sheet import Sheet  # noqa
+
+
+class DictLinesSheet(Sheet):
+    """
+    A Sheet that keeps its lines as a plain list of dicts, as Sheet used to.
+
+    """
+
+    @property
+    def lines(self):
+        return self._lines
+
+    @lines.setter
+    def lines(self, lines):
+        self._lines = list(lines)
+
+
+def make_release(i):
+    return OrderedDict([
+        ('ocid', 'ocds-213czf-{:06d}'.format(i)),
+        ('id', str(i)),
+        ('date', '2017-01-01T00:00:00Z'),
+        ('tag', ['tender']),
+        ('initiationType', 'tender'),
+        ('buyer', OrderedDict([('id', 'GB-LAC-{}'.format(i % 100)), ('name', 'Buyer {}'.format(i % 100))])),
+        ('tender', OrderedDict([
+            ('id', 'tender-{}'.format(i)),
+            ('title', 'Tender number {}'.format(i)),
+            ('status', 'active'),
+            ('value', OrderedDict([('amount', Decimal(i)), ('currency', 'GBP')])),
+            ('procurementMethod', 'open'),
+            ('items', [
+                OrderedDict([
+                    ('id', str(j)),
+                    ('description', 'Item {}'.format(j)),
+                    ('classification', OrderedDict([('scheme', 'CPV'), ('id', '4500000{}'.format(j))])),
+                    ('quantity', j),
+                ])
+                for j in range(3)
+            ]),
+        ])),
+    ])
+
+
+def run(sheet_class, releases):
+    json_input.Sheet = sheet_class
+    try:
+        tracemalloc.start()
+        start = time.time()
+        parser = JSONParser(root_json_dict=releases, root_id='ocid')
+        parser.main_sheet = sheet_class()
+        parser.parse()
+        elapsed = time.time() - start
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        line_count = len(parser.main_sheet.lines) + sum(len(sheet.lines) for sheet in parser.sub_sheets.values())
+        return memory, elapsed, line_count
+    finally:
+        json_input.Sheet = Sheet
+
+
+def main():
+    release_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    releases = [make_release(i) for i in range(release_count)]
+    dict_memory, dict_time, line_count = run(DictLinesSheet, releases)
+    compact_memory, compact_time, _ = run(Sheet, releases)
+    print('{} releases, {} lines:'.format(release_count, line_count))
+    print('  dicts:   {:.1f} MB, {:.1f}s'.format(dict_memory / 1e6, dict_time))
+    print('  compact: {:.1f} MB, {:.1f}s'.format(compact_memory / 1e6, compact_time))
+    print('  {:.1f}x less memory'.format(dict_memory / compact_memory))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark unflattening a large CSV input whose sheets are sorted by ocid,
+comparing keeping every object in memory until all the sheets have been
+read against --sorted-input, which writes each object as soon as it's made,
+and --external-sort, which sorts the rows on disk first.
+
+Run from the repository root with::
+
+    python benchmarks/bench_sorted_input.py [release_count]
+
+release_count defaults to 20000. Each mode is run in its own process, so that
+its peak RSS can be measured. This needs a Unix, for the resource module.
+
+"""
+from __future__ import print_function
+import csv
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, '.')
+
+from flattentool import unflatten  # noqa
+
+
+def write_csv(file_name, rows):
+    if sys.version > '3':
+        csv_file = open(file_name, 'w', newline='')
+    else:
+        csv_file = open(file_name, 'wb')
+    with csv_file:
+        csv.writer(csv_file).writerows(rows)
+
+
+def write_input(directory, release_count):
+    write_csv(os.path.join(directory, 'main.csv'), [['ocid', 'id', 'date', 'tender/title']] + [
+        ['ocds-{:08d}'.format(i), str(i), '2017-01-01T00:00:00Z', 'Tender number {}'.format(i)]
+        for i in range(release_count)])
+    write_csv(os.path.join(directory, 'items.csv'), [['ocid', 'id', 'tender/items/0/id', 'tender/items/0/description']] + [
+        ['ocds-{:08d}'.format(i), str(i), str(j), 'Item {} of tender number {}'.format(j, i)]
+        for i in range(release_count) for j in range(5)])
+
+
+def run(mode, directory):
+    output_name = os.path.join(directory, 'output.json')
+    start = time.time()
+    unflatten(directory, input_format='csv', root_id='ocid', output_name=output_name,
+              sorted_input=(mode == 'sorted'), external_sort=(mode == 'external sort'),
+              memory_limit=(20 if mode == 'external sort' else None))
+    elapsed = time.time() - start
+    os.remove(output_name)
+    # ru_maxrss is in kilobytes on Linux
+    print('{:.1f} {:.1f}'.format(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def main():
+    if len(sys.argv) > 2:
+        run(sys.argv[2], sys.argv[3])
+        return
+    release_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    directory = tempfile.mkdtemp()
+    try:
+        write_input(directory, release_count)
+        print('{} releases, 5 items each:'.format(release_count))
+        for mode in ['in memory', 'sorted', 'external sort']:
+            output = subprocess.check_output([sys.executable, __file__, str(release_count), mode, directory])
+            elapsed, peak_rss = output.split()
+            print('  {}: {}s, peak RSS {} MB'.format(mode, elapsed.decode(), peak_rss.decode()))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
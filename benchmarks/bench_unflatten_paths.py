@@ -0,0 +1,83 @@
+"""
+Benchmark unflattening a large CSV input, comparing path plans compiled once
+per sheet against working out each cell's path from its heading again for
+every row, as unflatten_main_with_parser used to.
+
+Run from the repository root with::
+
+    python benchmarks/bench_unflatten_paths.py [row_count]
+
+row_count defaults to 20000.
+
+"""
+from __future__ import print_function
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, '.')
+
+import flattentool.input  # noqa
+from flattentool.input import CSVInput  # noqa
+from flattentool.schema import SchemaParser  # noqa
+
+HEADINGS = [
+    'ocid', 'id', 'date', 'language',
+    'buyer/name', 'buyer/identifier/id', 'buyer/identifier/scheme',
+    'tender/id', 'tender/title', 'tender/description', 'tender/status',
+    'tender/value/amount', 'tender/value/currency',
+    'tender/items/0/id', 'tender/items/0/description', 'tender/items/0/quantity',
+    'tender/items/1/id', 'tender/items/1/description', 'tender/items/1/quantity',
+    'tender/tenderPeriod/startDate',
+]
+
+unflatten_main_with_parser = flattentool.input.unflatten_main_with_parser
+
+
+def unflatten_without_plans(parser, line, timezone, xml, id_name, path_plans=None):
+    return unflatten_main_with_parser(parser, line, timezone, xml, id_name)
+
+
+def main():
+    row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    directory = tempfile.mkdtemp()
+    try:
+        if sys.version > '3':
+            csv_file = open(os.path.join(directory, 'main.csv'), 'w', newline='')
+        else:
+            csv_file = open(os.path.join(directory, 'main.csv'), 'wb')
+        with csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(HEADINGS)
+            for i in range(row_count):
+                writer.writerow(['ocds-{}'.format(i), str(i)] + [
+                    str(j) if 'quantity' in heading or 'amount' in heading else '{} {}'.format(heading, i)
+                    for j, heading in enumerate(HEADINGS[2:])])
+        parser = SchemaParser(schema_filename='flattentool/tests/fixtures/release-schema.json', rollup=True, root_id='ocid')
+        with warnings.catch_warnings():
+            # The schema has a few fields without properties, which are skipped
+            warnings.simplefilter('ignore')
+            parser.parse()
+        cell_count = row_count * len(HEADINGS)
+        print('{} rows x {} columns:'.format(row_count, len(HEADINGS)))
+        for name, function in [('per row', unflatten_without_plans), ('compiled', unflatten_main_with_parser)]:
+            flattentool.input.unflatten_main_with_parser = function
+            spreadsheet_input = CSVInput(input_name=directory, root_list_path='releases', root_id='ocid')
+            spreadsheet_input.parser = parser
+            spreadsheet_input.read_sheets()
+            start = time.time()
+            for _ in spreadsheet_input.unflatten():
+                pass
+            elapsed = time.time() - start
+            print('  {}: {:.2f}s, {:.2f} microseconds per cell'.format(name, elapsed, elapsed / cell_count * 1e6))
+    finally:
+        flattentool.input.unflatten_main_with_parser = unflatten_main_with_parser
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
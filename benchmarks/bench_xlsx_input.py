@@ -0,0 +1,70 @@
+"""
+Benchmark reading XLSX input, comparing XLSXInput (openpyxl's read-only
+workbook) against NativeXLSXInput (flattentool's own reader).
+
+Each workbook in flattentool/tests/fixtures/xlsx is scaled up by repeating
+its data rows, and every sheet is read with get_sheet_lines.
+
+Run from the repository root with::
+
+    python benchmarks/bench_xlsx_input.py [scale]
+
+scale defaults to 1000.
+
+"""
+from __future__ import print_function
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, '.')
+
+import openpyxl  # noqa
+from flattentool.input import NativeXLSXInput, XLSXInput  # noqa
+
+
+def scale_workbook(file_name, scaled_file_name, scale):
+    workbook = openpyxl.load_workbook(file_name, data_only=True)
+    scaled_workbook = openpyxl.Workbook(write_only=True)
+    for worksheet in workbook.worksheets:
+        rows = [[cell.value for cell in row] for row in worksheet.rows]
+        scaled_worksheet = scaled_workbook.create_sheet(title=worksheet.title)
+        if rows:
+            scaled_worksheet.append(rows[0])
+        for _ in range(scale):
+            for row in rows[1:]:
+                scaled_worksheet.append(row)
+    scaled_workbook.save(scaled_file_name)
+
+
+def main():
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    directory = tempfile.mkdtemp()
+    try:
+        file_names = []
+        for file_name in sorted(glob.glob('flattentool/tests/fixtures/xlsx/*.xlsx')):
+            # The transposed fixture is only read with vertical orientation
+            if 'transpose' in file_name:
+                continue
+            scaled_file_name = os.path.join(directory, os.path.basename(file_name))
+            scale_workbook(file_name, scaled_file_name, scale)
+            file_names.append(scaled_file_name)
+        print('{} fixtures, data rows repeated {} times:'.format(len(file_names), scale))
+        for name, input_class in [('openpyxl', XLSXInput), ('native', NativeXLSXInput)]:
+            start = time.time()
+            line_count = 0
+            for file_name in file_names:
+                spreadsheet_input = input_class(input_name=file_name)
+                spreadsheet_input.read_sheets()
+                for sheet_name in spreadsheet_input.sub_sheet_names:
+                    line_count += sum(1 for _ in spreadsheet_input.get_sheet_lines(sheet_name))
+            print('  {}: {} lines in {:.2f}s'.format(name, line_count, time.time() - start))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmark writing flattened sheets to XLSX, comparing the write-only workbook
+XLSXOutput uses against the regular workbook it used to use.
+
+Run from the repository root with::
+
+    python benchmarks/bench_xlsx_output.py [row_count]
+
+row_count defaults to 100000. Each mode is run in its own process, so that
+its peak RSS can be measured. This needs a Unix, for the resource module.
+
+"""
+from __future__ import print_function
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, '.')
+
+import openpyxl  # noqa
+from flattentool.output import XLSXOutput  # noqa
+from flattentool.sheet import Sheet  # noqa
+
+
+class RegularXLSXOutput(XLSXOutput):
+    """
+    An XLSXOutput that builds a regular workbook, keeping every cell in
+    memory until it's saved, as XLSXOutput used to.
+
+    """
+
+    def open(self):
+        self.workbook = openpyxl.Workbook()
+
+    def write_sheet(self, sheet_name, sheet, sheet_lines=None):
+        worksheet = self.workbook.create_sheet()
+        worksheet.title = sheet_name
+        worksheet.append(list(sheet))
+        for line in (sheet.lines if sheet_lines is None else sheet_lines):
+            worksheet.append([line.get(column) for column in sheet])
+
+    def close(self):
+        self.workbook.remove_sheet(self.workbook.active)
+        self.workbook.save(self.output_name)
+
+
+class MockParser(object):
+    def __init__(self, row_count, column_count):
+        self.main_sheet = Sheet(['column{}'.format(i) for i in range(column_count)])
+        for i in range(row_count):
+            self.main_sheet.lines.append(dict(
+                ('column{}'.format(j), 'value {} {}'.format(i, j) if j % 2 else i * j)
+                for j in range(column_count)))
+        self.sub_sheets = {}
+
+
+def run(mode, row_count):
+    parser = MockParser(row_count, 20)
+    output_class = XLSXOutput if mode == 'write-only' else RegularXLSXOutput
+    output_name = os.path.join(tempfile.mkdtemp(), 'flattened.xlsx')
+    start = time.time()
+    output_class(parser=parser, output_name=output_name).write_sheets()
+    elapsed = time.time() - start
+    os.remove(output_name)
+    # ru_maxrss is in kilobytes on Linux
+    print('{:.1f} {:.1f}'.format(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def main():
+    if len(sys.argv) > 2:
+        run(sys.argv[2], int(sys.argv[1]))
+        return
+    row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('{} rows x 20 columns:'.format(row_count))
+    for mode in ['regular', 'write-only']:
+        output = subprocess.check_output([sys.executable, __file__, str(row_count), mode])
+        elapsed, peak_rss = output.split()
+        print('  {}: {}s, peak RSS {} MB'.format(mode, elapsed.decode(), peak_rss.decode()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,14 @@
 from flattentool.schema import SchemaParser
+from flattentool.compression import COMPRESSION_SUFFIXES, open_file
 from flattentool.json_input import JSONParser
 from flattentool.output import FORMATS as OUTPUT_FORMATS
-from flattentool.output import FORMATS_SUFFIX
+from flattentool.output import FORMATS_SUFFIX, ALL_FORMATS, FanOutOutput
 from flattentool.input import FORMATS as INPUT_FORMATS
 from flattentool.xml_output import toxml
 import sys
 import json
 import codecs
+import uuid
 from decimal import Decimal
 from collections import OrderedDict
 
@@ -23,28 +25,54 @@ def create_template(schema, output_name='template', output_format='all', main_sh
     parser.parse()
 
     def spreadsheet_output(spreadsheet_output_class, name):
-        spreadsheet_output = spreadsheet_output_class(
+        return spreadsheet_output_class(
             parser=parser,
             main_sheet_name=main_sheet_name,
             output_name=name)
-        spreadsheet_output.write_sheets()
 
     if output_format == 'all':
-        for format_name, spreadsheet_output_class in OUTPUT_FORMATS.items():
-            spreadsheet_output(spreadsheet_output_class, output_name+FORMATS_SUFFIX[format_name])
+        # Write every format in one pass over the sheets
+        FanOutOutput([
+            spreadsheet_output(OUTPUT_FORMATS[format_name], output_name+FORMATS_SUFFIX[format_name])
+            for format_name in ALL_FORMATS]).write_sheets()
 
     elif output_format in OUTPUT_FORMATS.keys():   # in dictionary of allowed formats
-        spreadsheet_output(OUTPUT_FORMATS[output_format], output_name)
+        spreadsheet_output(OUTPUT_FORMATS[output_format], output_name).write_sheets()
 
     else:
         raise Exception('The requested format is not available')
 
 
-def flatten(input_name, schema=None, output_name='flattened', output_format='all', main_sheet_name='main', root_list_path='main', rollup=False, root_id=None, use_titles=False, **_):
+def flatten(input_name, schema=None, output_name='flattened', output_format='all', main_sheet_name='main', root_list_path='main', rollup=False, root_id=None, use_titles=False, stream=False, two_pass=False, workers=1, input_format='json', compression=None, memory_limit=None, **_):
     """
     Flatten a nested structure (JSON) to a flat structure (spreadsheet - csv or xlsx).
 
+    With ``two_pass``, the input is read twice: once to find every sheet and
+    column, and again to write each line in its final column order. This
+    implies ``stream``.
+
+    With ``workers`` greater than 1, the root list is parsed in chunks across
+    that many processes, and the sheets of CSV and xlsx-native output are
+    written in parallel. The output is the same as with a single process.
+
+    ``input_format`` is either ``json`` or ``jsonl``, for JSON Lines input
+    with one item of the root list per line (``root_list_path`` is then
+    ignored). JSON Lines input is always read incrementally.
+
+    Input compressed with gzip, bz2 or xz is decompressed as it's read.
+    ``compression`` (``gzip``, ``bz2`` or ``xz``) compresses each CSV file of
+    the output.
+
+    With ``memory_limit`` (in megabytes), the flattened lines are moved to
+    temporary files on disk whenever they use more memory than that.
+
     """
+    if input_format not in ('json', 'jsonl'):
+        raise Exception('The requested input format is not available')
+    if compression is not None and compression not in COMPRESSION_SUFFIXES:
+        raise Exception('The requested compression is not available')
+    if two_pass:
+        stream = True
 
     if schema:
         schema_parser = SchemaParser(
@@ -60,26 +88,50 @@ def flatten(input_name, schema=None, output_name='flattened', output_format='all
         root_list_path=root_list_path,
         schema_parser=schema_parser,
         root_id=root_id,
-        use_titles=use_titles)
-    parser.parse()
+        use_titles=use_titles,
+        stream=stream,
+        workers=workers,
+        json_lines=input_format == 'jsonl',
+        memory_limit=memory_limit)
 
     def spreadsheet_output(spreadsheet_output_class, name):
-        spreadsheet_output = spreadsheet_output_class(
+        return spreadsheet_output_class(
             parser=parser,
             main_sheet_name=main_sheet_name,
-            output_name=name)
-        spreadsheet_output.write_sheets()
+            output_name=name,
+            compression=compression,
+            workers=workers)
 
     if output_format == 'all':
-        for format_name, spreadsheet_output_class in OUTPUT_FORMATS.items():
-            spreadsheet_output(spreadsheet_output_class, output_name+FORMATS_SUFFIX[format_name])
+        spreadsheet_outputs = [
+            spreadsheet_output(OUTPUT_FORMATS[format_name], output_name+FORMATS_SUFFIX[format_name])
+            for format_name in ALL_FORMATS]
 
     elif output_format in OUTPUT_FORMATS.keys():   # in dictionary of allowed formats
-        spreadsheet_output(OUTPUT_FORMATS[output_format], output_name)
+        spreadsheet_outputs = [spreadsheet_output(OUTPUT_FORMATS[output_format], output_name)]
 
     else:
         raise Exception('The requested format is not available')
 
+    if stream:
+        if two_pass:
+            parser.parse_columns()
+        # Write each line to the outputs as soon as it's produced, rather
+        # than keeping every line in memory until the end
+        parser.line_sinks = spreadsheet_outputs
+        parser.parse()
+        for spreadsheet_output in spreadsheet_outputs:
+            spreadsheet_output.write_streamed_sheets()
+    else:
+        parser.parse()
+        if len(spreadsheet_outputs) > 1 and workers == 1:
+            # Turn each line into a row once, for all the outputs
+            FanOutOutput(spreadsheet_outputs).write_sheets()
+        else:
+            # Each output writes its sheets across the worker processes
+            for spreadsheet_output in spreadsheet_outputs:
+                spreadsheet_output.write_sheets()
+
 
 # From http://bugs.python.org/issue16535
 class NumberStr(float):
@@ -105,27 +157,117 @@ def decimal_default(o):
     raise TypeError(repr(o) + " is not JSON serializable")
 
 
+def open_json_output(output_name):
+    """
+    Open ``output_name``, which may be compressed, to write JSON to. On
+    Python 2 the json module writes a mix of str and unicode, which io text
+    files don't accept, so a codecs writer is used instead.
+
+    """
+    if sys.version > '3':
+        return open_file(output_name, 'w')
+    return codecs.getwriter('utf-8')(open_file(output_name, 'wb'))
+
+
+def write_json_lines(fp, items):
+    """
+    Write each item to ``fp`` as a line of JSON, as soon as it's given.
+
+    """
+    for item in items:
+        fp.write(json.dumps(item, default=decimal_default, ensure_ascii=False))
+        fp.write('\n')
+
+
+def write_json(fp, base, root_list_path):
+    """
+    Write ``base`` to ``fp`` as JSON, as ``json.dump`` does. If the value at
+    ``root_list_path`` is an iterator, rather than a list, its items are
+    written as soon as they're given.
+
+    """
+    items = base.get(root_list_path)
+    if items is None or isinstance(items, list):
+        json.dump(base, fp, indent=4, default=decimal_default, ensure_ascii=False)
+        return
+    items = iter(items)
+    try:
+        item = next(items)
+    except StopIteration:
+        base = OrderedDict(base)
+        base[root_list_path] = []
+        json.dump(base, fp, indent=4, default=decimal_default, ensure_ascii=False)
+        return
+    # Dump base with two placeholders in the list, to get the JSON before,
+    # between and after the items
+    placeholder = uuid.uuid4().hex
+    base = OrderedDict(base)
+    base[root_list_path] = [placeholder, placeholder]
+    before, separator, after = json.dumps(base, indent=4, default=decimal_default, ensure_ascii=False).split(
+        json.dumps(placeholder))
+    indent = separator[separator.rindex('\n'):]
+    fp.write(before)
+    while True:
+        fp.write(json.dumps(item, indent=4, default=decimal_default, ensure_ascii=False).replace('\n', indent))
+        try:
+            item = next(items)
+        except StopIteration:
+            break
+        fp.write(separator)
+    fp.write(after)
+
+
 def unflatten(input_name, base_json=None, input_format=None, output_name=None,
               root_list_path='main', encoding='utf8', timezone_name='UTC',
               root_id=None, schema='', convert_titles=False, cell_source_map=None,
               heading_source_map=None, id_name='id', xml=False,
               vertical_orientation=False,
               metatab_name=None, metatab_only=False, metatab_schema='',
-              metatab_vertical_orientation=False,
-              **_):
+              metatab_vertical_orientation=False, output_format='json',
+              memory_limit=None, max_empty_rows=None, sorted_input=False,
+              external_sort=False, **_):
     """
     Unflatten a flat structure (spreadsheet - csv or xlsx) into a nested structure (JSON).
 
+    ``output_format`` is either ``json``, or ``jsonl`` to write JSON Lines
+    output with one object from the root list per line.
+
+    CSV input, ``base_json`` and ``output_name`` may be compressed with gzip,
+    bz2 or xz, which is worked out from their extension (or, for input, from
+    their contents).
+
+    With ``memory_limit`` (in megabytes), the objects being unflattened are
+    moved to a temporary database on disk whenever they use more memory than
+    that.
+
+    With ``max_empty_rows``, each sheet of XLSX input is only read until that
+    many empty rows in a row are found.
+
+    With ``sorted_input``, each sheet must be sorted by the root id (or by the
+    id, if there's no root id), and each object is written as soon as the
+    rows for the next root id (or id) are reached, rather than all of the
+    objects being kept in memory. The objects are in the order of their
+    root ids (or ids).
+
+    With ``external_sort``, the rows of unsorted sheets are sorted on disk
+    instead, using ``memory_limit`` megabytes (100 by default) at a time, so
+    that each object can be written as soon as it's made. The output is the
+    same as without it.
+
     """
     if input_format is None:
         raise Exception('You must specify an input format (may autodetect in future')
     elif input_format not in INPUT_FORMATS:
         raise Exception('The requested format is not available')
+    if output_format not in ('json', 'jsonl'):
+        raise Exception('The requested output format is not available')
     if metatab_name and base_json:
         raise Exception('Not allowed to use base_json with metatab')
+    if output_format == 'jsonl' and (base_json or metatab_name or xml):
+        raise Exception('Not allowed to use base_json, metatab or xml with jsonl output')
 
     if base_json:
-        with open(base_json) as fp:
+        with open_file(base_json) as fp:
             base = json.load(fp, object_pairs_hook=OrderedDict)
     else:
         base = OrderedDict()
@@ -134,80 +276,118 @@ def unflatten(input_name, base_json=None, input_format=None, output_name=None,
     cell_source_map_data = OrderedDict()
     heading_source_map_data = OrderedDict()
 
-    if metatab_name:
-        spreadsheet_input_class = INPUT_FORMATS[input_format]
-        spreadsheet_input = spreadsheet_input_class(
-            input_name=input_name,
-            timezone_name=timezone_name,
-            root_list_path='meta',
-            include_sheets=[metatab_name],
-            convert_titles=convert_titles,
-            vertical_orientation=metatab_vertical_orientation,
-            id_name=id_name,
-            xml=xml
-        )
-        if metatab_schema:
-            parser = SchemaParser(schema_filename=metatab_schema)
-            parser.parse()
-            spreadsheet_input.parser = parser
-        spreadsheet_input.encoding = encoding
-        spreadsheet_input.read_sheets()
-        result, cell_source_map_data_meta, heading_source_map_data_meta = spreadsheet_input.fancy_unflatten(
-            with_cell_source_map=cell_source_map,
-            with_heading_source_map=heading_source_map,
-        )
-        for key, value in (cell_source_map_data_meta or {}).items():
-            ## strip off meta/0/ from start of source map as actually data is at top level
-            cell_source_map_data[key[7:]] = value
-        for key, value in (heading_source_map_data_meta or {}).items():
-            ## strip off meta/ from start of source map as actually data is at top level
-            heading_source_map_data[key[5:]] = value
-
-        if result:
-            base.update(result[0])
-
-    if not metatab_only:
-        spreadsheet_input_class = INPUT_FORMATS[input_format]
-        spreadsheet_input = spreadsheet_input_class(
-            input_name=input_name,
-            timezone_name=timezone_name,
-            root_list_path=root_list_path,
-            root_id=root_id,
-            convert_titles=convert_titles,
-            exclude_sheets=[metatab_name],
-            vertical_orientation=vertical_orientation,
-            id_name=id_name,
-            xml=xml
-        )
-        if schema:
-            parser = SchemaParser(schema_filename=schema, rollup=True, root_id=root_id)
-            parser.parse()
-            spreadsheet_input.parser = parser
-        spreadsheet_input.encoding = encoding
-        spreadsheet_input.read_sheets()
-        result, cell_source_map_data_main, heading_source_map_data_main = spreadsheet_input.fancy_unflatten(
-            with_cell_source_map=cell_source_map,
-            with_heading_source_map=heading_source_map,
-        )
-        cell_source_map_data.update(cell_source_map_data_main or {})
-        heading_source_map_data.update(heading_source_map_data_main or {})
-        base[root_list_path] = list(result)
-
-    if xml:
-        if output_name is None:
-            if sys.version > '3':
-                sys.stdout.buffer.write(toxml(base))
-            else:
-                sys.stdout.write(toxml(base))
+    # The metatab and main passes share the same loaded schema if they use
+    # the same schema file, and the same opened workbook
+    root_schema_dicts = {}
+
+    def schema_parser(schema_filename, **kwargs):
+        if schema_filename in root_schema_dicts:
+            parser = SchemaParser(root_schema_dict=root_schema_dicts[schema_filename], **kwargs)
         else:
-            with codecs.open(output_name, 'wb') as fp:
-                fp.write(toxml(base))
-    else:
-        if output_name is None:
-            print(json.dumps(base, indent=4, default=decimal_default, ensure_ascii=False))
+            parser = SchemaParser(schema_filename=schema_filename, **kwargs)
+            root_schema_dicts[schema_filename] = parser.root_schema_dict
+        parser.parse()
+        return parser
+
+    # Every input is closed once the output has been written, as the result
+    # may be read from the workbook as it is written
+    spreadsheet_inputs = []
+    previous_spreadsheet_input = None
+    try:
+        if metatab_name:
+            spreadsheet_input_class = INPUT_FORMATS[input_format]
+            spreadsheet_input = spreadsheet_input_class(
+                input_name=input_name,
+                timezone_name=timezone_name,
+                root_list_path='meta',
+                include_sheets=[metatab_name],
+                convert_titles=convert_titles,
+                vertical_orientation=metatab_vertical_orientation,
+                id_name=id_name,
+                xml=xml,
+                memory_limit=memory_limit,
+                max_empty_rows=max_empty_rows
+            )
+            spreadsheet_inputs.append(spreadsheet_input)
+            if metatab_schema:
+                spreadsheet_input.parser = schema_parser(metatab_schema)
+            spreadsheet_input.encoding = encoding
+            spreadsheet_input.read_sheets()
+            previous_spreadsheet_input = spreadsheet_input
+            result, cell_source_map_data_meta, heading_source_map_data_meta = spreadsheet_input.fancy_unflatten(
+                with_cell_source_map=cell_source_map,
+                with_heading_source_map=heading_source_map,
+            )
+            for key, value in (cell_source_map_data_meta or {}).items():
+                ## strip off meta/0/ from start of source map as actually data is at top level
+                cell_source_map_data[key[7:]] = value
+            for key, value in (heading_source_map_data_meta or {}).items():
+                ## strip off meta/ from start of source map as actually data is at top level
+                heading_source_map_data[key[5:]] = value
+
+            if result:
+                base.update(result[0])
+
+        if not metatab_only:
+            spreadsheet_input_class = INPUT_FORMATS[input_format]
+            spreadsheet_input = spreadsheet_input_class(
+                input_name=input_name,
+                timezone_name=timezone_name,
+                root_list_path=root_list_path,
+                root_id=root_id,
+                convert_titles=convert_titles,
+                exclude_sheets=[metatab_name],
+                vertical_orientation=vertical_orientation,
+                id_name=id_name,
+                xml=xml,
+                memory_limit=memory_limit,
+                max_empty_rows=max_empty_rows,
+                sorted_input=sorted_input,
+                external_sort=external_sort
+            )
+            spreadsheet_inputs.append(spreadsheet_input)
+            if schema:
+                spreadsheet_input.parser = schema_parser(schema, rollup=True, root_id=root_id)
+            spreadsheet_input.encoding = encoding
+            if previous_spreadsheet_input is not None:
+                spreadsheet_input.share_workbook(previous_spreadsheet_input)
+            spreadsheet_input.read_sheets()
+            result, cell_source_map_data_main, heading_source_map_data_main = spreadsheet_input.fancy_unflatten(
+                with_cell_source_map=cell_source_map,
+                with_heading_source_map=heading_source_map,
+            )
+            cell_source_map_data.update(cell_source_map_data_main or {})
+            heading_source_map_data.update(heading_source_map_data_main or {})
+            if xml or not (sorted_input or external_sort):
+                result = list(result)
+            base[root_list_path] = result
+
+        if xml:
+            if output_name is None:
+                if sys.version > '3':
+                    sys.stdout.buffer.write(toxml(base))
+                else:
+                    sys.stdout.write(toxml(base))
+            else:
+                with open_file(output_name, 'wb') as fp:
+                    fp.write(toxml(base))
+        elif output_format == 'jsonl':
+            if output_name is None:
+                write_json_lines(sys.stdout, base.get(root_list_path, []))
+            else:
+                with open_json_output(output_name) as fp:
+                    write_json_lines(fp, base.get(root_list_path, []))
         else:
-            with codecs.open(output_name, 'w', encoding='utf-8') as fp:
-                json.dump(base, fp, indent=4, default=decimal_default, ensure_ascii=False)
+            if output_name is None:
+                write_json(sys.stdout, base, root_list_path)
+                sys.stdout.write('\n')
+            else:
+                with open_json_output(output_name) as fp:
+                    write_json(fp, base, root_list_path)
+    finally:
+        for spreadsheet_input in spreadsheet_inputs:
+            spreadsheet_input.close()
+
     if cell_source_map:
         with codecs.open(cell_source_map, 'w', encoding='utf-8') as fp:
             json.dump(cell_source_map_data, fp, indent=4, default=decimal_default, ensure_ascii=False)
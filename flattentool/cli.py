@@ -88,6 +88,28 @@ def create_parser():
         "--use-titles",
         action='store_true',
         help="Convert titles. Requires a schema to be specified.")
+    parser_flatten.add_argument(
+        "--stream",
+        action='store_true',
+        help="Read the input JSON one item of the root list at a time, and write each row as soon as it is produced, rather than keeping everything in memory.")
+    parser_flatten.add_argument(
+        "--two-pass",
+        action='store_true',
+        help="Read the input twice, first to find all the columns and then to write the rows in their final order. Implies --stream.")
+    parser_flatten.add_argument(
+        "--workers",
+        type=int,
+        help="Number of processes to flatten the input, and write the sheets of CSV and xlsx-native output, with. Defaults to 1.")
+    parser_flatten.add_argument(
+        "--input-format",
+        help="Format of the input file, either json or jsonl (JSON Lines, one item of the root list per line). Defaults to json.")
+    parser_flatten.add_argument(
+        "--compression",
+        help="Compress each CSV file of the output, with gzip, bz2 or xz. Compressed input is detected automatically.")
+    parser_flatten.add_argument(
+        "--memory-limit",
+        type=int,
+        help="Move the flattened rows to temporary files on disk when they use more than this many megabytes of memory. Not needed with --stream, which doesn't keep rows in memory.")
 
     parser_unflatten = subparsers.add_parser(
         'unflatten',
@@ -97,12 +119,31 @@ def create_parser():
         help="Name of the input file or directory.")
     parser_unflatten.add_argument(
         "-f", "--input-format",
-        help="File format of input file or directory.",
+        help="File format of input file or directory, either xlsx, xlsx-native (a faster XLSX reader) or csv.",
         required=True)
     parser_unflatten.add_argument(
         "--xml",
         action='store_true',
         help="Use XML as the output format")
+    parser_unflatten.add_argument(
+        "--output-format",
+        help="Format of the output, either json or jsonl (JSON Lines, one object from the root list per line). Defaults to json.")
+    parser_unflatten.add_argument(
+        "--memory-limit",
+        type=int,
+        help="Move the objects being unflattened to a temporary database on disk when they use more than this many megabytes of memory.")
+    parser_unflatten.add_argument(
+        "--max-empty-rows",
+        type=int,
+        help="Stop reading each sheet of XLSX input after this many empty rows in a row. Empty rows after the last row with a value are always ignored.")
+    parser_unflatten.add_argument(
+        "--sorted-input",
+        action='store_true',
+        help="Each sheet is sorted by the root id (or by the id, if there's no root id), so write each object as soon as it has been read, rather than keeping them all in memory.")
+    parser_unflatten.add_argument(
+        "--external-sort",
+        action='store_true',
+        help="Sort the rows of each sheet on disk, so that each object can be written as soon as it has been read, for spreadsheets too large to unflatten in memory. Sorts --memory-limit megabytes of rows at a time, or 100 by default.")
     parser_unflatten.add_argument(
         "--id-name",
         help="String to use for the identifier key, defaults to 'id'")
@@ -0,0 +1,107 @@
+"""
+Opening files that may be compressed with gzip, bz2 or xz.
+
+The compression is worked out from the file's extension, or, when reading a
+file without a recognised extension, from its first few bytes. Compressed
+files are streamed through, rather than being decompressed to disk first.
+
+"""
+
+import bz2
+import gzip
+import io
+import os
+
+try:
+    import lzma
+except ImportError:  # Python 2, unless backports.lzma is installed
+    try:
+        from backports import lzma  # pylint: disable=F0401
+    except ImportError:
+        lzma = None
+
+
+COMPRESSION_SUFFIXES = {
+    'gzip': '.gz',
+    'bz2': '.bz2',
+    'xz': '.xz',
+}
+
+MAGIC_BYTES = {
+    'gzip': b'\x1f\x8b',
+    'bz2': b'BZh',
+    'xz': b'\xfd7zXZ\x00',
+}
+
+
+def open_compressed(file_name, mode, compression):
+    if compression == 'gzip':
+        return gzip.GzipFile(file_name, mode)
+    elif compression == 'bz2':
+        return bz2.BZ2File(file_name, mode)
+    elif compression == 'xz':
+        if lzma is None:
+            raise Exception('xz compression needs the lzma module, which is not available')
+        return lzma.LZMAFile(file_name, mode)
+    else:
+        raise Exception('The requested compression is not available')
+
+
+def compression_from_suffix(file_name):
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if file_name.endswith(suffix):
+            return compression
+    return None
+
+
+def compression_from_magic_bytes(file_name):
+    with open(file_name, 'rb') as fp:
+        start = fp.read(max(len(magic) for magic in MAGIC_BYTES.values()))
+    for compression, magic in MAGIC_BYTES.items():
+        if start.startswith(magic):
+            return compression
+    return None
+
+
+def detect_compression(file_name, mode='r'):
+    """
+    Return the compression of ``file_name`` (``gzip``, ``bz2`` or ``xz``), or
+    None if it isn't compressed. Only files being read are checked for magic
+    bytes.
+
+    """
+    compression = compression_from_suffix(file_name)
+    if compression is None and 'r' in mode and os.path.isfile(file_name):
+        compression = compression_from_magic_bytes(file_name)
+    return compression
+
+
+def strip_compression_suffix(file_name):
+    compression = compression_from_suffix(file_name)
+    if compression:
+        return file_name[:-len(COMPRESSION_SUFFIXES[compression])]
+    return file_name
+
+
+def open_file(file_name, mode='r', encoding='utf-8', newline=None, compression=None, buffering=-1):
+    """
+    Open ``file_name``, which may be compressed, like ``io.open``.
+
+    ``compression`` is worked out with ``detect_compression`` if it isn't
+    given. Modes without ``b`` give a text file in ``encoding``.
+    ``buffering`` is the size of the buffer to use, or -1 for the default.
+
+    """
+    if compression is None:
+        compression = detect_compression(file_name, mode)
+    binary = 'b' in mode
+    if compression is None:
+        if binary:
+            return io.open(file_name, mode, buffering=buffering)
+        return io.open(file_name, mode, buffering=buffering, encoding=encoding, newline=newline)
+    binary_file = open_compressed(file_name, mode.replace('t', '').replace('b', '') + 'b', compression)
+    if buffering > 0 and 'r' not in mode:
+        binary_file = io.BufferedWriter(binary_file, buffering)
+    if binary:
+        return binary_file
+    return io.TextIOWrapper(binary_file, encoding=encoding, newline=newline)
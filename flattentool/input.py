@@ -7,23 +7,86 @@ from __future__ import print_function
 from __future__ import unicode_literals
 import sys
 from decimal import Decimal, InvalidOperation
+import heapq
+import itertools
 import os
 from collections import OrderedDict
 import openpyxl
-from six import text_type
+from openpyxl.worksheet.read_only import ReadOnlyWorksheet
+from six import integer_types, text_type
 from warnings import warn
 import traceback
 import datetime
 import pytz
 from openpyxl.utils import _get_column_letter, column_index_from_string
+from flattentool.compression import open_file, strip_compression_suffix
 from flattentool.exceptions import DataErrorWarning
+from flattentool.spill import ExternalSorter, SpillingDict, estimate_size, memory_budget_from_limit
+from flattentool.xlsx_reader import XLSXReader
 
 
-class Cell:
-    def __init__(self, cell_value, cell_location):
+class Cell(object):
+    """
+    A value read from a spreadsheet, and where it was read from. A cell is
+    made for every value, so only the parts of the location are kept, and
+    ``cell_location`` is only put together when it's asked for. Cells made
+    without a ``sheet`` (when no source map is wanted) have no location.
+
+    A cell can also be made with a ready-made ``(sheet name, column, row,
+    heading)`` location as its second argument, i.e. ``Cell(cell_value,
+    cell_location)``.
+
+    """
+    __slots__ = ('cell_value', 'sheet', 'column', 'row', 'heading', '_sub_cells')
+
+    def __init__(self, cell_value, sheet=None, column=None, row=None, heading=None):
         self.cell_value = cell_value
-        self.cell_location = cell_location
-        self.sub_cells = []
+        # A (sheet name, vertical orientation) tuple, shared by a sheet's
+        # cells, or a whole location if there's no column
+        self.sheet = sheet
+        # The (zero based) column number
+        self.column = column
+        self.row = row
+        self.heading = heading
+        # Other cells with the same value that have been merged into this
+        # one. Most cells never have any, so the list is only made when it's
+        # needed.
+        self._sub_cells = None
+
+    @property
+    def cell_location(self):
+        if self.sheet is None or self.column is None:
+            return self.sheet
+        sheet_name, vertical_orientation = self.sheet
+        if vertical_orientation:
+            # This is misleading as it specifies the row number as the distance vertically
+            # and the horizontal 'letter' as a number.
+            # https://github.com/OpenDataServices/flatten-tool/issues/153
+            column = str(self.column + 1)
+        else:
+            column = _get_column_letter(self.column + 1)
+        return (sheet_name, column, self.row, self.heading)
+
+    @cell_location.setter
+    def cell_location(self, cell_location):
+        self.sheet = cell_location
+        self.column = self.row = self.heading = None
+
+    @property
+    def sub_cells(self):
+        if self._sub_cells is None:
+            self._sub_cells = []
+        return self._sub_cells
+
+    def add_sub_cell(self, cell):
+        self.sub_cells.append(cell)
+
+    def iter_sub_cells(self):
+        """
+        Iterate over the sub cells, without making a list if there are none.
+
+        """
+        return iter(self._sub_cells or ())
 
 # The "pylint: disable" lines exist to ignore warnings about the imports we expect not to work not working
 
@@ -39,58 +102,172 @@ try:
 except ImportError:
     from UserDict import UserDict  # pylint: disable=F0401
 
-def convert_type(type_string, value, timezone = pytz.timezone('UTC')):
-    if value == '' or value is None:
-        return None
-    if type_string == 'number':
-        try:
-            return Decimal(value)
-        except (TypeError, ValueError, InvalidOperation):
-            warn('Non-numeric value "{}" found in number column, returning as string instead.'.format(value),
-                DataErrorWarning)
-            return text_type(value)
-    elif type_string == 'integer':
-        try:
-            return int(value)
-        except (TypeError, ValueError):
-            warn('Non-integer value "{}" found in integer column, returning as string instead.'.format(value),
-                DataErrorWarning)
-            return text_type(value)
-    elif type_string == 'boolean':
-        value = text_type(value)
-        if value.lower() in ['true', '1']:
-            return True
-        elif value.lower() in ['false', '0']:
-            return False
-        else:
-            warn('Unrecognised value for boolean: "{}", returning as string instead'.format(value),
-                DataErrorWarning)
-            return text_type(value)
-    elif type_string in ('array', 'array_array', 'string_array', 'number_array'):
-        value = text_type(value)
-        if type_string == 'number_array':
-            try:
-                if ',' in value:
-                    return [[Decimal(y) for y in x.split(',')] for x in value.split(';')]
-                else:
-                    return [Decimal(x) for x in value.split(';')]
-            except (TypeError, ValueError, InvalidOperation):
-                warn('Non-numeric value "{}" found in number array column, returning as string array instead.'.format(value),
-                    DataErrorWarning)
+def convert_number(value):
+    try:
+        return Decimal(value)
+    except (TypeError, ValueError, InvalidOperation):
+        warn('Non-numeric value "{}" found in number column, returning as string instead.'.format(value),
+            DataErrorWarning)
+        return text_type(value)
+
+
+def convert_integer(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        warn('Non-integer value "{}" found in integer column, returning as string instead.'.format(value),
+            DataErrorWarning)
+        return text_type(value)
+
+
+def convert_boolean(value):
+    value = text_type(value)
+    lower_value = value.lower()
+    if lower_value == 'true' or lower_value == '1':
+        return True
+    elif lower_value == 'false' or lower_value == '0':
+        return False
+    else:
+        warn('Unrecognised value for boolean: "{}", returning as string instead'.format(value),
+            DataErrorWarning)
+        return value
+
+
+def convert_array(value):
+    value = text_type(value)
+    if ',' in value:
+        return [x.split(',') for x in value.split(';')]
+    else:
+        return value.split(';')
+
+
+def convert_number_array(value):
+    value = text_type(value)
+    try:
         if ',' in value:
-            return [x.split(',') for x in value.split(';')]
+            return [[Decimal(y) for y in x.split(',')] for x in value.split(';')]
         else:
-            return value.split(';')
-    elif type_string == 'string':
-        if type(value) == datetime.datetime:
-            return timezone.localize(value).isoformat()
+            return [Decimal(x) for x in value.split(';')]
+    except (TypeError, ValueError, InvalidOperation):
+        warn('Non-numeric value "{}" found in number array column, returning as string array instead.'.format(value),
+            DataErrorWarning)
+    return convert_array(value)
+
+
+def make_datetime_converter(timezone, cache_size=10000):
+    """
+    Return a function that gives the ISO 8601 string for a (naive) datetime
+    in ``timezone``. Localizing is slow for timezones with daylight saving
+    time, and the same datetimes tend to come up again and again in a
+    column, so the strings for up to ``cache_size`` datetimes are kept.
+
+    """
+    localize = timezone.localize
+    cache = {}
+
+    def convert_datetime(value):
+        iso_string = cache.get(value)
+        if iso_string is None:
+            if len(cache) >= cache_size:
+                cache.clear()
+            iso_string = cache[value] = localize(value).isoformat()
+        return iso_string
+    return convert_datetime
+
+
+def make_string_converter(timezone):
+    convert_datetime = make_datetime_converter(timezone)
+
+    def convert_string(value):
+        if type(value) is datetime.datetime:
+            return convert_datetime(value)
         return text_type(value)
-    elif type_string == '':
-        if type(value) == datetime.datetime:
-            return timezone.localize(value).isoformat()
-        return value if type(value) in [int] else text_type(value)
-    else:
+    return convert_string
+
+
+def make_untyped_converter(timezone):
+    convert_datetime = make_datetime_converter(timezone)
+
+    def convert_untyped(value):
+        value_type = type(value)
+        if value_type is int:
+            return value
+        elif value_type is datetime.datetime:
+            return convert_datetime(value)
+        return text_type(value)
+    return convert_untyped
+
+
+def make_unrecognised_converter(type_string):
+    def convert_unrecognised(value):
         raise ValueError('Unrecognised type: "{}"'.format(type_string))
+    return convert_unrecognised
+
+
+TYPE_CONVERTERS = {
+    'number': convert_number,
+    'integer': convert_integer,
+    'boolean': convert_boolean,
+    'array': convert_array,
+    'array_array': convert_array,
+    'string_array': convert_array,
+    'number_array': convert_number_array,
+}
+
+# The converters that depend on the timezone, by type and timezone
+timezone_converters = {}
+
+
+def get_converter(type_string, timezone=pytz.timezone('UTC')):
+    """
+    Return a function that converts a (non blank) value from a column with
+    the type ``type_string`` in the schema, so that which conversion to do
+    is worked out once for each column, rather than for every cell.
+    Converters for strings localize datetimes to ``timezone``.
+
+    """
+    converter = TYPE_CONVERTERS.get(type_string)
+    if converter is not None:
+        return converter
+    key = (type_string, timezone)
+    converter = timezone_converters.get(key)
+    if converter is None:
+        if type_string == 'string':
+            converter = make_string_converter(timezone)
+        elif type_string == '':
+            converter = make_untyped_converter(timezone)
+        else:
+            # Only raised once there's a value to convert
+            converter = make_unrecognised_converter(type_string)
+        converter = timezone_converters[key] = converter
+    return converter
+
+
+def convert_type(type_string, value, timezone = pytz.timezone('UTC')):
+    if value == '' or value is None:
+        return None
+    return get_converter(type_string, timezone)(value)
+
+
+# The megabytes of lines to sort in memory at a time for an external sort,
+# if no memory_limit is given
+EXTERNAL_SORT_MEMORY_LIMIT = 100
+
+INFINITY = float('inf')
+
+
+def sort_key(value):
+    """
+    Return a key to sort a root id or id by: missing ids first, then numbers
+    by value, then everything else as text. This is the order sorted input
+    is expected to be in.
+
+    """
+    if value is None or value == '':
+        return (0, '')
+    elif isinstance(value, integer_types + (float, Decimal)):
+        return (1, value)
+    return (2, text_type(value))
 
 
 def merge(base, mergee, debug_info=None):
@@ -124,7 +301,7 @@ def merge(base, mergee, debug_info=None):
                             key, id_info, debug_info.get('sheet_name'), base_value, value),
                         DataErrorWarning)
                 else:
-                    base[key].sub_cells.append(v)
+                    base[key].add_sub_cell(v)
         else:
             # This happens when a parent record finds the first a child record of a known type
             base[key] = v
@@ -160,7 +337,11 @@ class SpreadsheetInput(object):
                  include_sheets=[],
                  exclude_sheets=[],
                  id_name='id',
-                 xml=False
+                 xml=False,
+                 memory_limit=None,
+                 max_empty_rows=None,
+                 sorted_input=False,
+                 external_sort=False
                 ):
         self.input_name = input_name
         self.root_list_path = root_list_path
@@ -174,6 +355,19 @@ class SpreadsheetInput(object):
         self.vertical_orientation = vertical_orientation
         self.include_sheets = include_sheets
         self.exclude_sheets = exclude_sheets
+        # The objects being built are moved to disk if they use more than
+        # memory_limit megabytes
+        self.memory_limit = memory_limit
+        # Spreadsheet input stops reading a sheet after this many empty rows
+        # in a row
+        self.max_empty_rows = max_empty_rows
+        # Whether each sheet's lines are sorted by root id (or id), so that
+        # objects can be unflattened one at a time (see do_unflatten_sorted)
+        self.sorted_input = sorted_input
+        # Whether to sort the lines on disk, so that objects can be
+        # unflattened one at a time from unsorted input (see
+        # do_unflatten_external_sort)
+        self.external_sort = external_sort
 
     def get_sub_sheets_lines(self):
         for sub_sheet_name in self.sub_sheet_names:
@@ -192,118 +386,320 @@ class SpreadsheetInput(object):
     def read_sheets(self):
         raise NotImplementedError
 
-    def do_unflatten(self):
-        main_sheet_by_ocid = OrderedDict()
-        sheets = list(self.get_sub_sheets_lines())
-        for i, sheet in enumerate(sheets):
-            sheet_name, lines = sheet
-            try:
-                actual_headings = self.get_sheet_headings(sheet_name)
-                found = OrderedDict()
-                last_col = len(actual_headings)
-                # We want to ignore data in earlier columns, so we look
-                # through the data backwards
-                for i, actual_heading in enumerate(reversed(actual_headings)):
-                    if actual_heading in found:
-                        found[actual_heading].append((last_col-i)-1)
-                    else:
-                        found[actual_heading] = [i]
-                for actual_heading in reversed(found):
-                    if len(found[actual_heading]) > 1:
-                        keeping = found[actual_heading][0]
-                        ignoring = found[actual_heading][1:]
-                        ignoring.reverse()
-                        if len(ignoring) >= 3:
-                            warn(
-                                (
-                                    'Duplicate heading "{}" found, ignoring '
-                                    'the data in columns {} and {}.'
-                                ).format(
-                                    actual_heading,
-                                    ', '.join(
-                                        [_get_column_letter(x+1) for x in ignoring[:-1]]
-                                    ),
-                                    _get_column_letter(ignoring[-1] + 1),
-                                ),
-                                DataErrorWarning
-                            )
-                        elif len(found[actual_heading]) == 3:
-                            warn(
-                                (
-                                    'Duplicate heading "{}" found, ignoring '
-                                    'the data in columns {} and {}.'
-                                ).format(
-                                    actual_heading,
-                                    _get_column_letter(ignoring[0] + 1),
-                                    _get_column_letter(ignoring[1] + 1),
-                                ),
-                                DataErrorWarning
-                            )
-                        else:
-                            warn(
-                                (
-                                    'Duplicate heading "{}" found, ignoring '
-                                    'the data in column {}.'
-                                ).format(
-                                    actual_heading,
-                                    _get_column_letter(ignoring[0]+1),
+    def share_workbook(self, spreadsheet_input):
+        """
+        Read from the workbook that ``spreadsheet_input``, an input of the
+        same format and file, has already opened, rather than opening it
+        again. Inputs that don't open a workbook ignore this.
+
+        """
+        pass
+
+    def close(self):
+        """
+        Close anything that was opened to read the sheets (e.g. a workbook),
+        once everything has been read from them. Inputs that share a workbook
+        may both close it.
+
+        """
+        pass
+
+    def get_checked_headings(self, sheet_name):
+        """
+        Return the headings of ``sheet_name`` (or None if they can't be got),
+        warning about any duplicate headings, whose earlier columns are
+        ignored.
+
+        """
+        try:
+            actual_headings = self.get_sheet_headings(sheet_name)
+            found = OrderedDict()
+            last_col = len(actual_headings)
+            # We want to ignore data in earlier columns, so we look
+            # through the data backwards
+            for i, actual_heading in enumerate(reversed(actual_headings)):
+                if actual_heading in found:
+                    found[actual_heading].append((last_col-i)-1)
+                else:
+                    found[actual_heading] = [i]
+            for actual_heading in reversed(found):
+                if len(found[actual_heading]) > 1:
+                    keeping = found[actual_heading][0]
+                    ignoring = found[actual_heading][1:]
+                    ignoring.reverse()
+                    if len(ignoring) >= 3:
+                        warn(
+                            (
+                                'Duplicate heading "{}" found, ignoring '
+                                'the data in columns {} and {}.'
+                            ).format(
+                                actual_heading,
+                                ', '.join(
+                                    [_get_column_letter(x+1) for x in ignoring[:-1]]
                                 ),
-                                DataErrorWarning
-                            )
-            except NotImplementedError:
-                # The ListInput type used in the tests doesn't support getting headings.
-                actual_headings = None
-            for j, line in enumerate(lines):
-                if all(x is None or x == '' for x in line.values()):
-                #if all(x == '' for x in line.values()):
-                    continue
-                root_id_or_none = line.get(self.root_id) if self.root_id else None
-                cells = OrderedDict()
+                                _get_column_letter(ignoring[-1] + 1),
+                            ),
+                            DataErrorWarning
+                        )
+                    elif len(found[actual_heading]) == 3:
+                        warn(
+                            (
+                                'Duplicate heading "{}" found, ignoring '
+                                'the data in columns {} and {}.'
+                            ).format(
+                                actual_heading,
+                                _get_column_letter(ignoring[0] + 1),
+                                _get_column_letter(ignoring[1] + 1),
+                            ),
+                            DataErrorWarning
+                        )
+                    else:
+                        warn(
+                            (
+                                'Duplicate heading "{}" found, ignoring '
+                                'the data in column {}.'
+                            ).format(
+                                actual_heading,
+                                _get_column_letter(ignoring[0]+1),
+                            ),
+                            DataErrorWarning
+                        )
+        except NotImplementedError:
+            # The ListInput type used in the tests doesn't support getting headings.
+            actual_headings = None
+        return actual_headings
+
+    def unflatten_sheet_lines(self, sheet_name, lines, with_locations=True):
+        """
+        Unflatten each line of a sheet on its own, and yield a
+        ``(root_id_or_none, line, unflattened)`` tuple for each line that
+        isn't empty.
+
+        """
+        actual_headings = self.get_checked_headings(sheet_name)
+        # How to unflatten each column, worked out once for the sheet
+        path_plans = {}
+        cell_sheet = (sheet_name, self.vertical_orientation)
+        for j, line in enumerate(lines):
+            if all(x is None or x == '' for x in line.values()):
+            #if all(x == '' for x in line.values()):
+                continue
+            root_id_or_none = line.get(self.root_id) if self.root_id else None
+            cells = OrderedDict()
+            if with_locations:
                 for k, header in enumerate(line):
                     heading = actual_headings[k] if actual_headings else header
-                    if self.vertical_orientation:
-                        # This is misleading as it specifies the row number as the distance vertically
-                        # and the horizontal 'letter' as a number.
-                        # https://github.com/OpenDataServices/flatten-tool/issues/153
-                        cells[header] = Cell(line[header], (sheet_name, str(k+1), j+2, heading))
-                    else:
-                        cells[header] = Cell(line[header], (sheet_name, _get_column_letter(k+1), j+2, heading))
-                unflattened = unflatten_main_with_parser(self.parser, cells, self.timezone, self.xml, self.id_name)
-                if root_id_or_none not in main_sheet_by_ocid:
-                    main_sheet_by_ocid[root_id_or_none] = TemporaryDict(self.id_name, xml=self.xml)
-                def inthere(unflattened, id_name):
-                    if self.xml:
-                        return unflattened[id_name]['text()'].cell_value
-                    else:
-                        return unflattened[id_name].cell_value
-                if self.id_name in unflattened and inthere(unflattened, self.id_name) in main_sheet_by_ocid[root_id_or_none]:
-                    if self.xml:
-                        unflattened_id = unflattened.get(self.id_name)['text()'].cell_value
-                    else:
-                        unflattened_id = unflattened.get(self.id_name).cell_value
-                    merge(
-                        main_sheet_by_ocid[root_id_or_none][unflattened_id],
-                        unflattened,
-                        {
-                            'sheet_name': sheet_name,
-                            'root_id': self.root_id,
-                            'root_id_or_none': root_id_or_none,
-                            'id_name': self.id_name,
-                            self.id_name: unflattened_id
-                        }
-                    )
-                else:
-                    main_sheet_by_ocid[root_id_or_none].append(unflattened)
+                    cells[header] = Cell(line[header], cell_sheet, k, j+2, heading)
+            else:
+                for header, value in line.items():
+                    cells[header] = Cell(value)
+            unflattened = unflatten_main_with_parser(self.parser, cells, self.timezone, self.xml, self.id_name, path_plans)
+            yield root_id_or_none, line, unflattened
+
+    def get_unflattened_id(self, unflattened):
+        if self.xml:
+            return unflattened[self.id_name]['text()'].cell_value
+        else:
+            return unflattened[self.id_name].cell_value
+
+    def add_unflattened(self, main_sheet_by_ocid, sheet_name, root_id_or_none, unflattened):
+        """
+        Add an unflattened line to the objects for its root id, merging it
+        into the object with the same id if there is one.
+
+        """
+        if root_id_or_none not in main_sheet_by_ocid:
+            main_sheet_by_ocid[root_id_or_none] = TemporaryDict(self.id_name, xml=self.xml)
+        if self.id_name in unflattened and self.get_unflattened_id(unflattened) in main_sheet_by_ocid[root_id_or_none]:
+            unflattened_id = self.get_unflattened_id(unflattened)
+            merge(
+                main_sheet_by_ocid[root_id_or_none][unflattened_id],
+                unflattened,
+                {
+                    'sheet_name': sheet_name,
+                    'root_id': self.root_id,
+                    'root_id_or_none': root_id_or_none,
+                    'id_name': self.id_name,
+                    self.id_name: unflattened_id
+                }
+            )
+        else:
+            main_sheet_by_ocid[root_id_or_none].append(unflattened)
+
+    def do_unflatten(self, with_locations=True):
+        """
+        Unflatten the sheets into a list of objects, whose values are
+        ``Cell``s. The cells only have locations if ``with_locations`` is
+        true, as they're only needed for source maps.
+
+        """
+        if self.sorted_input:
+            return self.do_unflatten_sorted(with_locations)
+        elif self.external_sort:
+            return self.do_unflatten_external_sort(with_locations)
+        memory_budget = memory_budget_from_limit(self.memory_limit)
+        if memory_budget is not None:
+            return self.do_unflatten_spilling(memory_budget, with_locations)
+        main_sheet_by_ocid = OrderedDict()
+        sheets = list(self.get_sub_sheets_lines())
+        for sheet_name, lines in sheets:
+            for root_id_or_none, line, unflattened in self.unflatten_sheet_lines(sheet_name, lines, with_locations):
+                self.add_unflattened(main_sheet_by_ocid, sheet_name, root_id_or_none, unflattened)
         temporarydicts_to_lists(main_sheet_by_ocid)
         return sum(main_sheet_by_ocid.values(), [])
 
+    def do_unflatten_spilling(self, memory_budget, with_locations=True):
+        """
+        Unflatten the sheets as do_unflatten does, but with each object kept
+        separately in a SpillingDict, so that once ``memory_budget`` is
+        exceeded only the object that a line is merged into is loaded back
+        from disk, however many objects share a root id (e.g. when there's no
+        root id at all).
+
+        """
+        spilled_items = SpilledItems(memory_budget)
+        sheets = list(self.get_sub_sheets_lines())
+        for sheet_name, lines in sheets:
+            for root_id_or_none, line, unflattened in self.unflatten_sheet_lines(sheet_name, lines, with_locations):
+                if self.id_name in unflattened:
+                    unflattened_id = self.get_unflattened_id(unflattened)
+                    key = (root_id_or_none, unflattened_id)
+                    if key in spilled_items.objects:
+                        merge(
+                            spilled_items.objects[key],
+                            unflattened,
+                            {
+                                'sheet_name': sheet_name,
+                                'root_id': self.root_id,
+                                'root_id_or_none': root_id_or_none,
+                                'id_name': self.id_name,
+                                self.id_name: unflattened_id
+                            }
+                        )
+                    else:
+                        spilled_items.add(root_id_or_none, key, unflattened)
+                else:
+                    key = spilled_items.add(root_id_or_none, None, unflattened)
+                spilled_items.objects.grow(key, estimate_size(line.values()))
+        return spilled_items
+
+    def get_sort_key(self, root_id_or_none, unflattened):
+        """
+        Return the key that the lines of sorted input are sorted by: the root
+        id, or the id if there's no root id.
+
+        """
+        if self.root_id:
+            return sort_key(root_id_or_none)
+        elif self.id_name in unflattened:
+            return sort_key(self.get_unflattened_id(unflattened))
+        return sort_key(None)
+
+    def iter_sorted_sheet(self, sheet_index, sheet_name, lines, with_locations=True):
+        """
+        Yield a ``(key, sheet_index, row_index, sheet_name, root_id_or_none,
+        unflattened)`` tuple for each line of a sheet that's sorted by key,
+        so that the tuples from all the sheets can be merged in order.
+
+        """
+        previous_key = None
+        for row_index, (root_id_or_none, line, unflattened) in enumerate(self.unflatten_sheet_lines(sheet_name, lines, with_locations)):
+            key = self.get_sort_key(root_id_or_none, unflattened)
+            if previous_key is not None and key < previous_key:
+                raise ValueError('Sheet "{}" is not sorted by {}: "{}" comes after "{}"'.format(
+                    sheet_name, self.root_id or self.id_name, key[-1], previous_key[-1]))
+            previous_key = key
+            yield key, sheet_index, row_index, sheet_name, root_id_or_none, unflattened
+
+    def do_unflatten_sorted(self, with_locations=True):
+        """
+        Unflatten sheets whose lines are sorted by root id (or id, if there's
+        no root id), yielding the objects for each key as soon as the lines
+        for the next key have been reached. The sheets are read in lockstep,
+        so only the lines for one key are kept in memory at a time.
+
+        """
+        sheets = [
+            self.iter_sorted_sheet(sheet_index, sheet_name, lines, with_locations)
+            for sheet_index, (sheet_name, lines) in enumerate(self.get_sub_sheets_lines())
+        ]
+        # The sheet and row indexes make each tuple unique, so the merge
+        # never compares the unflattened lines themselves, and the lines for
+        # each key are in the same order as do_unflatten reads them in.
+        return self.unflatten_merged_lines(heapq.merge(*sheets))
+
+    def do_unflatten_external_sort(self, with_locations=True):
+        """
+        Unflatten sheets in any order, giving the same objects, in the same
+        order, as do_unflatten, without keeping them all in memory.
+
+        Each line is unflattened on its own, and the lines are sorted on
+        disk by the position that their root id (or id) first appears at,
+        using ``memory_limit`` megabytes (or EXTERNAL_SORT_MEMORY_LIMIT) to
+        sort in. The lines for each root id (or id) are then merged as in
+        do_unflatten_sorted. Only the root ids (or ids) are kept in memory.
+
+        """
+        memory_budget = memory_budget_from_limit(self.memory_limit or EXTERNAL_SORT_MEMORY_LIMIT)
+        sorter = ExternalSorter(memory_budget)
+        key_positions = {}
+        sheets = list(self.get_sub_sheets_lines())
+        for sheet_index, (sheet_name, lines) in enumerate(sheets):
+            for row_index, (root_id_or_none, line, unflattened) in enumerate(self.unflatten_sheet_lines(sheet_name, lines, with_locations)):
+                if self.root_id:
+                    key = root_id_or_none
+                elif self.id_name in unflattened:
+                    key = self.get_unflattened_id(unflattened)
+                else:
+                    # Objects without an id come after all the others
+                    key = None
+                if key is None and not self.root_id:
+                    position = INFINITY
+                else:
+                    position = key_positions.get(key)
+                    if position is None:
+                        position = key_positions[key] = len(key_positions)
+                sorter.add(
+                    (position, sheet_index, row_index, sheet_name, root_id_or_none, unflattened),
+                    estimate_size(line.values()))
+        return self.unflatten_merged_lines(sorter.sorted_items())
+
+    def unflatten_merged_lines(self, merged_lines):
+        """
+        Yield the objects unflattened from ``(key, sheet_index, row_index,
+        sheet_name, root_id_or_none, unflattened)`` tuples, sorted by key,
+        one key at a time.
+
+        """
+        for _, key_lines in itertools.groupby(merged_lines, key=lambda key_line: key_line[0]):
+            main_sheet_by_ocid = OrderedDict()
+            for _, _, _, sheet_name, root_id_or_none, unflattened in key_lines:
+                self.add_unflattened(main_sheet_by_ocid, sheet_name, root_id_or_none, unflattened)
+            temporarydicts_to_lists(main_sheet_by_ocid)
+            for items in main_sheet_by_ocid.values():
+                for item in items:
+                    yield item
+
     def unflatten(self):
-        result = self.do_unflatten()
+        result = self.do_unflatten(with_locations=False)
+        if self.sorted_input or self.external_sort:
+            return iter_list_to_value(result)
         result = extract_list_to_value(result)
         return result
 
     def fancy_unflatten(self, with_cell_source_map, with_heading_source_map):
-        cell_tree = self.do_unflatten()
+        """
+        Return the unflattened objects, and the cell and heading source maps
+        that were asked for. With sorted input or an external sort, and no
+        source maps, the objects are an iterator, so that they can be written
+        as they're made.
+
+        """
+        if (self.sorted_input or self.external_sort) and not (with_cell_source_map or with_heading_source_map):
+            return iter_list_to_value(self.do_unflatten(with_locations=False)), None, None
+        cell_tree = self.do_unflatten(with_locations=with_cell_source_map or with_heading_source_map)
+        if self.sorted_input or self.external_sort:
+            cell_tree = list(cell_tree)
         result = extract_list_to_value(cell_tree)
         ordered_cell_source_map = None
         heading_source_map = None
@@ -370,7 +766,7 @@ def extract_dict_to_error_path(path, input):
             p = tuple(path+[k])
             assert p not in output, 'Already have key {}'.format(p)
             output[p] = [input[k].cell_location]
-            for sub_cell in input[k].sub_cells:
+            for sub_cell in input[k].iter_sub_cells():
                 assert sub_cell.cell_value == input[k].cell_value, 'Two sub-cells have different values: {}, {}'.format(input[k].cell_value, sub_cell.cell_value)
                 output[p].append(sub_cell.cell_location)
         else:
@@ -383,6 +779,10 @@ def extract_list_to_value(input):
         output.append(extract_dict_to_value(item))
     return output
 
+def iter_list_to_value(input):
+    for item in input:
+        yield extract_dict_to_value(item)
+
 def extract_dict_to_value(input):
     output = OrderedDict()
     for k in input:
@@ -399,23 +799,37 @@ def extract_dict_to_value(input):
 class CSVInput(SpreadsheetInput):
     encoding = 'utf-8'
 
-    def get_sheet_headings(self, sheet_name):
+    def sheet_file_name(self, sheet_name):
+        sheet_file_names = getattr(self, 'sheet_file_names', {})
+        return os.path.join(self.input_name, sheet_file_names.get(sheet_name, sheet_name+'.csv'))
+
+    def open_sheet_file(self, sheet_name):
+        # Compressed sheets are detected by their extension or magic bytes
         if sys.version > '3':  # If Python 3 or greater
-            with open(os.path.join(self.input_name, sheet_name+'.csv'), encoding=self.encoding) as main_sheet_file:
-                r = csvreader(main_sheet_file)
-                for row in enumerate(r):
-                    # Just return the first row
-                    return row[1]
+            # Pass the encoding to the open function
+            return open_file(self.sheet_file_name(sheet_name), encoding=self.encoding)
         else:  # If Python 2
-            with open(os.path.join(self.input_name, sheet_name+'.csv')) as main_sheet_file:
+            # The encoding is passed to the csv reader instead
+            return open_file(self.sheet_file_name(sheet_name), 'rb')
+
+    def get_sheet_headings(self, sheet_name):
+        with self.open_sheet_file(sheet_name) as main_sheet_file:
+            if sys.version > '3':  # If Python 3 or greater
+                r = csvreader(main_sheet_file)
+            else:  # If Python 2
                 r = csvreader(main_sheet_file, encoding=self.encoding)
-                for row in enumerate(r):
-                    # Just return the first row
-                    return row[1]
+            for row in enumerate(r):
+                # Just return the first row
+                return row[1]
 
     def read_sheets(self):
         sheet_file_names = os.listdir(self.input_name)
-        sheet_names = sorted([fname[:-4] for fname in sheet_file_names if fname.endswith('.csv')])
+        self.sheet_file_names = {}
+        for fname in sorted(sheet_file_names):
+            base_name = strip_compression_suffix(fname)
+            if base_name.endswith('.csv'):
+                self.sheet_file_names.setdefault(base_name[:-4], fname)
+        sheet_names = sorted(self.sheet_file_names)
         if self.include_sheets:
             for sheet in list(sheet_names):
                 if sheet not in self.include_sheets:
@@ -428,25 +842,56 @@ class CSVInput(SpreadsheetInput):
         self.sub_sheet_names = sheet_names
 
     def get_sheet_lines(self, sheet_name):
-        if sys.version > '3':  # If Python 3 or greater
-            # Pass the encoding to the open function
-            with open(os.path.join(self.input_name, sheet_name+'.csv'), encoding=self.encoding) as main_sheet_file:
+        with self.open_sheet_file(sheet_name) as main_sheet_file:
+            if sys.version > '3':  # If Python 3 or greater
                 dictreader = DictReader(main_sheet_file)
-                for line in dictreader:
-                    yield OrderedDict((fieldname, line[fieldname]) for fieldname in dictreader.fieldnames)
-        else:  # If Python 2
-            # Pass the encoding to DictReader
-            with open(os.path.join(self.input_name, sheet_name+'.csv')) as main_sheet_file:
+            else:  # If Python 2
+                # Pass the encoding to DictReader
                 dictreader = DictReader(main_sheet_file, encoding=self.encoding)
-                for line in dictreader:
-                    yield OrderedDict((fieldname, line[fieldname]) for fieldname in dictreader.fieldnames)
+            for line in dictreader:
+                yield OrderedDict((fieldname, line[fieldname]) for fieldname in dictreader.fieldnames)
 
 
 class XLSXInput(SpreadsheetInput):
-    def read_sheets(self):
-        self.workbook = openpyxl.load_workbook(self.input_name, data_only=True)
+    # How much of the start of each worksheet's XML is checked for inline
+    # strings, which at least the header row will use if any cells do
+    inline_strings_check_size = 65536
+
+    workbook = None
+    # A fully loaded copy of the workbook, for sheets that the read-only
+    # workbook can't read
+    loaded_workbook = None
+
+    def share_workbook(self, spreadsheet_input):
+        self.workbook = spreadsheet_input.workbook
+        self.loaded_workbook = spreadsheet_input.loaded_workbook
+
+    def close(self):
+        if self.workbook is not None:
+            # A read-only workbook keeps the file open, to read each sheet
+            # from, until it's closed. Older versions of openpyxl have no
+            # close method. Sheets that weren't read to the end (e.g. for
+            # their headings) keep the file open even then, so it's closed
+            # directly too.
+            xlsx_file = self.workbook._archive.fp
+            if hasattr(self.workbook, 'close'):
+                self.workbook.close()
+            else:
+                self.workbook._archive.close()
+            if xlsx_file is not None:
+                xlsx_file.close()
+        self.workbook = None
+        self.loaded_workbook = None
 
-        self.sheet_names_map = OrderedDict((sheet_name, sheet_name) for sheet_name in self.workbook.get_sheet_names())
+    def open_workbook(self):
+        if self.workbook is None:
+            # A read-only workbook reads each sheet's rows from the file as
+            # they're iterated over, rather than loading every cell up front
+            self.workbook = openpyxl.load_workbook(self.input_name, read_only=True, data_only=True)
+        return self.workbook.get_sheet_names()
+
+    def read_sheets(self):
+        self.sheet_names_map = OrderedDict((sheet_name, sheet_name) for sheet_name in self.open_workbook())
         if self.include_sheets:
             for sheet in list(self.sheet_names_map):
                 if sheet not in self.include_sheets:
@@ -457,30 +902,108 @@ class XLSXInput(SpreadsheetInput):
         sheet_names = list(sheet for sheet in self.sheet_names_map.keys())
         self.sub_sheet_names = sheet_names
 
-    def get_sheet_headings(self, sheet_name):
+    def get_worksheet(self, sheet_name):
         worksheet = self.workbook[self.sheet_names_map[sheet_name]]
+        xml_source = worksheet.xml_source
+        try:
+            start = xml_source.read(self.inline_strings_check_size)
+        finally:
+            xml_source.close()
+        if b't="inlineStr"' in start:
+            # openpyxl's read-only worksheets lose the values of inline
+            # strings (which some writers, including xlsx-native, use instead
+            # of shared strings), so these sheets are read from a fully
+            # loaded workbook instead
+            if self.loaded_workbook is None:
+                self.loaded_workbook = openpyxl.load_workbook(self.input_name, data_only=True)
+            worksheet = self.loaded_workbook[self.sheet_names_map[sheet_name]]
+        return worksheet
+
+    def iter_worksheet_rows(self, sheet_name, max_column=None):
+        worksheet = self.get_worksheet(sheet_name)
+        if isinstance(worksheet, ReadOnlyWorksheet):
+            # worksheet.rows only reads as far as the dimension stored in the
+            # sheet, which some writers give as smaller than the data (e.g.
+            # "A1"), and pads every row up to the last column it gives, which
+            # may be far beyond the data. So every row is read, up to its last
+            # cell, or padded up to max_column.
+            rows = worksheet.get_squared_range(1, 1, max_column, None)
+        else:
+            rows = worksheet.rows
+        return ([cell.value for cell in row[:max_column]] for row in rows)
+
+    def get_sheet_rows(self, sheet_name, max_column=None):
+        """
+        Yield a list of the values in each row of the sheet, or in each
+        column with ``vertical_orientation``. Rows may be cut off after
+        ``max_column`` values, but needn't be.
 
-        if self.vertical_orientation:
-            return [cell.value for cell in worksheet.columns[0]]
+        """
+        if not self.vertical_orientation:
+            return self.iter_worksheet_rows(sheet_name, max_column)
+        rows = self.iter_worksheet_rows(sheet_name)
+        # The rows are only read one at a time, so every row has to be read
+        # before any of the columns are known
+        rows = list(rows)
+        width = max(len(row) for row in rows) if rows else 0
+        return (list(column) for column in zip(*[row + [None] * (width - len(row)) for row in rows]))
 
-        return [cell.value for cell in worksheet.rows[0]]
+    def get_sheet_headings(self, sheet_name):
+        return next(self.get_sheet_rows(sheet_name), [])
 
     def get_sheet_lines(self, sheet_name):
-        worksheet = self.workbook[self.sheet_names_map[sheet_name]]
-        if self.vertical_orientation:
-            header_row = worksheet.columns[0]
-            remaining_rows = worksheet.columns[1:]
-        else:
-            header_row = worksheet.rows[0]
-            remaining_rows = worksheet.rows[1:]
+        header_row = self.get_sheet_headings(sheet_name)
+        coli_to_header = [(i, x) for i, x in enumerate(header_row) if x is not None]
+        if not coli_to_header:
+            return
+        # Cells in columns without a heading are never used, so they aren't
+        # read
+        rows = self.get_sheet_rows(sheet_name, max_column=coli_to_header[-1][0] + 1)
+        next(rows, None)
+
+        # Spreadsheet programs often save formatted but empty rows after the
+        # data, so empty rows are only given once another row with a value
+        # is found, and not at all after max_empty_rows of them in a row
+        empty_rows = 0
+        for row in rows:
+            # Rows may be shorter than the header if their last cells are
+            # empty
+            row_length = len(row)
+            line = OrderedDict((header, row[i] if i < row_length else None) for i, header in coli_to_header)
+            if all(value is None or value == '' for value in line.values()):
+                empty_rows += 1
+                if self.max_empty_rows is not None and empty_rows > self.max_empty_rows:
+                    return
+                continue
+            for _ in range(empty_rows):
+                yield OrderedDict((header, None) for i, header in coli_to_header)
+            empty_rows = 0
+            yield line
 
-        coli_to_header = ({i: x.value for i, x in enumerate(header_row) if x.value is not None})
-        for row in remaining_rows:
-            yield OrderedDict((coli_to_header[i], x.value) for i, x in enumerate(row) if i in coli_to_header)
+
+class NativeXLSXInput(XLSXInput):
+    """
+    Reads XLSX with flattentool's own minimal reader (see xlsx_reader.py)
+    instead of openpyxl, which is much faster for very large sheets.
+
+    """
+
+    def open_workbook(self):
+        if self.workbook is None:
+            self.workbook = XLSXReader(self.input_name)
+        return self.workbook.sheet_names
+
+    def close(self):
+        # XLSXReader only opens the file while it's reading it
+        self.workbook = None
+
+    def iter_worksheet_rows(self, sheet_name, max_column=None):
+        return self.workbook.iter_rows(self.sheet_names_map[sheet_name], max_column)
 
 
 FORMATS = {
     'xlsx': XLSXInput,
+    'xlsx-native': NativeXLSXInput,
     'csv': CSVInput
 }
 
@@ -511,35 +1034,99 @@ def list_as_dicts_to_temporary_dicts(unflattened, id_name, xml):
     return unflattened
 
 
-def unflatten_main_with_parser(parser, line, timezone, xml, id_name):
+# The kinds of step in a path plan (see compile_path)
+PATH_ARRAY = 0
+PATH_OBJECT = 1
+PATH_VALUE = 2
+PATH_ERROR = 3
+
+
+def compile_path(parser, path, timezone=pytz.timezone('UTC')):
+    """
+    Work out the steps to take to put a value from the column with the
+    heading ``path`` into an unflattened object. This only depends on the
+    heading (and the schema), so it's done once for each column, rather than
+    for every cell.
+
+    Each step is a tuple starting with its kind:
+
+    * ``(PATH_ARRAY, path_item, list_index, path_till_now)`` moves into the
+      item at ``list_index`` of an array.
+    * ``(PATH_OBJECT, path_item, path_till_now)`` moves into an object.
+    * ``(PATH_VALUE, path_item, converter)`` sets a value, converted with
+      the column's converter (see ``get_converter``).
+    * ``(PATH_ERROR, message)`` is a conflict with the schema, which is only
+      raised once there's a value in the column.
+
+    """
+    steps = []
+    path_list = [item.rstrip('[]') for item in path.split('/')]
+    ints = [isint(item) for item in path_list]
+    names_till_now = []
+    for num, path_item in enumerate(path_list):
+        if ints[num]:
+            continue
+        names_till_now.append(path_item)
+        path_till_now = '/'.join(names_till_now)
+        if parser:
+            current_type = parser.flattened.get(path_till_now)
+        else:
+            current_type = None
+        if num + 1 < len(path_list):
+            next_path_item = path_list[num+1]
+            next_is_int = ints[num+1]
+        else:
+            next_path_item = ''
+            next_is_int = False
+
+        ## Array
+        if next_is_int:
+            if current_type and current_type != 'array':
+                steps.append((PATH_ERROR, "There is an array at '{}' when the schema says there should be a '{}'".format(path_till_now, current_type)))
+                break
+            steps.append((PATH_ARRAY, path_item, int(next_path_item), path_till_now))
+            continue
+        if current_type == 'array':
+            steps.append((PATH_ARRAY, path_item, -1, path_till_now))
+            continue
+
+        ## Object
+        if current_type == 'object' or (not current_type and next_path_item):
+            steps.append((PATH_OBJECT, path_item, path_till_now))
+            continue
+        if current_type and current_type != 'object' and next_path_item:
+            steps.append((PATH_ERROR, "There is an object or list at '{}' but it should be an {}".format(path_till_now, current_type)))
+            break
+
+        ## Other Types
+        steps.append((PATH_VALUE, path_item, get_converter(current_type or '', timezone)))
+    return steps
+
+
+def unflatten_main_with_parser(parser, line, timezone, xml, id_name, path_plans=None):
+    """
+    Unflatten a single line. ``path_plans`` is a dict to keep the plan for
+    each heading in (see ``compile_path``), which should be shared between
+    the lines of a sheet.
+
+    """
+    if path_plans is None:
+        path_plans = {}
     unflattened = OrderedDict()
     for path, cell in line.items():
         # Skip blank cells
         if cell.cell_value is None or cell.cell_value == '':
             continue
+        plan = path_plans.get(path)
+        if plan is None:
+            plan = path_plans[path] = compile_path(parser, path, timezone)
         current_path = unflattened
-        path_list = [item.rstrip('[]') for item in path.split('/')]
-        for num, path_item in enumerate(path_list):
-            if isint(path_item):
-                continue
-            path_till_now = '/'.join([item for item in path_list[:num+1] if not isint(item)])
-            if parser:
-                current_type = parser.flattened.get(path_till_now)
-            else:
-                current_type = None
-            try:
-                next_path_item = path_list[num+1]
-            except IndexError:
-                next_path_item = ''
+        for step in plan:
+            kind = step[0]
 
             ## Array
-            list_index = -1
-            if isint(next_path_item):
-                if current_type and current_type != 'array':
-                    raise ValueError("There is an array at '{}' when the schema says there should be a '{}'".format(path_till_now, current_type))
-                list_index = int(next_path_item)
-
-            if isint(next_path_item) or current_type == 'array':
+            if kind == PATH_ARRAY:
+                _, path_item, list_index, path_till_now = step
                 list_as_dict = current_path.get(path_item)
                 if list_as_dict is None:
                     list_as_dict = ListAsDict()
@@ -553,10 +1140,10 @@ def unflatten_main_with_parser(parser, line, timezone, xml, id_name):
                     new_path = OrderedDict()
                     list_as_dict[list_index] = new_path
                 current_path = new_path
-                continue
 
             ## Object
-            if current_type == 'object' or (not current_type and next_path_item):
+            elif kind == PATH_OBJECT:
+                _, path_item, path_till_now = step
                 new_path = current_path.get(path_item)
                 if new_path is None:
                     new_path = OrderedDict()
@@ -566,32 +1153,33 @@ def unflatten_main_with_parser(parser, line, timezone, xml, id_name):
                         DataErrorWarning)
                     break
                 current_path = new_path
-                continue
-            if current_type and current_type != 'object' and next_path_item:
-                raise ValueError("There is an object or list at '{}' but it should be an {}".format(path_till_now, current_type))
+
+            elif kind == PATH_ERROR:
+                raise ValueError(step[1])
 
             ## Other Types
-            value = cell.cell_value
-            converted_value = convert_type(current_type or '', value, timezone)
-            cell.cell_value = converted_value
-            if converted_value is not None and converted_value != '':
-                if xml:
-                    # For XML we want to support text and attributes at the
-                    # same level, e.g.
-                    # <my-element a="b">some text</my-element>
-                    # which we represent in a dict as:
-                    # {"@a":"b", "text()": "some text"}
-                    # To ensure we can attach attributes everywhere, all
-                    # element text must be added as a dict with a `text()` key.
-                    if path_item.startswith('@'):
-                        current_path[path_item] = cell
-                    else:
-                        if path_item not in current_path:
-                            current_path[path_item] = {'text()': cell}
+            else:
+                _, path_item, converter = step
+                converted_value = converter(cell.cell_value)
+                cell.cell_value = converted_value
+                if converted_value is not None and converted_value != '':
+                    if xml:
+                        # For XML we want to support text and attributes at the
+                        # same level, e.g.
+                        # <my-element a="b">some text</my-element>
+                        # which we represent in a dict as:
+                        # {"@a":"b", "text()": "some text"}
+                        # To ensure we can attach attributes everywhere, all
+                        # element text must be added as a dict with a `text()` key.
+                        if path_item.startswith('@'):
+                            current_path[path_item] = cell
                         else:
-                            current_path[path_item]['text()'] = cell
-                else:
-                    current_path[path_item] = cell
+                            if path_item not in current_path:
+                                current_path[path_item] = {'text()': cell}
+                            else:
+                                current_path[path_item]['text()'] = cell
+                    else:
+                        current_path[path_item] = cell
 
     unflattened = list_as_dicts_to_temporary_dicts(unflattened, id_name, xml)
     return unflattened
@@ -663,6 +1251,46 @@ class TemporaryDict(UserDict):
         return list(self.data.values()) + self.items_no_keyfield
 
 
+class SpilledItems(object):
+    """
+    The objects unflattened for each root id, in order, each kept separately
+    in a SpillingDict.
+
+    As with a TemporaryDict, the objects for each root id that have an id
+    come first, then those that don't. Each time this is iterated over, the
+    objects are loaded from disk (if they've been spilled) and converted one
+    at a time, so they're never all in memory at once.
+
+    """
+    def __init__(self, memory_budget):
+        self.objects = SpillingDict(memory_budget)
+        # The keys of the objects for each root id, with and without an id
+        self.keys_by_root_id = OrderedDict()
+
+    def add(self, root_id_or_none, key, item):
+        """
+        Add an object, under ``key``, or under a new key of its own if
+        ``key`` is None (for objects without an id). Return the key.
+
+        """
+        if root_id_or_none not in self.keys_by_root_id:
+            self.keys_by_root_id[root_id_or_none] = ([], [])
+        keys, keys_no_id = self.keys_by_root_id[root_id_or_none]
+        if key is None:
+            key = (root_id_or_none, None, len(self.objects))
+            keys_no_id.append(key)
+        else:
+            keys.append(key)
+        self.objects[key] = item
+        return key
+
+    def __iter__(self):
+        for keys, keys_no_id in self.keys_by_root_id.values():
+            for item in self.objects.values(keys + keys_no_id):
+                temporarydicts_to_lists(item)
+                yield item
+
+
 def temporarydicts_to_lists(nested_dict):
     """ Recrusively transforms TemporaryDicts to lists inplace. """
     for key, value in nested_dict.items():
@@ -6,15 +6,20 @@ JSON schema, for that see schema.py).
 """
 
 import json
+import multiprocessing
+import pickle
+import re
 import six
 import copy
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from decimal import Decimal
+from flattentool.compression import open_file
 from flattentool.schema import SchemaParser
 from flattentool.input import path_search
 from flattentool.sheet import Sheet
+from flattentool.spill import memory_budget_from_limit
 from warnings import warn
-import codecs
+import warnings
 
 BASIC_TYPES = [six.text_type, bool, int, Decimal, type(None)]
 
@@ -23,6 +28,206 @@ class BadlyFormedJSONError(ValueError):
     pass
 
 
+WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+# Characters that can continue a number
+NUMBER_CHARACTERS_RE = re.compile(r'[0-9.eE+-]*')
+
+
+class JSONStreamReader(object):
+    """
+    Reads JSON values one at a time from a file, so that a single large
+    document doesn't need to be held in memory all at once.
+
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, json_file, chunk_size=None):
+        self.json_file = json_file
+        if chunk_size:
+            self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder(object_pairs_hook=OrderedDict, parse_float=Decimal)
+
+    def fill(self, size=None):
+        """
+        Read more of the file into the buffer, discarding what has already
+        been consumed.
+
+        """
+        chunk = self.json_file.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """
+        Return the next non-whitespace character without consuming it, or an
+        empty string at the end of the file.
+
+        """
+        while True:
+            self.pos = WHITESPACE_RE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos+1]
+            self.fill()
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise BadlyFormedJSONError('Expecting "{}" but found "{}" at character {} of the current buffer'.format(char, found, self.pos))
+        self.pos += 1
+
+    def decode_value(self):
+        """
+        Decode and consume the next complete JSON value.
+
+        """
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError as err:
+                if self.eof:
+                    raise BadlyFormedJSONError(*err.args)
+            else:
+                # A number that's only followed by characters that could be
+                # part of it, up to the end of the buffer (e.g. "1." or "1e"),
+                # may continue in the next chunk.
+                if self.eof or NUMBER_CHARACTERS_RE.match(self.buffer, end).end() < len(self.buffer):
+                    self.pos = end
+                    return value
+            # Grow the reads geometrically, so that a large value isn't
+            # re-decoded from the start once per chunk.
+            self.fill(size)
+            size = max(size, len(self.buffer))
+
+    def iter_list(self, path_list):
+        """
+        Yield each item of the list found by following ``path_list`` (a list
+        of object keys) from the start of the document.
+
+        """
+        if path_list:
+            if self.peek() != '{':
+                # Not an object, so fall back to the same lookup as the
+                # non-streaming code.
+                for item in path_search(self.decode_value(), path_list):
+                    yield item
+                return
+            self.expect('{')
+            while self.peek() != '}':
+                key = self.decode_value()
+                self.expect(':')
+                if key == path_list[0]:
+                    for item in self.iter_list(path_list[1:]):
+                        yield item
+                    return
+                # Discard the value of any other key
+                self.decode_value()
+                if self.peek() == ',':
+                    self.pos += 1
+                elif self.peek() != '}':
+                    self.expect('}')
+            return
+
+        if self.peek() != '[':
+            for item in self.decode_value():
+                yield item
+            return
+        self.expect('[')
+        if self.peek() == ']':
+            return
+        while True:
+            yield self.decode_value()
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+
+class DiscardLines(object):
+    """
+    A line sink (see JSONParser.line_sinks) that throws every line away.
+
+    """
+
+    def write_line(self, sheet, line):
+        pass
+
+
+class RecordLines(object):
+    """
+    A line sink (see JSONParser.line_sinks) that records each line, along
+    with the name of its sheet (None for the main sheet).
+
+    """
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.lines = []
+
+    def write_line(self, sheet, line):
+        self.lines.append((None if sheet is self.parser.main_sheet else sheet.name, line))
+
+
+class SchemaSheets(object):
+    """
+    Stands in for a SchemaParser in worker processes, as parse_json_dict only
+    needs the schema's main sheet for rollup.
+
+    """
+
+    def __init__(self, main_sheet):
+        self.main_sheet = main_sheet
+
+
+# The pickled starting state of the JSONParser in each worker process, set by
+# init_worker.
+worker_state = None
+
+
+def init_worker(state):
+    global worker_state
+    worker_state = state
+
+
+def parse_chunk(chunk):
+    """
+    Parse a chunk of the root list in a worker process.
+
+    Every chunk starts from the parser's state before any parsing, so the
+    result doesn't depend on which worker parsed which chunks. Returns the
+    columns of every sheet, the lines in the order they were produced, and
+    any warnings raised.
+
+    """
+    state = pickle.loads(worker_state)
+    parser = JSONParser(root_json_dict=chunk, root_id=state['root_id'], use_titles=state['use_titles'])
+    parser.main_sheet = state['main_sheet']
+    parser.sub_sheets = state['sub_sheets']
+    parser.rollup = state['rollup']
+    # In the main process the schema parser's main sheet is the same object
+    # as the parser's main sheet, so keep that true here.
+    parser.schema_parser = SchemaSheets(parser.main_sheet)
+    record_lines = RecordLines(parser)
+    parser.line_sinks = [record_lines]
+    with warnings.catch_warnings(record=True) as caught_warnings:
+        warnings.simplefilter('always')
+        parser.parse()
+    sheets = [(None, parser.main_sheet)] + list(parser.sub_sheets.items())
+    return (
+        [(sheet_name, sheet.id_columns, sheet.columns) for sheet_name, sheet in sheets],
+        record_lines.lines,
+        [(six.text_type(w.message), w.category) for w in caught_warnings],
+    )
+
+
 def sheet_key_field(sheet, key, id_key=None):
     if key not in sheet:
         sheet.append(key)
@@ -35,7 +240,7 @@ def sheet_key_title(sheet, key, id_key=None):
     """
     if id_key: # call sheet_key_field instead
         return sheet_key_field(sheet, key, id_key)
-    title_lookup = {v: k for k, v in sheet.titles.items()}
+    title_lookup = sheet.titles.inverse
     if key in title_lookup:
         return title_lookup[key]
     else:
@@ -47,12 +252,21 @@ class JSONParser(object):
     # Named for consistency with schema.SchemaParser, but not sure it's the most appropriate name.
     # Similarily with methods like parse_json_dict
 
-    def __init__(self, json_filename=None, root_json_dict=None, schema_parser=None, root_list_path=None, root_id='ocid', use_titles=False):
+    def __init__(self, json_filename=None, root_json_dict=None, schema_parser=None, root_list_path=None, root_id='ocid', use_titles=False, stream=False, workers=1, json_lines=False, memory_limit=None):
         self.sub_sheets = {}
         self.main_sheet = Sheet()
         self.root_list_path = root_list_path
         self.root_id = root_id
         self.use_titles = use_titles
+        self.stream = stream
+        self.json_lines = json_lines
+        self.workers = workers
+        # Outputs (see output.py) that each line is written to as soon as
+        # it's produced. If this is empty, lines are kept in sheet.lines.
+        self.line_sinks = []
+        # Lines kept in sheet.lines are moved to disk if they use more than
+        # memory_limit megabytes
+        self.memory_budget = memory_budget_from_limit(memory_limit)
         if schema_parser:
             self.main_sheet = schema_parser.main_sheet
             self.sub_sheets = schema_parser.sub_sheets
@@ -67,9 +281,16 @@ class JSONParser(object):
 
         if json_filename is not None and root_json_dict is not None:
             raise ValueError('Only one of json_file or root_json_dict should be supplied')
- 
-        if json_filename:
-            with codecs.open(json_filename, encoding='utf-8') as json_file:
+
+        if (stream or json_lines) and json_filename is None:
+            raise ValueError('stream and json_lines can only be used with json_filename')
+
+        self.json_filename = json_filename
+        if stream or json_lines:
+            # The file is read incrementally by parse()
+            pass
+        elif json_filename:
+            with open_file(json_filename) as json_file:
                 try:
                     self.root_json_dict = json.load(json_file, object_pairs_hook=OrderedDict, parse_float=Decimal)
                 except ValueError as err:
@@ -77,14 +298,134 @@ class JSONParser(object):
         else:
             self.root_json_dict = root_json_dict
 
+    def stream_root_json_list(self):
+        """
+        Yield the items of the root list one at a time, without loading the
+        whole JSON file into memory.
+
+        """
+        path_list = self.root_list_path.split('/') if self.root_list_path is not None else []
+        with open_file(self.json_filename) as json_file:
+            for json_dict in JSONStreamReader(json_file).iter_list(path_list):
+                yield json_dict
+
+    def json_lines_root_json_list(self):
+        """
+        Yield each line of a JSON Lines file (one JSON object per line) as an
+        item of the root list.
+
+        """
+        decoder = json.JSONDecoder(object_pairs_hook=OrderedDict, parse_float=Decimal)
+        with open_file(self.json_filename) as json_file:
+            for line_number, line in enumerate(json_file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield decoder.decode(line)
+                except ValueError as err:
+                    raise BadlyFormedJSONError('Line {}: {}'.format(line_number, err))
+
     def parse(self):
-        if self.root_list_path is None:
+        if self.json_lines:
+            root_json_list = self.json_lines_root_json_list()
+        elif self.stream:
+            root_json_list = self.stream_root_json_list()
+        elif self.root_list_path is None:
             root_json_list = self.root_json_dict
         else:
             root_json_list = path_search(self.root_json_dict, self.root_list_path.split('/'))
-        for json_dict in root_json_list:
-            self.parse_json_dict(json_dict, sheet=self.main_sheet)
-    
+        if self.workers > 1:
+            self.parse_parallel(root_json_list)
+        else:
+            for json_dict in root_json_list:
+                self.parse_json_dict(json_dict, sheet=self.main_sheet)
+
+    # Number of items of the root list sent to a worker process at once
+    parallel_chunk_size = 100
+
+    def parse_parallel(self, root_json_list):
+        """
+        Parse the root list in chunks across ``self.workers`` processes.
+
+        The chunks' results are merged in order, so the sheets, columns and
+        lines are the same as if the list had been parsed in this process.
+
+        """
+        state = pickle.dumps({
+            'root_id': self.root_id,
+            'use_titles': self.use_titles,
+            'rollup': self.rollup,
+            'main_sheet': self.main_sheet,
+            'sub_sheets': self.sub_sheets,
+        }, pickle.HIGHEST_PROTOCOL)
+        pool = multiprocessing.Pool(self.workers, init_worker, (state,))
+        try:
+            # Only keep a few chunks in flight, so that a streamed root list
+            # isn't read into memory faster than it can be parsed.
+            pending = deque()
+            chunk = []
+            for json_dict in root_json_list:
+                chunk.append(json_dict)
+                if len(chunk) == self.parallel_chunk_size:
+                    pending.append(pool.apply_async(parse_chunk, (chunk,)))
+                    chunk = []
+                    if len(pending) >= self.workers * 2:
+                        self.merge_chunk(pending.popleft().get())
+            if chunk:
+                pending.append(pool.apply_async(parse_chunk, (chunk,)))
+            while pending:
+                self.merge_chunk(pending.popleft().get())
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def merge_chunk(self, chunk_result):
+        sheet_columns, lines, caught_warnings = chunk_result
+        for sheet_name, id_columns, columns in sheet_columns:
+            if sheet_name is None:
+                sheet = self.main_sheet
+            else:
+                if sheet_name not in self.sub_sheets:
+                    self.sub_sheets[sheet_name] = Sheet(name=sheet_name)
+                sheet = self.sub_sheets[sheet_name]
+            for column in id_columns:
+                sheet.add_field(column, id_field=True)
+            for column in columns:
+                sheet.add_field(column)
+        for message, category in caught_warnings:
+            warn(message, category)
+        for sheet_name, line in lines:
+            self.add_line(self.main_sheet if sheet_name is None else self.sub_sheets[sheet_name], line)
+
+    def add_line(self, sheet, line):
+        if self.line_sinks:
+            for line_sink in self.line_sinks:
+                line_sink.write_line(sheet, line)
+        else:
+            if self.memory_budget is not None:
+                self.memory_budget.track(sheet.lines)
+            sheet.lines.append(line)
+
+    def parse_columns(self):
+        """
+        Parse the input to find every sheet and column, without keeping any
+        of the lines. A later call to parse() then produces lines whose
+        columns are already known.
+
+        """
+        line_sinks = self.line_sinks
+        self.line_sinks = [DiscardLines()]
+        try:
+            # Any warnings will be raised again by the second pass
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                self.parse()
+        finally:
+            self.line_sinks = line_sinks
+
     def parse_json_dict(self, json_dict, sheet, json_key=None, parent_name='', flattened_dict=None, parent_id_fields=None, top_level_of_sub_sheet=False):
         """
         Parse a json dictionary.
@@ -170,4 +511,4 @@ class JSONParser(object):
                 raise ValueError('Unsupported type {}'.format(type(value)))
         
         if top:
-            sheet.lines.append(flattened_dict)
+            self.add_line(sheet, flattened_dict)
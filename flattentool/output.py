@@ -6,12 +6,22 @@ formats.
 
 import openpyxl
 from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils import get_column_letter
 import csv
+import multiprocessing
 import os
+from collections import OrderedDict
+import pickle
 import sys
+import tempfile
+import threading
 from warnings import warn
+import warnings
 import six
+from six.moves import queue
+from flattentool.compression import COMPRESSION_SUFFIXES, open_file
 from flattentool.exceptions import DataErrorWarning
+from flattentool.xlsx_writer import WorksheetWriter, XLSXWriter
 
 if sys.version > '3':
     import csv
@@ -19,90 +29,662 @@ else:
     import unicodecsv as csv  # pylint: disable=F0401
 
 
+class LineSpool(object):
+    """
+    Holds the lines of a single sheet in a temporary file as they are
+    produced, so that they don't need to be kept in memory until the final
+    column order is known.
+
+    Each line is stored against the position its columns were first seen in,
+    rather than the column names themselves.
+
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.columns = []
+        self.column_index = {}
+        self.count = 0
+
+    def append(self, line):
+        row = []
+        for key, value in line.items():
+            index = self.column_index.get(key)
+            if index is None:
+                index = self.column_index[key] = len(self.columns)
+                self.columns.append(key)
+            row.append((index, value))
+        pickle.dump(row, self.file, pickle.HIGHEST_PROTOCOL)
+        self.count += 1
+
+    def __iter__(self):
+        self.file.seek(0)
+        for _ in range(self.count):
+            yield dict((self.columns[index], value) for index, value in pickle.load(self.file))
+
+    def iter_rows(self, header):
+        """
+        Yield each line as a list of its values for the columns in
+        ``header``, like ``SheetLines.iter_rows``.
+
+        """
+        header_index = dict((column, i) for i, column in enumerate(header))
+        plan = [header_index.get(column) for column in self.columns]
+        header_length = len(header)
+        self.file.seek(0)
+        for _ in range(self.count):
+            row = [None] * header_length
+            for index, value in pickle.load(self.file):
+                header_position = plan[index]
+                if header_position is not None:
+                    row[header_position] = value
+            yield row
+
+    def close(self):
+        self.file.close()
+
+
+def iter_sheet_rows(sheet_lines, sheet_header):
+    """
+    Yield each of ``sheet_lines`` as a list of values in the order of
+    ``sheet_header``. Compact line storage gives these directly, without
+    building a dict for each line.
+
+    """
+    if hasattr(sheet_lines, 'iter_rows'):
+        return sheet_lines.iter_rows(sheet_header)
+    return ([line.get(column) for column in sheet_header] for line in sheet_lines)
+
+
+class CSVSheetWriter(object):
+    """
+    Writes the rows of a sheet to a CSV file, after its header.
+
+    """
+
+    def __init__(self, csv_file, writer, sheet_header):
+        self.csv_file = csv_file
+        self.writer = writer
+        writer.writerow(sheet_header)
+
+    def write_row(self, row):
+        self.writer.writerow(row)
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.csv_file.close()
+
+
+class XLSXSheetWriter(object):
+    """
+    Writes the rows of a sheet to a worksheet with ``append``, after its
+    header, removing any characters that aren't allowed in a spreadsheet.
+
+    Rather than a warning for every cell that has characters removed,
+    there's one warning for each column when the sheet is closed.
+
+    """
+
+    # How many of the cells that had characters removed are listed in the
+    # warning for each column
+    illegal_characters_sample_size = 3
+
+    def __init__(self, sheet_name, sheet_header, append, close_worksheet=None):
+        self.sheet_name = sheet_name
+        self.sheet_header = sheet_header
+        self.append = append
+        self.close_worksheet = close_worksheet
+        self.row_number = 1
+        # The number of cells in each column that had characters removed,
+        # and the first few of those cells
+        self.illegal_characters = OrderedDict()
+        append(sheet_header)
+
+    def write_row(self, row):
+        self.row_number += 1
+        copied = False
+        for i, value in enumerate(row):
+            # All the illegal characters are control characters, so most
+            # strings can be passed over without running the regex
+            if isinstance(value, six.text_type) and value and min(value) < ' ':
+                new_value = ILLEGAL_CHARACTERS_RE.sub('', value)
+                if new_value != value:
+                    if i not in self.illegal_characters:
+                        self.illegal_characters[i] = [0, []]
+                    found = self.illegal_characters[i]
+                    found[0] += 1
+                    if len(found[1]) < self.illegal_characters_sample_size:
+                        found[1].append('{}{}'.format(get_column_letter(i + 1), self.row_number))
+                    # The row may also be being written to other outputs
+                    if not copied:
+                        row = list(row)
+                        copied = True
+                    row[i] = new_value
+        self.append(row)
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def close(self):
+        if self.close_worksheet is not None:
+            self.close_worksheet()
+        for i, (count, cells) in self.illegal_characters.items():
+            warn('Character(s) in {} cell(s) of column "{}" in sheet "{}" are not allowed in a spreadsheet cell. Those character(s) will be removed. First found in {}.'.format(
+                    count, self.sheet_header[i], self.sheet_name, ', '.join(cells)),
+                DataErrorWarning)
+
+
+class SheetWriters(object):
+    """
+    Writes each row of a sheet to several sheet writers.
+
+    """
+
+    def __init__(self, sheet_writers):
+        self.sheet_writers = sheet_writers
+
+    def write_row(self, row):
+        for sheet_writer in self.sheet_writers:
+            sheet_writer.write_row(row)
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def close(self):
+        for sheet_writer in self.sheet_writers:
+            sheet_writer.close()
+
+
+class ThreadedSheetWriters(SheetWriters):
+    """
+    Writes each row of a sheet to several sheet writers, each in its own
+    thread. Rows are passed to the threads in batches.
+
+    """
+
+    batch_size = 1000
+    # The number of batches that can be waiting for each thread
+    queue_size = 10
+
+    def __init__(self, sheet_writers):
+        super(ThreadedSheetWriters, self).__init__(sheet_writers)
+        self.batch = []
+        self.queues = []
+        self.threads = []
+        self.errors = []
+        for sheet_writer in sheet_writers:
+            batches = queue.Queue(self.queue_size)
+            thread = threading.Thread(target=self.run, args=(sheet_writer, batches))
+            thread.daemon = True
+            thread.start()
+            self.queues.append(batches)
+            self.threads.append(thread)
+
+    def run(self, sheet_writer, batches):
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                sheet_writer.write_rows(batch)
+            sheet_writer.close()
+        except Exception as e:
+            self.errors.append(e)
+            # Keep taking batches, so the main thread isn't left waiting
+            while batch is not None:
+                batch = batches.get()
+
+    def put_batch(self, batch):
+        for batches in self.queues:
+            batches.put(batch)
+
+    def write_row(self, row):
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self.put_batch(self.batch)
+            self.batch = []
+
+    def close(self):
+        if self.batch:
+            self.put_batch(self.batch)
+            self.batch = []
+        self.put_batch(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+def write_sheet_target(spreadsheet_output, target, sheet_name, sheet):
+    """
+    Write a sheet to ``target`` (see ``SpreadsheetOutput.sheet_target``),
+    which may be in a worker process. Returns any warnings raised, so they
+    can be raised again in the main process.
+
+    """
+    with warnings.catch_warnings(record=True) as caught_warnings:
+        warnings.simplefilter('always')
+        sheet_writer = spreadsheet_output.open_sheet_target(target, sheet_name, sheet)
+        sheet_writer.write_rows(iter_sheet_rows(sheet.lines, list(sheet)))
+        sheet_writer.close()
+    return [(six.text_type(w.message), w.category) for w in caught_warnings]
+
+
+# The output and sheets being written by write_sheets_parallel, which worker
+# processes inherit when they're forked
+worker_sheets = None
+
+
+def start_method_forks():
+    if hasattr(multiprocessing, 'get_start_method'):
+        return multiprocessing.get_start_method() == 'fork'
+    # Python 2 forks everywhere but Windows
+    return sys.platform != 'win32'
+
+
+def write_inherited_sheet(i):
+    spreadsheet_output, sheet_targets = worker_sheets
+    target, sheet_name, sheet = sheet_targets[i]
+    return write_sheet_target(spreadsheet_output, target, sheet_name, sheet)
+
+
 class SpreadsheetOutput(object):
+    # Whether each sheet is written to its own file or part, independently of
+    # the others, by open_sheet_target, so that they can be written in
+    # parallel
+    independent_sheets = False
+
     # output_name is given a default here, partly to help with tests,
     # but should have been defined by the time we get here.
-    def __init__(self, parser, main_sheet_name='main', output_name='unflattened'):
+    def __init__(self, parser, main_sheet_name='main', output_name='unflattened', compression=None, workers=1):
         self.parser = parser
         self.main_sheet_name = main_sheet_name
         self.output_name = output_name
+        # One of the keys of COMPRESSION_SUFFIXES, for formats that write
+        # separate files that can be compressed
+        self.compression = compression
+        # The number of processes to write independent sheets with
+        self.workers = workers
+        self.streamed_lines = {}
+
+    def __getstate__(self):
+        # Outputs are sent to worker processes to write sheets, which only
+        # need the output's options
+        state = self.__dict__.copy()
+        state['parser'] = None
+        state['streamed_lines'] = {}
+        return state
 
     def open(self):
         pass
 
-    def write_sheet(self, sheet_name, sheet_header, sheet_lines=None):
+    def sheet_target(self, sheet_name):
+        """
+        For outputs with ``independent_sheets``, add a sheet to the output,
+        and return where to write it to (e.g. a file name), which is passed
+        to ``open_sheet_target``. This is always called in the main process,
+        in the order the sheets are to appear.
+
+        """
         raise NotImplementedError
 
+    def open_sheet_target(self, target, sheet_name, sheet):
+        """
+        Return a sheet writer (see ``open_sheet``) for ``target``. This may be
+        called in a worker process.
+
+        """
+        raise NotImplementedError
+
+    def open_sheet(self, sheet_name, sheet):
+        """
+        Start writing a sheet, and return a sheet writer, which has a
+        ``write_row`` method for each row (a list of values in the order of
+        ``list(sheet)``), a ``write_rows`` method for an iterable of rows, and
+        a ``close`` method.
+
+        """
+        raise NotImplementedError
+
+    def write_sheet(self, sheet_name, sheet, sheet_lines=None):
+        sheet_writer = self.open_sheet(sheet_name, sheet)
+        sheet_writer.write_rows(iter_sheet_rows(sheet.lines if sheet_lines is None else sheet_lines, list(sheet)))
+        sheet_writer.close()
+
     def write_sheets(self):
-        self.open()
+        try:
+            self.open()
 
-        self.write_sheet(self.main_sheet_name, self.parser.main_sheet)
-        for sheet_name, sub_sheet in sorted(self.parser.sub_sheets.items()):
-            self.write_sheet(sheet_name, sub_sheet)
+            sheets = [(self.main_sheet_name, self.parser.main_sheet)] + sorted(self.parser.sub_sheets.items())
+            if self.independent_sheets and self.workers > 1 and len(sheets) > 1:
+                self.write_sheets_parallel(sheets)
+            else:
+                for sheet_name, sheet in sheets:
+                    self.write_sheet(sheet_name, sheet)
 
-        self.close()
+            self.close()
+        finally:
+            self.clean_up()
+
+    def write_sheets_parallel(self, sheets):
+        """
+        Write each sheet in one of ``self.workers`` processes.
+
+        The targets are added in order, so the sheets are in the same order
+        as when they're written one after another. Warnings are raised in
+        that order too.
+
+        """
+        global worker_sheets
+        sheet_targets = [(self.sheet_target(sheet_name), sheet_name, sheet) for sheet_name, sheet in sheets]
+        inherit = start_method_forks()
+        if inherit:
+            # Forked workers already have the sheets, so only the position
+            # of each one needs to be sent
+            worker_sheets = (self, sheet_targets)
+        pool = multiprocessing.Pool(min(self.workers, len(sheets)))
+        try:
+            results = []
+            for i, (target, sheet_name, sheet) in enumerate(sheet_targets):
+                if sheet.lines.spilled_count:
+                    # Lines that have been spilled are in a temporary file
+                    # that only this process can read
+                    results.append(write_sheet_target(self, target, sheet_name, sheet))
+                elif inherit:
+                    results.append(pool.apply_async(write_inherited_sheet, (i,)))
+                else:
+                    results.append(pool.apply_async(write_sheet_target, (self, target, sheet_name, sheet)))
+            for result in results:
+                caught_warnings = result if isinstance(result, list) else result.get()
+                for message, category in caught_warnings:
+                    warn(message, category)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            worker_sheets = None
 
     def close(self):
         pass
 
+    def clean_up(self):
+        """
+        Remove anything temporary that was made while writing, whether or
+        not the output was written successfully, including the lines passed
+        to ``write_line`` that haven't been written.
+
+        """
+        for spool in self.streamed_lines.values():
+            spool.close()
+        self.streamed_lines = {}
+
+    def sheet_name(self, sheet):
+        if sheet is self.parser.main_sheet:
+            return self.main_sheet_name
+        for sheet_name, sub_sheet in self.parser.sub_sheets.items():
+            if sub_sheet is sheet:
+                return sheet_name
+        return sheet.name
+
+    def write_line(self, sheet, line):
+        """
+        Accept a single line of ``sheet`` as soon as the parser has produced
+        it, instead of it being kept in ``sheet.lines``.
+
+        More columns may be added to the sheet after a line has been written,
+        so nothing is final until ``write_streamed_sheets`` is called.
+
+        """
+        if sheet not in self.streamed_lines:
+            self.streamed_lines[sheet] = LineSpool()
+        self.streamed_lines[sheet].append(line)
+
+    def write_streamed_sheets(self):
+        """
+        Write out all the sheets, using the lines passed to ``write_line``.
+
+        """
+        try:
+            self.open()
+
+            sheets = [(self.main_sheet_name, self.parser.main_sheet)] + sorted(self.parser.sub_sheets.items())
+            for sheet_name, sheet in sheets:
+                # The spool is left in streamed_lines until it's been
+                # written, so that clean_up closes it if writing fails
+                spool = self.streamed_lines.get(sheet)
+                self.write_sheet(sheet_name, sheet, spool if spool is not None else [])
+                if spool is not None:
+                    self.streamed_lines.pop(sheet).close()
+
+            self.close()
+        finally:
+            self.clean_up()
+
+
+class FanOutOutput(SpreadsheetOutput):
+    """
+    Writes the same sheets to several outputs (e.g. CSV and XLSX) at once.
+
+    Each sheet's lines are only walked, and turned into rows, once, with each
+    row given to every output. With ``threads``, each output writes its rows
+    in its own thread.
+
+    """
+
+    def __init__(self, outputs, threads=False):
+        super(FanOutOutput, self).__init__(
+            parser=outputs[0].parser,
+            main_sheet_name=outputs[0].main_sheet_name,
+            output_name=None)
+        self.outputs = outputs
+        self.threads = threads
+
+    def open(self):
+        for output in self.outputs:
+            output.open()
+
+    def open_sheet(self, sheet_name, sheet):
+        sheet_writers = [output.open_sheet(sheet_name, sheet) for output in self.outputs]
+        if self.threads:
+            return ThreadedSheetWriters(sheet_writers)
+        return SheetWriters(sheet_writers)
+
+    def close(self):
+        for output in self.outputs:
+            output.close()
+
+    def clean_up(self):
+        super(FanOutOutput, self).clean_up()
+        for output in self.outputs:
+            output.clean_up()
+
 
 class XLSXOutput(SpreadsheetOutput):
     def open(self):
-        self.workbook = openpyxl.Workbook()
-
-    def write_sheet(self, sheet_name, sheet):
-        sheet_header = list(sheet)
-        worksheet = self.workbook.create_sheet()
-        worksheet.title = sheet_name
-        worksheet.append(sheet_header)
-        for sheet_line in sheet.lines:
-            line = []
-            for header in sheet_header:
-                value = sheet_line.get(header)
-                if isinstance(value, six.text_type):
-                    new_value = ILLEGAL_CHARACTERS_RE.sub('', value)
-                    if new_value != value:
-                        warn("Character(s) in '{}' are not allowed in a spreadsheet cell. Those character(s) will be removed".format(value),
-                            DataErrorWarning)
-                    value = new_value
-                line.append(value)
-            worksheet.append(line)
+        # A write-only workbook writes each row out as it's appended, rather
+        # than keeping a cell object for every value until it's saved
+        self.workbook = openpyxl.Workbook(write_only=True)
+
+    def open_sheet(self, sheet_name, sheet):
+        worksheet = self.workbook.create_sheet(title=sheet_name)
+        return XLSXSheetWriter(sheet_name, list(sheet), worksheet.append)
 
     def close(self):
-        self.workbook.remove_sheet(self.workbook.active)
         self.workbook.save(self.output_name)
 
 
+class NativeXLSXOutput(XLSXOutput):
+    """
+    Writes XLSX with flattentool's own minimal writer (see xlsx_writer.py)
+    instead of openpyxl, which is much faster for very large sheets.
+
+    """
+
+    independent_sheets = True
+
+    def open(self):
+        self.workbook = XLSXWriter(self.output_name)
+
+    def sheet_target(self, sheet_name):
+        return self.workbook.add_sheet(sheet_name)
+
+    def open_sheet_target(self, target, sheet_name, sheet):
+        worksheet_writer = WorksheetWriter(target)
+        return XLSXSheetWriter(sheet_name, list(sheet), worksheet_writer.write_row, worksheet_writer.close)
+
+    def open_sheet(self, sheet_name, sheet):
+        return self.open_sheet_target(self.sheet_target(sheet_name), sheet_name, sheet)
+
+    def close(self):
+        self.workbook.close()
+
+    def clean_up(self):
+        super(NativeXLSXOutput, self).clean_up()
+        # The workbook isn't made until the output is opened
+        if getattr(self, 'workbook', None) is not None:
+            self.workbook.clean_up()
+
+
 class CSVOutput(SpreadsheetOutput):
+    independent_sheets = True
+
+    # Sheet files are written in large blocks, rather than the default of a
+    # few kilobytes at a time
+    buffer_size = 1024 * 1024
+
     def open(self):
         try:
             os.makedirs(self.output_name)
         except OSError:
             pass
 
-    def write_sheet(self, sheet_name, sheet):
-        sheet_header = list(sheet)
+    def sheet_file_name(self, sheet_name):
+        file_name = os.path.join(self.output_name, sheet_name+'.csv')
+        if self.compression:
+            file_name += COMPRESSION_SUFFIXES[self.compression]
+        return file_name
+
+    def sheet_target(self, sheet_name):
+        return self.sheet_file_name(sheet_name)
+
+    def open_sheet_target(self, target, sheet_name, sheet):
+        csv_file = self.open_sheet_file(target)
+        return CSVSheetWriter(csv_file, self.csv_writer(csv_file), list(sheet))
+
+    def open_sheet(self, sheet_name, sheet):
+        return self.open_sheet_target(self.sheet_target(sheet_name), sheet_name, sheet)
+
+    def open_sheet_file(self, file_name, mode='w'):
         if sys.version > '3':  # If Python 3 or greater
-            # Pass the encoding to the open function
-            with open(os.path.join(self.output_name, sheet_name+'.csv'), 'w', encoding='utf-8') as csv_file:
-                dictwriter = csv.DictWriter(csv_file, sheet_header)
-                dictwriter.writeheader()
-                for sheet_line in sheet.lines:
-                    dictwriter.writerow(sheet_line)
+            # newline='' is only needed when reading, so that newlines within
+            # quoted values survive a rewrite
+            return open_file(file_name, mode, newline='' if mode == 'r' else None, compression=self.compression, buffering=self.buffer_size)
         else:  # If Python 2
-            # Pass the encoding to DictReader
-            with open(os.path.join(self.output_name, sheet_name+'.csv'), 'w') as csv_file:
-                dictwriter = csv.DictWriter(csv_file, sheet_header, encoding='utf-8')
-                dictwriter.writeheader()
-                for sheet_line in sheet.lines:
-                    dictwriter.writerow(sheet_line)
+            return open_file(file_name, mode+'b', compression=self.compression, buffering=self.buffer_size)
+
+    def csv_writer(self, csv_file):
+        if sys.version > '3':
+            return csv.writer(csv_file)
+        else:
+            return csv.writer(csv_file, encoding='utf-8')
+
+    def write_line(self, sheet, line):
+        """
+        Write each line straight to its CSV file, with columns in the order
+        they were first seen. The file is only rewritten at the end if that
+        turns out not to be the final column order.
+
+        """
+        stream = self.streamed_lines.get(sheet)
+        if stream is None:
+            if not self.streamed_lines:
+                self.open()
+            file_name = self.sheet_file_name(self.sheet_name(sheet))
+            csv_file = self.open_sheet_file(file_name)
+            header = list(sheet)
+            stream = self.streamed_lines[sheet] = {
+                'file': csv_file,
+                'file_name': file_name,
+                'writer': self.csv_writer(csv_file),
+                'header': header,
+                'columns': list(header),
+                'column_index': dict((column, i) for i, column in enumerate(header)),
+            }
+            stream['writer'].writerow(header)
+        columns = stream['columns']
+        column_index = stream['column_index']
+        for key in line:
+            if key not in column_index:
+                column_index[key] = len(columns)
+                columns.append(key)
+        stream['writer'].writerow([line.get(column) for column in columns])
+
+    def write_streamed_sheets(self):
+        try:
+            self.open()
+
+            sheets = [(self.main_sheet_name, self.parser.main_sheet)] + sorted(self.parser.sub_sheets.items())
+            for sheet_name, sheet in sheets:
+                stream = self.streamed_lines.pop(sheet, None)
+                if stream is None:
+                    self.write_sheet(sheet_name, sheet, [])
+                    continue
+                stream['file'].close()
+                sheet_header = list(sheet)
+                if sheet_header != stream['header'] or sheet_header != stream['columns']:
+                    self.rewrite_sheet_file(stream['file_name'], sheet_header, stream['column_index'])
+
+            self.close()
+        finally:
+            self.clean_up()
+
+    def clean_up(self):
+        # Streamed lines are written straight to their files, rather than to
+        # spools
+        for stream in self.streamed_lines.values():
+            stream['file'].close()
+        self.streamed_lines = {}
+
+    def rewrite_sheet_file(self, file_name, sheet_header, column_index):
+        """
+        Rewrite a streamed CSV file so that it has the final header, and every
+        row is in that column order.
+
+        """
+        # Columns that have never had a value are left blank
+        plan = [column_index.get(column, sys.maxsize) for column in sheet_header]
+        tmp_file_name = file_name + '.tmp'
+        with self.open_sheet_file(file_name, 'r') as old_file, self.open_sheet_file(tmp_file_name) as new_file:
+            if sys.version > '3':
+                reader = csv.reader(old_file)
+            else:
+                reader = csv.reader(old_file, encoding='utf-8')
+            writer = self.csv_writer(new_file)
+            writer.writerow(sheet_header)
+            next(reader)
+            for row in reader:
+                row_length = len(row)
+                writer.writerow([row[i] if i < row_length else None for i in plan])
+        os.remove(file_name)
+        os.rename(tmp_file_name, file_name)
 
 
 FORMATS = {
     'xlsx': XLSXOutput,
-    'csv': CSVOutput
+    'csv': CSVOutput,
+    'xlsx-native': NativeXLSXOutput
 }
 FORMATS_SUFFIX = {
     'xlsx': '.xlsx',
-    'csv': ''  # This is the suffix for the directory
+    'csv': '',  # This is the suffix for the directory
+    'xlsx-native': '.xlsx'
 }
+# The formats written when the output format is "all". The others are just
+# different ways of writing one of these.
+ALL_FORMATS = ['xlsx', 'csv']
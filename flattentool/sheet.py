@@ -1,25 +1,261 @@
+from array import array
+from six.moves import zip
+from itertools import islice
+import pickle
+import tempfile
+from flattentool.spill import estimate_size
+
+
+class Titles(dict):
+    """
+    A dict of titles, which also keeps ``inverse``, an index from each value
+    back to its key (the last key, if several share a value).
+
+    Adding a new key updates the index in place. Anything else that changes
+    existing keys is rare, so simply rebuilds it.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Titles, self).__init__(*args, **kwargs)
+        self.rebuild_inverse()
+
+    def __reduce__(self):
+        # The default pickling sets items before the inverse attribute exists
+        return (Titles, (dict(self),))
+
+    def rebuild_inverse(self):
+        self.inverse = {v: k for k, v in self.items()}
+
+    def __setitem__(self, key, value):
+        if key in self:
+            super(Titles, self).__setitem__(key, value)
+            self.rebuild_inverse()
+        else:
+            super(Titles, self).__setitem__(key, value)
+            self.inverse[value] = key
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, value=None):
+        if key not in self:
+            self[key] = value
+        return self[key]
+
+    def __delitem__(self, key):
+        super(Titles, self).__delitem__(key)
+        self.rebuild_inverse()
+
+    def pop(self, *args):
+        value = super(Titles, self).pop(*args)
+        self.rebuild_inverse()
+        return value
+
+    def popitem(self):
+        item = super(Titles, self).popitem()
+        self.rebuild_inverse()
+        return item
+
+    def clear(self):
+        super(Titles, self).clear()
+        self.rebuild_inverse()
+
+
+class SheetLines(object):
+    """
+    The lines of a sheet, stored compactly rather than as a dict per line.
+
+    Each column name is stored once, in ``columns``. Each line is stored as a
+    tuple of its values, plus the number of its "layout", the tuple of column
+    numbers the values are for. Most lines of a sheet share one of a few
+    layouts, so these are also only stored once.
+
+    Iterating gives each line as a dict, as if this were a list of dicts.
+    ``iter_rows`` gives the lines as lists instead, without building dicts.
+
+    If a ``memory_budget`` (see flattentool.spill) is tracking these lines,
+    the values of the lines so far are moved to a temporary file whenever it
+    is exceeded. ``line_values`` then only holds the lines after
+    ``spilled_count``.
+
+    """
+
+    def __init__(self, lines=()):
+        self.columns = []
+        self.column_index = {}
+        self.layouts = []
+        self.layout_index = {}
+        self.line_layouts = array('I')
+        self.line_values = []
+        self.memory_budget = None
+        self.spill_file = None
+        self.spilled_count = 0
+        for line in lines:
+            self.append(line)
+
+    def append(self, line):
+        column_index = self.column_index
+        layout = []
+        for key in line:
+            index = column_index.get(key)
+            if index is None:
+                index = column_index[key] = len(self.columns)
+                self.columns.append(key)
+            layout.append(index)
+        layout = tuple(layout)
+        layout_number = self.layout_index.get(layout)
+        if layout_number is None:
+            layout_number = self.layout_index[layout] = len(self.layouts)
+            self.layouts.append(layout)
+        self.line_layouts.append(layout_number)
+        values = tuple(line.values())
+        self.line_values.append(values)
+        if self.memory_budget is not None:
+            self.memory_budget.add(estimate_size(values))
+
+    def __getstate__(self):
+        # Sheets are sent to worker processes, which don't share the memory
+        # budget. Spilled lines are in a temporary file that can't be sent.
+        if self.spilled_count:
+            raise pickle.PicklingError('Lines that have been spilled to disk can not be pickled')
+        state = self.__dict__.copy()
+        state['memory_budget'] = None
+        state['spill_file'] = None
+        return state
+
+    def spill(self):
+        if not self.line_values:
+            return
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile()
+        self.spill_file.seek(0, 2)
+        for values in self.line_values:
+            pickle.dump(values, self.spill_file, pickle.HIGHEST_PROTOCOL)
+        self.spilled_count += len(self.line_values)
+        self.line_values = []
+
+    def iter_values(self):
+        if self.spilled_count:
+            self.spill_file.seek(0)
+            for _ in range(self.spilled_count):
+                yield pickle.load(self.spill_file)
+        for values in self.line_values:
+            yield values
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def line_dict(self, layout_number, values):
+        columns = self.columns
+        return dict(zip((columns[index] for index in self.layouts[layout_number]), values))
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < self.spilled_count:
+            values = next(islice(self.iter_values(), i, None))
+        else:
+            values = self.line_values[i - self.spilled_count]
+        return self.line_dict(self.line_layouts[i], values)
+
+    def __iter__(self):
+        for layout_number, values in zip(self.line_layouts, self.iter_values()):
+            yield self.line_dict(layout_number, values)
+
+    def iter_rows(self, header):
+        """
+        Yield each line as a list of its values for the columns in
+        ``header``, with None for any column the line has no value for.
+
+        """
+        header_index = dict((column, i) for i, column in enumerate(header))
+        # The position in the row of each column of each layout. Columns that
+        # aren't in the header are left out, as are their values.
+        plans = [
+            [(value_index, header_index[self.columns[column]])
+             for value_index, column in enumerate(layout)
+             if self.columns[column] in header_index]
+            for layout in self.layouts]
+        header_length = len(header)
+        for layout_number, values in zip(self.line_layouts, self.iter_values()):
+            row = [None] * header_length
+            for value_index, header_position in plans[layout_number]:
+                row[header_position] = values[value_index]
+            yield row
+
+    def __len__(self):
+        return len(self.line_layouts)
+
+    def __eq__(self, other):
+        if isinstance(other, (SheetLines, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'SheetLines({!r})'.format(list(self))
+
+
 class Sheet(object):
     """
     An abstract representation of a single sheet of a spreadsheet.
 
+    The columns are kept in lists, to preserve their order, alongside sets of
+    the same columns so that checking whether a column is already present
+    doesn't depend on how many columns there are. The lines are kept in a
+    ``SheetLines``.
+
     """
 
     def __init__(self, columns=None, root_id='', name=None):
         self.id_columns = []
         self.columns = columns if columns else []
-        self.titles = {}
-        self.lines = []
+        self.id_column_set = set()
+        self.column_set = set(self.columns)
+        self.titles = Titles()
+        self.lines = SheetLines()
         self.root_id = root_id
         self.name = name
 
+    @property
+    def titles(self):
+        return self._titles
+
+    @titles.setter
+    def titles(self, titles):
+        self._titles = titles if isinstance(titles, Titles) else Titles(titles)
+
+    @property
+    def lines(self):
+        return self._lines
+
+    @lines.setter
+    def lines(self, lines):
+        self._lines = lines if isinstance(lines, SheetLines) else SheetLines(lines)
+
     def add_field(self, field, id_field=False):
-        columns = self.id_columns if id_field else self.columns
-        if field not in columns:
+        if id_field:
+            columns, column_set = self.id_columns, self.id_column_set
+        else:
+            columns, column_set = self.columns, self.column_set
+        if field not in column_set:
             columns.append(field)
+            column_set.add(field)
 
     def append(self, item):
         self.add_field(item)
 
+    def __contains__(self, item):
+        return item in self.column_set or item in self.id_column_set or (bool(self.root_id) and item == self.root_id)
+
     def __iter__(self):
         if self.root_id:
             yield self.root_id
@@ -0,0 +1,218 @@
+"""
+Keeping a budget on how much memory is used for the lines of sheets (when
+flattening) and the objects being built (when unflattening), and moving them
+to temporary storage on disk once that budget is exceeded. The same is used
+to sort more lines than fit in memory.
+
+"""
+
+import heapq
+import pickle
+import sqlite3
+import sys
+import tempfile
+
+
+class MemoryBudget(object):
+    """
+    A limit, in bytes, on the memory used by a number of "spillables". Each
+    spillable reports the (estimated) size of what it adds with ``add``, and
+    has a ``spill`` method that moves everything it's holding to disk.
+
+    Once the limit is exceeded every spillable is spilled, and counting
+    starts again from zero.
+
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.spillables = []
+
+    def track(self, spillable):
+        if spillable.memory_budget is not self:
+            spillable.memory_budget = self
+            self.spillables.append(spillable)
+
+    def add(self, size):
+        self.used += size
+        if self.used > self.limit:
+            for spillable in self.spillables:
+                spillable.spill()
+            self.used = 0
+
+
+def memory_budget_from_limit(memory_limit):
+    """
+    Return a MemoryBudget for ``memory_limit`` megabytes, or None if there is
+    no limit.
+
+    """
+    if memory_limit:
+        return MemoryBudget(memory_limit * 1024 * 1024)
+    return None
+
+
+# A rough allowance for the objects that wrap each value, e.g. a dict entry
+# when flattening, or a Cell and its location when unflattening
+VALUE_OVERHEAD = 200
+
+
+def estimate_size(values):
+    """
+    Estimate the memory used to hold ``values``.
+
+    """
+    return sum(sys.getsizeof(value) + VALUE_OVERHEAD for value in values)
+
+
+class SpillingDict(object):
+    """
+    An ordered mapping whose values are moved to a private temporary SQLite
+    database when its memory budget is exceeded, and loaded back when they're
+    next used.
+
+    Values are only weighed when ``grow`` is called, so after changing a
+    value, call ``grow`` with an estimate of how much bigger it has got. A
+    value that's been fetched may be spilled by any later ``grow``, after
+    which changes to it are lost, so fetch it again rather than holding on to
+    it.
+
+    """
+
+    def __init__(self, memory_budget):
+        self.memory_budget = None
+        memory_budget.track(self)
+        self.key_numbers = {}
+        self.ordered_keys = []
+        self.in_memory = {}
+        self.sizes = {}
+        self.connection = None
+
+    def __contains__(self, key):
+        return key in self.key_numbers
+
+    def __len__(self):
+        return len(self.ordered_keys)
+
+    def __setitem__(self, key, value):
+        number = self.key_numbers.get(key)
+        if number is None:
+            number = self.key_numbers[key] = len(self.ordered_keys)
+            self.ordered_keys.append(key)
+            self.sizes[number] = 0
+        self.in_memory[number] = value
+
+    def __getitem__(self, key):
+        number = self.key_numbers[key]
+        if number not in self.in_memory:
+            self.in_memory[number] = self.load(number, delete=True)
+            # Count the value again now that it's back in memory
+            self.memory_budget.used += self.sizes[number]
+        return self.in_memory[number]
+
+    def grow(self, key, size):
+        self.sizes[self.key_numbers[key]] += size
+        self.memory_budget.add(size)
+
+    def keys(self):
+        return list(self.ordered_keys)
+
+    def values(self, keys=None):
+        """
+        Yield the value for each of ``keys``, or for every key in order.
+        Values that have been spilled are loaded one at a time, and aren't
+        kept in memory afterwards.
+
+        """
+        if keys is None:
+            numbers = range(len(self.ordered_keys))
+        else:
+            numbers = (self.key_numbers[key] for key in keys)
+        for number in numbers:
+            if number in self.in_memory:
+                yield self.in_memory[number]
+            else:
+                yield self.load(number)
+
+    def items(self):
+        return zip(self.ordered_keys, self.values())
+
+    def spill(self):
+        if not self.in_memory:
+            return
+        if self.connection is None:
+            # An empty name gives a private on-disk database, which is
+            # deleted when the connection is closed
+            self.connection = sqlite3.connect('')
+            self.connection.execute('CREATE TABLE spilled (number INTEGER PRIMARY KEY, value BLOB)')
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO spilled (number, value) VALUES (?, ?)',
+            ((number, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+             for number, value in self.in_memory.items()))
+        self.in_memory = {}
+
+    def load(self, number, delete=False):
+        row = self.connection.execute('SELECT value FROM spilled WHERE number = ?', (number,)).fetchone()
+        if delete:
+            self.connection.execute('DELETE FROM spilled WHERE number = ?', (number,))
+        return pickle.loads(bytes(row[0]))
+
+
+def iter_run(run_file):
+    run_file.seek(0)
+    while True:
+        try:
+            yield pickle.load(run_file)
+        except EOFError:
+            return
+
+
+class ExternalSorter(object):
+    """
+    Sorts more items than fit in memory. Whenever the memory budget is
+    exceeded, the items being held are sorted and written to a temporary
+    "run" file, and ``sorted_items`` merges the runs back together.
+
+    Items are compared as a whole when they're sorted and merged, so they
+    should be tuples that start with something unique, e.g. a position.
+
+    """
+
+    def __init__(self, memory_budget):
+        self.memory_budget = None
+        memory_budget.track(self)
+        self.items = []
+        self.run_files = []
+
+    def add(self, item, size):
+        """
+        Add an item, whose (estimated) size is ``size``.
+
+        """
+        self.items.append(item)
+        self.memory_budget.add(size)
+
+    def spill(self):
+        if not self.items:
+            return
+        self.items.sort()
+        run_file = tempfile.TemporaryFile()
+        for item in self.items:
+            pickle.dump(item, run_file, pickle.HIGHEST_PROTOCOL)
+        self.run_files.append(run_file)
+        self.items = []
+
+    def sorted_items(self):
+        """
+        Yield every item that's been added, in order. Only one item from each
+        run is in memory at a time, and the runs are deleted afterwards.
+
+        """
+        self.items.sort()
+        try:
+            for item in heapq.merge(*([iter_run(run_file) for run_file in self.run_files] + [iter(self.items)])):
+                yield item
+        finally:
+            for run_file in self.run_files:
+                run_file.close()
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-from flattentool import decimal_default, unflatten
+from flattentool import decimal_default, unflatten, flatten
+from flattentool.compression import open_compressed, open_file
+from flattentool.output import CSVOutput
 from decimal import Decimal
 import json
 import sys
@@ -1076,6 +1078,68 @@ def test_metatab(tmpdir):
                                   'main/colC': [['subsheet', 'colC']],
                                   'main/colD': [['subsheet', 'colD']]}
 
+def test_metatab_loads_once(tmpdir, monkeypatch):
+    import flattentool.input
+    import flattentool.schema
+    tmpdir.join('schema.json').write('{"properties": {}}')
+    loads = []
+
+    def load_workbook(*args, **kwargs):
+        loads.append('workbook')
+        return load_workbook.original(*args, **kwargs)
+    load_workbook.original = flattentool.input.openpyxl.load_workbook
+
+    def load_schema(*args, **kwargs):
+        loads.append('schema')
+        return load_schema.original(*args, **kwargs)
+    load_schema.original = flattentool.schema.jsonref.load
+
+    monkeypatch.setattr(flattentool.input.openpyxl, 'load_workbook', load_workbook)
+    monkeypatch.setattr(flattentool.schema.jsonref, 'load', load_schema)
+    unflatten(
+        'flattentool/tests/fixtures/xlsx/basic_meta.xlsx',
+        input_format='xlsx',
+        output_name=tmpdir.join('meta_unflattened.json').strpath,
+        metatab_name='Meta',
+        metatab_vertical_orientation=True,
+        metatab_schema=tmpdir.join('schema.json').strpath,
+        schema=tmpdir.join('schema.json').strpath,
+        )
+
+    # The metatab and main passes share the workbook and the schema
+    assert sorted(loads) == ['schema', 'workbook']
+    assert json.load(tmpdir.join('meta_unflattened.json'))['a'] == 'a1'
+
+
+
+@pytest.mark.parametrize('sorted_input', [False, True])
+def test_unflatten_closes_workbook(tmpdir, monkeypatch, sorted_input):
+    import flattentool.input
+    workbooks = []
+
+    def load_workbook(*args, **kwargs):
+        workbook = load_workbook.original(*args, **kwargs)
+        workbooks.append((workbook, workbook._archive.fp))
+        return workbook
+    load_workbook.original = flattentool.input.openpyxl.load_workbook
+
+    monkeypatch.setattr(flattentool.input.openpyxl, 'load_workbook', load_workbook)
+    unflatten(
+        'flattentool/tests/fixtures/xlsx/basic_meta.xlsx',
+        input_format='xlsx',
+        output_name=tmpdir.join('meta_unflattened.json').strpath,
+        metatab_name='Meta',
+        metatab_vertical_orientation=True,
+        sorted_input=sorted_input,
+        )
+
+    # The read-only workbook keeps the file open until it's closed
+    assert len(workbooks) == 1
+    workbook, xlsx_file = workbooks[0]
+    assert workbook._archive.fp is None
+    assert xlsx_file.closed
+    assert json.load(tmpdir.join('meta_unflattened.json'))['a'] == 'a1'
+
 def test_metatab_only(tmpdir):
 
     unflatten(
@@ -1138,3 +1202,222 @@ def test_bad_format(tmpdir):
             input_format=None,
             output_name=tmpdir.join('meta_unflattened.json').strpath,
             )
+
+
+def test_flatten_two_pass(tmpdir, monkeypatch):
+    """
+    A two pass flatten should give byte identical CSV output, without
+    needing to rewrite any files to add columns found late.
+
+    """
+    input_json = tmpdir.join('input.json')
+    input_json.write(json.dumps({'main': [
+        {'id': '1', 'a': 'x', 'b': [{'id': 'b1', 'c': 'y'}]},
+        {'id': '2', 'd': 'z', 'b': [{'id': 'b2', 'e': 'w'}]},
+    ]}))
+    flatten(
+        input_json.strpath,
+        output_name=tmpdir.join('normal').strpath,
+        output_format='csv')
+
+    def rewrite_sheet_file(*args):
+        raise AssertionError('CSV file was rewritten')
+    monkeypatch.setattr(CSVOutput, 'rewrite_sheet_file', rewrite_sheet_file)
+    flatten(
+        input_json.strpath,
+        output_name=tmpdir.join('two_pass').strpath,
+        output_format='csv',
+        two_pass=True)
+
+    for sheet_name in ['main.csv', 'b.csv']:
+        assert tmpdir.join('two_pass', sheet_name).read_binary() == tmpdir.join('normal', sheet_name).read_binary()
+    assert tmpdir.join('two_pass', 'main.csv').read().replace('\r\n', '\n') == 'id,a,d\n1,x,\n2,,z\n'
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_flatten_workers(tmpdir, stream):
+    """
+    Flattening with several worker processes should give byte identical
+    output to a single process.
+
+    """
+    input_json = tmpdir.join('input.json')
+    input_json.write(json.dumps({'main': [
+        {'id': str(i), 'a{}'.format(i % 7): 'x', 'b{}'.format(i % 3): [{'id': 'b1', 'c{}'.format(i % 5): 'y'}]}
+        for i in range(250)
+    ]}))
+    for workers in [1, 3]:
+        flatten(
+            input_json.strpath,
+            output_name=tmpdir.join('workers{}'.format(workers)).strpath,
+            output_format='csv',
+            stream=stream,
+            workers=workers)
+    sheet_names = sorted(x.basename for x in tmpdir.join('workers1').listdir())
+    assert sheet_names == ['b0.csv', 'b1.csv', 'b2.csv', 'main.csv']
+    assert sorted(x.basename for x in tmpdir.join('workers3').listdir()) == sheet_names
+    for sheet_name in sheet_names:
+        assert tmpdir.join('workers3', sheet_name).read_binary() == tmpdir.join('workers1', sheet_name).read_binary()
+
+
+def test_flatten_jsonl(tmpdir):
+    tmpdir.join('input.json').write('{"main": [{"id": "1", "a": [{"b": "c"}]}, {"id": "2", "d": 1.5}]}')
+    tmpdir.join('input.jsonl').write('{"id": "1", "a": [{"b": "c"}]}\n\n{"id": "2", "d": 1.5}\n')
+    flatten(tmpdir.join('input.json').strpath, output_name=tmpdir.join('json').strpath, output_format='csv')
+    flatten(tmpdir.join('input.jsonl').strpath, output_name=tmpdir.join('jsonl').strpath, output_format='csv', input_format='jsonl')
+    for sheet_name in ['main.csv', 'a.csv']:
+        assert tmpdir.join('jsonl', sheet_name).read_binary() == tmpdir.join('json', sheet_name).read_binary()
+
+
+def test_unflatten_jsonl(tmpdir):
+    input_dir = tmpdir.ensure('input', dir=True)
+    input_dir.join('main.csv').write(
+        'id,a,b/0/c\n'
+        '1,é,2\n'
+        '3,4.5,\n'
+    )
+    unflatten(
+        input_dir.strpath,
+        input_format='csv',
+        output_name=tmpdir.join('output.jsonl').strpath,
+        output_format='jsonl',
+        schema=None)
+    assert tmpdir.join('output.jsonl').read_text(encoding='utf-8') == (
+        '{"id": "1", "a": "é", "b": [{"c": "2"}]}\n'
+        '{"id": "3", "a": "4.5"}\n'
+    )
+    with pytest.raises(Exception):
+        unflatten(input_dir.strpath, input_format='csv', output_format='jsonl', xml=True)
+    with pytest.raises(Exception):
+        unflatten(input_dir.strpath, input_format='csv', output_format='yaml')
+
+
+@pytest.mark.parametrize('compression,suffix', [('gzip', '.gz'), ('bz2', '.bz2'), ('xz', '.xz')])
+def test_flatten_compressed(tmpdir, compression, suffix):
+    data = b'{"main": [{"id": "1", "a": [{"b": "c"}]}, {"id": "2", "d": 1.5}]}'
+    tmpdir.join('input.json').write_binary(data)
+    with open_compressed(tmpdir.join('input.json'+suffix).strpath, 'wb', compression) as fp:
+        fp.write(data)
+    # Detected by the magic bytes, without an extension
+    with open_compressed(tmpdir.join('input').strpath, 'wb', compression) as fp:
+        fp.write(data)
+    flatten(tmpdir.join('input.json').strpath, output_name=tmpdir.join('plain').strpath, output_format='csv')
+    for input_name in ['input.json'+suffix, 'input']:
+        for stream in [False, True]:
+            flatten(tmpdir.join(input_name).strpath, output_name=tmpdir.join('compressed').strpath,
+                    output_format='csv', stream=stream, compression=compression)
+            for sheet_name in ['main.csv', 'a.csv']:
+                with open_compressed(tmpdir.join('compressed', sheet_name+suffix).strpath, 'rb', compression) as fp:
+                    assert fp.read() == tmpdir.join('plain', sheet_name).read_binary()
+
+
+@pytest.mark.parametrize('output_format', ['json', 'jsonl'])
+@pytest.mark.parametrize('suffix', ['', '.gz'])
+def test_unflatten_output_file(tmpdir, output_format, suffix):
+    input_dir = tmpdir.ensure('input', dir=True)
+    input_dir.join('main.csv').write_text('id,a\n1,é\n2,b\n', encoding='utf-8')
+    output_name = tmpdir.join('output.' + output_format + suffix).strpath
+    unflatten(input_dir.strpath, input_format='csv', output_name=output_name, output_format=output_format)
+    with open_file(output_name, 'r') as fp:
+        output = fp.read()
+    if output_format == 'json':
+        assert json.loads(output) == {'main': [{'id': '1', 'a': 'é'}, {'id': '2', 'a': 'b'}]}
+    else:
+        assert output == '{"id": "1", "a": "é"}\n{"id": "2", "a": "b"}\n'
+
+
+def test_unflatten_compressed(tmpdir):
+    input_dir = tmpdir.ensure('input', dir=True)
+    with open_compressed(input_dir.join('main.csv.gz').strpath, 'wb', 'gzip') as fp:
+        fp.write('id,c\n1,é\n'.encode('utf-8'))
+    input_dir.join('a.csv').write('id,a/0/b\n1,2\n')
+    with open_compressed(tmpdir.join('base.json.bz2').strpath, 'wb', 'bz2') as fp:
+        fp.write(b'{"version": "1.0"}')
+    unflatten(
+        input_dir.strpath,
+        input_format='csv',
+        base_json=tmpdir.join('base.json.bz2').strpath,
+        output_name=tmpdir.join('output.json.gz').strpath)
+    with open_compressed(tmpdir.join('output.json.gz').strpath, 'rb', 'gzip') as fp:
+        assert json.loads(fp.read().decode('utf-8')) == {
+            'version': '1.0',
+            'main': [{'id': '1', 'a': [{'b': '2'}], 'c': 'é'}],
+        }
+
+
+def test_unflatten_sorted_input(tmpdir):
+    input_dir = tmpdir.ensure('input', dir=True)
+    input_dir.join('main.csv').write(
+        'ocid,id,a\n'
+        'ocds-1,1,é\n'
+        'ocds-2,2,b\n'
+    )
+    input_dir.join('sub.csv').write(
+        'ocid,id,c/0/d\n'
+        'ocds-1,1,e\n'
+        'ocds-1,1,f\n'
+        'ocds-2,2,g\n'
+    )
+    tmpdir.join('base.json').write('{"version": "1.1", "main": null, "extensions": []}')
+    for sorted_input in [False, True]:
+        unflatten(
+            input_dir.strpath,
+            input_format='csv',
+            base_json=tmpdir.join('base.json').strpath,
+            root_id='ocid',
+            output_name=tmpdir.join('{}.json'.format(sorted_input)).strpath,
+            sorted_input=sorted_input)
+    # The objects are written as they're made, but the JSON is the same
+    assert tmpdir.join('True.json').read_binary() == tmpdir.join('False.json').read_binary()
+    assert json.loads(tmpdir.join('True.json').read_text(encoding='utf-8')) == {
+        'version': '1.1',
+        'main': [
+            {'ocid': 'ocds-1', 'id': '1', 'a': 'é', 'c': [{'d': 'e'}, {'d': 'f'}]},
+            {'ocid': 'ocds-2', 'id': '2', 'a': 'b', 'c': [{'d': 'g'}]},
+        ],
+        'extensions': [],
+    }
+
+    input_dir.join('sub.csv').remove()
+    input_dir.join('main.csv').write('ocid,id,a\n')
+    unflatten(input_dir.strpath, input_format='csv', root_id='ocid',
+              output_name=tmpdir.join('empty.json').strpath, sorted_input=True)
+    assert json.loads(tmpdir.join('empty.json').read_text(encoding='utf-8')) == {'main': []}
+
+
+def test_unflatten_external_sort(tmpdir):
+    input_dir = tmpdir.ensure('input', dir=True)
+    input_dir.join('main.csv').write(
+        'ocid,id,a\n'
+        'ocds-2,2,b\n'
+        'ocds-1,1,é\n'
+    )
+    input_dir.join('sub.csv').write(
+        'ocid,id,c/0/d\n'
+        'ocds-1,1,e\n'
+        'ocds-3,3,f\n'
+        'ocds-2,2,g\n'
+        'ocds-1,1,h\n'
+    )
+    for external_sort in [False, True]:
+        unflatten(
+            input_dir.strpath,
+            input_format='csv',
+            root_id='ocid',
+            output_name=tmpdir.join('{}.json'.format(external_sort)).strpath,
+            external_sort=external_sort,
+            memory_limit=0.0001)
+    assert tmpdir.join('True.json').read_binary() == tmpdir.join('False.json').read_binary()
+    assert [release['ocid'] for release in json.loads(tmpdir.join('True.json').read_text(encoding='utf-8'))['main']] == [
+        'ocds-2', 'ocds-1', 'ocds-3']
+
+
+def test_flatten_memory_limit(tmpdir):
+    tmpdir.join('input.json').write('{"main": [{"id": "1", "a": [{"b": "c"}]}, {"id": "2", "d": 1.5}]}')
+    flatten(tmpdir.join('input.json').strpath, output_name=tmpdir.join('plain').strpath, output_format='csv')
+    flatten(tmpdir.join('input.json').strpath, output_name=tmpdir.join('spilled').strpath, output_format='csv', memory_limit=0.0001)
+    # Spilled sheets are written in the main process rather than by a worker
+    flatten(tmpdir.join('input.json').strpath, output_name=tmpdir.join('workers').strpath, output_format='csv', memory_limit=0.0001, workers=2)
+    for sheet_name in ['main.csv', 'a.csv']:
+        assert tmpdir.join('spilled', sheet_name).read_binary() == tmpdir.join('plain', sheet_name).read_binary()
+        assert tmpdir.join('workers', sheet_name).read_binary() == tmpdir.join('plain', sheet_name).read_binary()
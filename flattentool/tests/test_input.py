@@ -4,7 +4,8 @@ Tests of functions in input.py
 Tests of SpreadsheetInput class and its children are in test_input_SpreadsheetInput*.py
 """
 from __future__ import unicode_literals
-from flattentool.input import path_search
+from flattentool.input import path_search, compile_path, Cell, merge, get_converter, convert_number, PATH_ARRAY, PATH_OBJECT, PATH_VALUE, PATH_ERROR
+from flattentool.schema import SchemaParser
 from decimal import Decimal
 from collections import OrderedDict
 import sys
@@ -38,3 +39,57 @@ def test_path_search():
         ['a1', 'c1'],
         id_fields={'a1/id': 'b1'},
         top=True) is goal_dict
+
+
+def test_compile_path():
+    assert compile_path(None, 'a/0/b[]/c') == [
+        (PATH_ARRAY, 'a', 0, 'a'),
+        (PATH_OBJECT, 'b', 'a/b'),
+        (PATH_VALUE, 'c', get_converter('')),
+    ]
+
+    parser = SchemaParser(root_schema_dict={'properties': {
+        'a': {'type': 'array', 'items': {'type': 'object', 'properties': {'b': {'type': 'number'}}}},
+        'c': {'type': 'string'},
+    }})
+    parser.parse()
+    assert compile_path(parser, 'a/b') == [
+        (PATH_ARRAY, 'a', -1, 'a'),
+        (PATH_VALUE, 'b', convert_number),
+    ]
+    # Conflicts with the schema are only raised when a cell has a value
+    assert compile_path(parser, 'c/0/d') == [
+        (PATH_ERROR, "There is an array at 'c' when the schema says there should be a 'string'"),
+    ]
+    assert compile_path(parser, 'c/d') == [
+        (PATH_ERROR, "There is an object or list at 'c' but it should be an string"),
+    ]
+
+
+def test_cell_location():
+    assert Cell('a').cell_location is None
+    cell = Cell('a', ('main', False), 27, 3, 'Heading')
+    assert cell.cell_location == ('main', 'AB', 3, 'Heading')
+    # Vertical sheets give the column as a number
+    cell = Cell('a', ('main', True), 27, 3, 'Heading')
+    assert cell.cell_location == ('main', '28', 3, 'Heading')
+
+    # Cells with the same value are kept when they're merged
+    base = {'id': Cell('1', ('main', False), 0, 2, 'id')}
+    sub_cell = Cell('1', ('sub', False), 0, 2, 'id')
+    merge(base, {'id': sub_cell})
+    assert base['id'].sub_cells == [sub_cell]
+
+
+def test_cell_location_given():
+    # A location can also be given whole, as cells used to be made
+    cell = Cell('a', ('main', 'AB', 3, 'Heading'))
+    assert cell.cell_location == ('main', 'AB', 3, 'Heading')
+    assert cell.sub_cells == []
+    sub_cell = Cell('a', ('sub', 'A', 2, 'Heading'))
+    cell.sub_cells.append(sub_cell)
+    assert cell.sub_cells == [sub_cell]
+
+    cell = Cell('a')
+    cell.cell_location = ('main', 'B', 4, 'Heading')
+    assert cell.cell_location == ('main', 'B', 4, 'Heading')
@@ -4,7 +4,8 @@ Tests of SpreadsheetInput class from input.py, and its chidlren.
 Tests of unflatten method are in test_input_SpreadsheetInput_unflatten.py
 """
 from __future__ import unicode_literals
-from flattentool.input import SpreadsheetInput, CSVInput, XLSXInput, convert_type
+from flattentool.input import SpreadsheetInput, CSVInput, XLSXInput, NativeXLSXInput, convert_type, get_converter
+from flattentool.xlsx_writer import XLSXWriter
 from decimal import Decimal
 from collections import OrderedDict
 import sys
@@ -12,6 +13,8 @@ import pytest
 import openpyxl
 import datetime
 import pytz
+import re
+import zipfile
 from six import text_type
 
 class ListInput(SpreadsheetInput):
@@ -50,8 +53,9 @@ class TestSuccessfulInput(object):
         assert list(csvinput.get_sheet_lines('subsheet')) == \
             [{'colC': 'cell5', 'colD': 'cell6'}, {'colC': 'cell7', 'colD': 'cell8'}]
 
-    def test_xlsx_input(self):
-        xlsxinput = XLSXInput(input_name='flattentool/tests/fixtures/xlsx/basic.xlsx')
+    @pytest.mark.parametrize('xlsx_input_class', [XLSXInput, NativeXLSXInput])
+    def test_xlsx_input(self, xlsx_input_class):
+        xlsxinput = xlsx_input_class(input_name='flattentool/tests/fixtures/xlsx/basic.xlsx')
 
         xlsxinput.read_sheets()
 
@@ -60,9 +64,11 @@ class TestSuccessfulInput(object):
             [{'colA': 'cell1', 'colB': 'cell2'}, {'colA': 'cell3', 'colB': 'cell4'}]
         assert list(xlsxinput.get_sheet_lines('subsheet')) == \
             [{'colC': 'cell5', 'colD': 'cell6'}, {'colC': 'cell7', 'colD': 'cell8'}]
+        xlsxinput.close()
 
-    def test_xlsx_vertical(self):
-        xlsxinput = XLSXInput(input_name='flattentool/tests/fixtures/xlsx/basic_transpose.xlsx', vertical_orientation=True)
+    @pytest.mark.parametrize('xlsx_input_class', [XLSXInput, NativeXLSXInput])
+    def test_xlsx_vertical(self, xlsx_input_class):
+        xlsxinput = xlsx_input_class(input_name='flattentool/tests/fixtures/xlsx/basic_transpose.xlsx', vertical_orientation=True)
 
         xlsxinput.read_sheets()
 
@@ -71,17 +77,20 @@ class TestSuccessfulInput(object):
             [{'colA': 'cell1', 'colB': 'cell2'}, {'colA': 'cell3', 'colB': 'cell4'}]
         assert list(xlsxinput.get_sheet_lines('subsheet')) == \
             [{'colC': 'cell5', 'colD': 'cell6'}, {'colC': 'cell7', 'colD': 'cell8'}]
+        xlsxinput.close()
 
-    def test_xlsx_include_ignore(self):
-        xlsxinput = XLSXInput(input_name='flattentool/tests/fixtures/xlsx/basic_meta.xlsx', 
+    @pytest.mark.parametrize('xlsx_input_class', [XLSXInput, NativeXLSXInput])
+    def test_xlsx_include_ignore(self, xlsx_input_class):
+        xlsxinput = xlsx_input_class(input_name='flattentool/tests/fixtures/xlsx/basic_meta.xlsx', 
                               include_sheets=['Meta'], vertical_orientation=True
                              )
         xlsxinput.read_sheets()
         assert xlsxinput.sub_sheet_names == ['Meta']
         assert list(xlsxinput.get_sheet_lines('Meta')) == \
             [{'a': 'a1', 'b': 'b1', 'c': 'c1'}]
+        xlsxinput.close()
 
-        xlsxinput = XLSXInput(input_name='flattentool/tests/fixtures/xlsx/basic_meta.xlsx', 
+        xlsxinput = xlsx_input_class(input_name='flattentool/tests/fixtures/xlsx/basic_meta.xlsx', 
                               exclude_sheets=['Meta'])
         xlsxinput.read_sheets()
 
@@ -90,21 +99,25 @@ class TestSuccessfulInput(object):
             [{'colA': 'cell1', 'colB': 'cell2'}, {'colA': 'cell3', 'colB': 'cell4'}]
         assert list(xlsxinput.get_sheet_lines('subsheet')) == \
             [{'colC': 'cell5', 'colD': 'cell6'}, {'colC': 'cell7', 'colD': 'cell8'}]
+        xlsxinput.close()
 
-    def test_xlsx_input_integer(self):
-        xlsxinput = XLSXInput(input_name='flattentool/tests/fixtures/xlsx/integer.xlsx')
+    @pytest.mark.parametrize('xlsx_input_class', [XLSXInput, NativeXLSXInput])
+    def test_xlsx_input_integer(self, xlsx_input_class):
+        xlsxinput = xlsx_input_class(input_name='flattentool/tests/fixtures/xlsx/integer.xlsx')
 
         xlsxinput.read_sheets()
 
         assert list(xlsxinput.get_sheet_lines('main')) == \
             [{'colA': 1}]
         assert xlsxinput.sub_sheet_names == ['main']
+        xlsxinput.close()
 
-    def test_xlsx_input_formula(self):
+    @pytest.mark.parametrize('xlsx_input_class', [XLSXInput, NativeXLSXInput])
+    def test_xlsx_input_formula(self, xlsx_input_class):
         """ When a forumla is present, we should use the value, rather than the
         formula itself. """
 
-        xlsxinput = XLSXInput(input_name='flattentool/tests/fixtures/xlsx/formula.xlsx')
+        xlsxinput = xlsx_input_class(input_name='flattentool/tests/fixtures/xlsx/formula.xlsx')
 
         xlsxinput.read_sheets()
 
@@ -113,6 +126,142 @@ class TestSuccessfulInput(object):
             [{'colA': 1, 'colB': 2}, {'colA': 2, 'colB': 4}]
         assert list(xlsxinput.get_sheet_lines('subsheet')) == \
             [{'colC': 3, 'colD': 9}, {'colC': 4, 'colD': 12}]
+        xlsxinput.close()
+
+    def test_xlsx_read_only(self):
+        xlsxinput = XLSXInput(input_name='flattentool/tests/fixtures/xlsx/basic.xlsx')
+
+        xlsxinput.read_sheets()
+
+        assert xlsxinput.workbook.read_only
+        lines = xlsxinput.get_sheet_lines('main')
+        assert next(lines) == {'colA': 'cell1', 'colB': 'cell2'}
+        assert xlsxinput.loaded_workbook is None
+
+        # The read-only workbook keeps the file open until it's closed, even
+        # though the sheet hasn't been read to the end
+        xlsx_file = xlsxinput.workbook._archive.fp
+        xlsxinput.close()
+        assert xlsx_file.closed
+        assert xlsxinput.workbook is None
+
+    @pytest.mark.parametrize('vertical_orientation', [False, True])
+    @pytest.mark.parametrize('xlsx_input_class', [XLSXInput, NativeXLSXInput])
+    def test_xlsx_wrong_dimension(self, tmpdir, xlsx_input_class, vertical_orientation):
+        # Some writers give a dimension that's smaller than the data
+        workbook = openpyxl.Workbook()
+        worksheet = workbook.active
+        worksheet.title = 'main'
+        rows = [['colA', 'colB'], ['cell1', 'cell2'], ['cell3', 'cell4']]
+        if vertical_orientation:
+            rows = [list(column) for column in zip(*rows)]
+        for row in rows:
+            worksheet.append(row)
+        workbook.save(tmpdir.join('saved.xlsx').strpath)
+        with zipfile.ZipFile(tmpdir.join('saved.xlsx').strpath) as saved_file:
+            with zipfile.ZipFile(tmpdir.join('dimension.xlsx').strpath, 'w') as xlsx_file:
+                for name in saved_file.namelist():
+                    data = saved_file.read(name)
+                    if name.startswith('xl/worksheets/'):
+                        data = re.sub(b'<dimension ref="[^"]*"', b'<dimension ref="A1"', data)
+                        assert b'<dimension ref="A1"' in data
+                    xlsx_file.writestr(name, data)
+        xlsxinput = xlsx_input_class(input_name=tmpdir.join('dimension.xlsx').strpath,
+                                     vertical_orientation=vertical_orientation)
+
+        xlsxinput.read_sheets()
+
+        assert xlsxinput.get_sheet_headings('main') == ['colA', 'colB']
+        assert list(xlsxinput.get_sheet_lines('main')) == \
+            [{'colA': 'cell1', 'colB': 'cell2'}, {'colA': 'cell3', 'colB': 'cell4'}]
+        xlsxinput.close()
+
+    def test_native_xlsx_cells_without_references(self, tmpdir):
+        xlsx_writer = XLSXWriter(tmpdir.join('written.xlsx').strpath)
+        xlsx_writer.write_sheet('main', [['colA', 'colB', None, None], ['cell1', 'cell2', 'cell3', 'cell4']])
+        xlsx_writer.close()
+        # Cell references are optional
+        with zipfile.ZipFile(tmpdir.join('written.xlsx').strpath) as written_file:
+            with zipfile.ZipFile(tmpdir.join('references.xlsx').strpath, 'w') as xlsx_file:
+                for name in written_file.namelist():
+                    data = written_file.read(name)
+                    if name.startswith('xl/worksheets/'):
+                        data = re.sub(b'<c r="[A-Z]+[0-9]+"', b'<c', data)
+                    xlsx_file.writestr(name, data)
+        xlsxinput = NativeXLSXInput(input_name=tmpdir.join('references.xlsx').strpath)
+
+        xlsxinput.read_sheets()
+
+        assert list(xlsxinput.workbook.iter_rows('main', max_column=3)) == [['colA', 'colB'], ['cell1', 'cell2', 'cell3']]
+        assert list(xlsxinput.get_sheet_lines('main')) == [{'colA': 'cell1', 'colB': 'cell2'}]
+        xlsxinput.close()
+
+    @pytest.mark.parametrize('xlsx_input_class', [XLSXInput, NativeXLSXInput])
+    def test_xlsx_inline_strings(self, tmpdir, xlsx_input_class):
+        xlsx_writer = XLSXWriter(tmpdir.join('inline.xlsx').strpath)
+        # Rows whose last cells are empty are shorter than the header
+        xlsx_writer.write_sheet('main', [['colA', 'colB'], ['cell1', 'cell2'], ['cell3', None], [1]])
+        xlsx_writer.close()
+        xlsxinput = xlsx_input_class(input_name=tmpdir.join('inline.xlsx').strpath)
+
+        xlsxinput.read_sheets()
+
+        assert xlsxinput.get_sheet_headings('main') == ['colA', 'colB']
+        assert list(xlsxinput.get_sheet_lines('main')) == \
+            [{'colA': 'cell1', 'colB': 'cell2'}, {'colA': 'cell3', 'colB': None}, {'colA': 1, 'colB': None}]
+        xlsxinput.close()
+
+    @pytest.mark.parametrize('xlsx_input_class', [XLSXInput, NativeXLSXInput])
+    @pytest.mark.parametrize('max_empty_rows,line_count', [(None, 3), (0, 1), (1, 3)])
+    def test_xlsx_empty_rows_and_columns(self, tmpdir, xlsx_input_class, max_empty_rows, line_count):
+        xlsx_writer = XLSXWriter(tmpdir.join('empty.xlsx').strpath)
+        xlsx_writer.write_sheet('main', [
+            ['colA', 'colB', None],
+            ['cell1', 'cell2'],
+            [],
+            ['cell3', None, 'no heading'],
+            [None, ''],
+            [],
+            [None, None, 'no heading'],
+        ])
+        xlsx_writer.close()
+        xlsxinput = xlsx_input_class(input_name=tmpdir.join('empty.xlsx').strpath, max_empty_rows=max_empty_rows)
+
+        xlsxinput.read_sheets()
+
+        # Empty rows are kept between rows with values, so that row numbers
+        # stay the same, but not after them
+        assert list(xlsxinput.get_sheet_lines('main')) == [
+            {'colA': 'cell1', 'colB': 'cell2'},
+            {'colA': None, 'colB': None},
+            {'colA': 'cell3', 'colB': None},
+        ][:line_count]
+        xlsxinput.close()
+
+    def test_native_xlsx_input_types(self, tmpdir):
+        workbook = openpyxl.Workbook()
+        worksheet = workbook.active
+        worksheet.title = 'main'
+        worksheet.append(['colA', 'colB', 'colC', 'colD', 'colE', 'colF'])
+        worksheet.append([datetime.datetime(2017, 3, 4, 12), datetime.date(2017, 3, 4), True, 1.5, 10, ' space '])
+        worksheet.append([None, None, False, -2e-20, None, 'x'])
+        workbook.save(tmpdir.join('types.xlsx').strpath)
+
+        lines = {}
+        for xlsx_input_class in [XLSXInput, NativeXLSXInput]:
+            xlsxinput = xlsx_input_class(input_name=tmpdir.join('types.xlsx').strpath)
+            xlsxinput.read_sheets()
+            lines[xlsx_input_class] = list(xlsxinput.get_sheet_lines('main'))
+            xlsxinput.close()
+        assert lines[NativeXLSXInput] == lines[XLSXInput]
+        assert lines[NativeXLSXInput][0] == OrderedDict([
+            ('colA', datetime.datetime(2017, 3, 4, 12)),
+            ('colB', datetime.datetime(2017, 3, 4)),
+            ('colC', True),
+            ('colD', 1.5),
+            ('colE', 10),
+            ('colF', ' space '),
+        ])
 
 
 class TestInputFailure(object):
@@ -174,6 +323,7 @@ class TestUnicodeInput(object):
 
         csvinput.read_sheets()
         assert list(csvinput.get_sheet_lines('main'))[0]['id'] == 'éαГ😼𝒞人'
+        csvinput.close()
 
 
 def test_convert_type(recwarn):
@@ -257,3 +407,27 @@ def test_convert_type(recwarn):
     assert convert_type('', datetime.datetime(2015, 6, 1, 13, 37, 59), timezone) == '2015-06-01T13:37:59+01:00'
 
     assert len(recwarn) == 0
+
+
+def test_get_converter(recwarn):
+    # Converters are made once for each type and timezone
+    timezone = pytz.timezone('Europe/London')
+    assert get_converter('number') is get_converter('number', timezone)
+    assert get_converter('string') is get_converter('string')
+    assert get_converter('string', timezone) is get_converter('string', timezone)
+    assert get_converter('string') is not get_converter('string', timezone)
+
+    assert get_converter('number')('1.2') == Decimal('1.2')
+    assert get_converter('integer')('3') == 3
+    assert get_converter('boolean')('TRUE') is True
+    assert get_converter('number_array')('1,2;3,4') == [[1, 2], [3, 4]]
+    assert get_converter('string_array')('one;two') == ['one', 'two']
+    assert get_converter('string', timezone)(datetime.datetime(2015, 6, 1)) == '2015-06-01T00:00:00+01:00'
+    assert get_converter('', timezone)(3) == 3
+    assert len(recwarn) == 0
+
+    # Unrecognised types are only an error once there's a value to convert
+    converter = get_converter('notatype')
+    with pytest.raises(ValueError) as e:
+        converter('test')
+    assert 'Unrecognised type: "notatype"' in text_type(e)
@@ -521,6 +521,129 @@ class TestUnflattenNoRootID(object):
             }
         ]
 
+    def test_memory_limit(self):
+        """
+        With a tiny memory limit, the objects being built are spilled to disk
+        after every row, but the result is the same.
+
+        """
+        sheets = OrderedDict([
+            ('custom_main', [
+                {'ocid': ocid, 'id': i, 'testA': 'a' * 50}
+                for ocid in range(5) for i in range(3)
+            ]),
+            ('sub', [
+                {'ocid': ocid, 'id': i, 'subField/0/testB': 'b' * 50}
+                for i in range(3) for ocid in range(5)
+            ]),
+        ])
+        spreadsheet_input = ListInput(sheets=sheets)
+        spreadsheet_input.read_sheets()
+        expected = list(spreadsheet_input.unflatten())
+        expected_source_maps = spreadsheet_input.fancy_unflatten(True, True)
+        assert len(expected) == 15
+        assert expected[1] == {'ocid': 0, 'id': 1, 'testA': 'a' * 50, 'subField': [{'testB': 'b' * 50}]}
+
+        spreadsheet_input = ListInput(sheets=sheets, memory_limit=0.0001)
+        spreadsheet_input.read_sheets()
+        assert list(spreadsheet_input.unflatten()) == expected
+        assert spreadsheet_input.fancy_unflatten(True, True) == expected_source_maps
+
+    @pytest.mark.parametrize('with_ids', [True, False])
+    def test_memory_limit_no_root_id(self, with_ids):
+        """
+        Without a root id, every object is under the same root id, but each
+        one is still spilled on its own, rather than all of them being loaded
+        back and spilled again after every row.
+
+        """
+        sheets = OrderedDict([
+            ('custom_main', [
+                {'id': i if with_ids else '', 'testA': 'a' * 50}
+                for i in range(500)
+            ]),
+        ])
+        spreadsheet_input = ListInput(sheets=sheets, root_id='')
+        spreadsheet_input.read_sheets()
+        expected = list(spreadsheet_input.unflatten())
+
+        spreadsheet_input = ListInput(sheets=sheets, root_id='', memory_limit=0.001)
+        spreadsheet_input.read_sheets()
+        spilled_items = spreadsheet_input.do_unflatten(with_locations=False)
+        connection = spilled_items.objects.connection
+        assert connection.execute('SELECT COUNT(*) FROM spilled').fetchone()[0] > 400
+        assert connection.execute('SELECT MAX(LENGTH(value)) FROM spilled').fetchone()[0] < 1000
+        assert list(spreadsheet_input.unflatten()) == expected
+
+    @pytest.mark.parametrize('root_id', ['ocid', ''])
+    def test_sorted_input(self, root_id):
+        """
+        Sheets sorted by root id (or id) give the same result when they're
+        unflattened a root id (or id) at a time.
+
+        """
+        key = root_id or 'id'
+        sheets = OrderedDict([
+            ('custom_main', [
+                {'ocid': i, 'id': i, 'testA': 'a'}
+                for i in range(5)
+            ]),
+            ('sub', [
+                {'ocid': i, 'id': i, 'subField/0/id': j, 'subField/0/testB': 'b'}
+                for i in range(1, 6) for j in range(2)
+            ]),
+        ])
+        spreadsheet_input = ListInput(sheets=sheets, root_id=root_id)
+        spreadsheet_input.read_sheets()
+        expected = list(spreadsheet_input.unflatten())
+        expected_source_maps = spreadsheet_input.fancy_unflatten(True, True)
+        assert len(expected) == 6
+        assert expected[5] == {'ocid': 5, 'id': 5, 'subField': [{'id': 0, 'testB': 'b'}, {'id': 1, 'testB': 'b'}]}
+
+        spreadsheet_input = ListInput(sheets=sheets, root_id=root_id, sorted_input=True)
+        spreadsheet_input.read_sheets()
+        unflattened = spreadsheet_input.unflatten()
+        assert next(unflattened) == expected[0]
+        assert list(unflattened) == expected[1:]
+        assert spreadsheet_input.fancy_unflatten(True, True) == expected_source_maps
+
+        sheets['sub'].reverse()
+        spreadsheet_input = ListInput(sheets=sheets, root_id=root_id, sorted_input=True)
+        spreadsheet_input.read_sheets()
+        with pytest.raises(ValueError) as e:
+            list(spreadsheet_input.unflatten())
+        assert 'Sheet "sub" is not sorted by {}: "4" comes after "5"'.format(key) in text_type(e.value)
+
+    @pytest.mark.parametrize('root_id', ['ocid', ''])
+    def test_external_sort(self, root_id):
+        """
+        Unsorted sheets give the same result, in the same order, when their
+        lines are sorted on disk and unflattened an object at a time.
+
+        """
+        sheets = OrderedDict([
+            ('custom_main', [
+                {'ocid': ocid, 'id': ocid * 10 + i, 'testA': 'a' * 50}
+                for ocid in [3, 1, 4, 0, 2] for i in range(2)
+            ] + [{'ocid': 1, 'testA': 'no id'}]),
+            ('sub', [
+                {'ocid': ocid, 'id': ocid * 10 + i, 'subField/0/testB': 'b' * 50}
+                for i in range(3) for ocid in [5, 2, 3, 0, 1]
+            ] + [{'ocid': 5, 'subField/0/testB': 'no id'}]),
+        ])
+        spreadsheet_input = ListInput(sheets=sheets, root_id=root_id)
+        spreadsheet_input.read_sheets()
+        expected = list(spreadsheet_input.unflatten())
+        expected_source_maps = spreadsheet_input.fancy_unflatten(True, True)
+        assert len(expected) == 19
+
+        # A tiny memory limit sorts every line in a run of its own
+        for memory_limit in [None, 0.0001]:
+            spreadsheet_input = ListInput(sheets=sheets, root_id=root_id, external_sort=True, memory_limit=memory_limit)
+            spreadsheet_input.read_sheets()
+            assert list(spreadsheet_input.unflatten()) == expected
+            assert spreadsheet_input.fancy_unflatten(True, True) == expected_source_maps
+
 
 from flattentool.schema import SchemaParser
 
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-from flattentool.json_input import JSONParser, BadlyFormedJSONError
+from flattentool.json_input import JSONParser, JSONStreamReader, BadlyFormedJSONError, sheet_key_title
+from flattentool.sheet import Sheet
 from flattentool.schema import SchemaParser
 import pytest
 from collections import OrderedDict
+from decimal import Decimal
 from six import text_type
 
 
@@ -139,6 +141,210 @@ def test_root_list_path():
     assert parser.sub_sheets == {}
 
 
+
+def test_jsonparser_stream_requires_filename():
+    with pytest.raises(ValueError):
+        JSONParser(root_json_dict={}, stream=True)
+
+
+def test_jsonparser_stream_bad_json(tmpdir):
+    test_json = tmpdir.join('test.json')
+    test_json.write('{"main": [{"a":"b"}, {"a":}]}')
+    # The file isn't read until parse() is called
+    parser = JSONParser(json_filename=test_json.strpath, root_list_path='main', stream=True)
+    with pytest.raises(BadlyFormedJSONError):
+        parser.parse()
+
+
+@pytest.mark.parametrize('root_list_path,json_text', [
+    ('main', '{"main": [{"a": "b", "c": 1.5}, {"a": "e", "c": [1, 2]}]}'),
+    ('x/main', ' { "other": {"main": [1]}, "x" : {"y": [], "main" : [ {"a": "b"} , {"a": {"c": "d"}} ] } } '),
+    ('main', '{"other": [{"a": "ignored"}], "main": []}'),
+    ('main', '{"other": [{"a": "ignored"}]}'),
+    ('main', '{}'),
+    (None, r'[{"a": "b"}, {"a": "\u00e9\"]"}]'),
+])
+def test_jsonparser_stream_matches_load(tmpdir, root_list_path, json_text):
+    test_json = tmpdir.join('test.json')
+    test_json.write(json_text)
+    parser = JSONParser(json_filename=test_json.strpath, root_list_path=root_list_path)
+    parser.parse()
+    stream_parser = JSONParser(json_filename=test_json.strpath, root_list_path=root_list_path, stream=True)
+    stream_parser.parse()
+    assert not hasattr(stream_parser, 'root_json_dict')
+    assert list(stream_parser.main_sheet) == list(parser.main_sheet)
+    assert stream_parser.main_sheet.lines == parser.main_sheet.lines
+    assert listify(stream_parser.sub_sheets) == listify(parser.sub_sheets)
+
+
+def test_json_stream_reader_small_chunks(tmpdir):
+    test_json = tmpdir.join('test.json')
+    test_json.write_text('{"a": "' + 'x'*100 + '", "main": [{"b": 12345, "c": "éαГ😼𝒞人"}, {"b": 1.25, "c": true}]}', encoding='utf-8')
+    with test_json.open(encoding='utf-8') as json_file:
+        items = list(JSONStreamReader(json_file, chunk_size=3).iter_list(['main']))
+    assert items == [
+        OrderedDict([('b', 12345), ('c', 'éαГ😼𝒞人')]),
+        OrderedDict([('b', Decimal('1.25')), ('c', True)]),
+    ]
+    assert type(items[1]['b']) == Decimal
+
+
+def test_json_stream_reader_split_numbers():
+    class SplitFile(object):
+        """
+        Gives the first ``split`` characters of ``text`` on the first read.
+
+        """
+        def __init__(self, text, split):
+            self.text = text
+            self.split = split
+            self.pos = 0
+
+        def read(self, size):
+            if self.pos == 0:
+                size = self.split
+            chunk = self.text[self.pos:self.pos+size]
+            self.pos += len(chunk)
+            return chunk
+
+    text = '{"version": 1.25, "count": 2e3, "main": [{"b": -1.5E+2}, 3.0], "d": 10}'
+    for split in range(1, len(text) + 1):
+        for chunk_size in [1, 2, 3, 5]:
+            items = list(JSONStreamReader(SplitFile(text, split), chunk_size=chunk_size).iter_list(['main']))
+            assert items == [OrderedDict([('b', Decimal('-1.5E+2'))]), Decimal('3.0')]
+
+
+def test_jsonparser_line_sinks():
+    class ListSink(object):
+        def __init__(self):
+            self.lines = []
+
+        def write_line(self, sheet, line):
+            self.lines.append((sheet.name, line))
+
+    parser = JSONParser(root_json_dict=[OrderedDict([
+        ('a', 'b'),
+        ('c', [OrderedDict([('d', 'e')])]),
+    ])])
+    sink = ListSink()
+    parser.line_sinks = [sink]
+    parser.parse()
+    assert sink.lines == [('c', {'c/0/d': 'e'}), (None, {'a': 'b'})]
+    assert parser.main_sheet.lines == []
+    assert parser.sub_sheets['c'].lines == []
+    assert list(parser.main_sheet) == ['a']
+
+
+def test_jsonparser_parse_columns():
+    parser = JSONParser(root_json_dict=[
+        OrderedDict([('a', 'b')]),
+        OrderedDict([('c', [OrderedDict([('d', 'e')])])]),
+    ])
+    parser.parse_columns()
+    assert list(parser.main_sheet) == ['a']
+    assert listify(parser.sub_sheets) == {'c': ['c/0/d']}
+    assert parser.main_sheet.lines == []
+    assert parser.sub_sheets['c'].lines == []
+    assert parser.line_sinks == []
+    # A second pass finds no new columns
+    parser.parse()
+    assert list(parser.main_sheet) == ['a']
+    assert parser.main_sheet.lines == [{'a': 'b'}, {}]
+    assert parser.sub_sheets['c'].lines == [{'c/0/d': 'e'}]
+
+
+def test_sheet_key_title():
+    sheet = Sheet()
+    sheet.titles['Title A'] = 'a'
+    assert sheet_key_title(sheet, 'a') == 'Title A'
+    assert list(sheet) == []
+    assert sheet_key_title(sheet, 'b') == 'b'
+    assert list(sheet) == ['b']
+    # Titles added later are found too
+    sheet.titles['Title C'] = 'c'
+    assert sheet_key_title(sheet, 'c') == 'Title C'
+    assert sheet_key_title(sheet, 'd', id_key='x') == 'd'
+    assert list(sheet) == ['b', 'd']
+
+
+@pytest.mark.parametrize('use_schema', [False, True])
+def test_jsonparser_parallel_matches_serial(use_schema):
+    def parse(workers):
+        if use_schema:
+            schema_parser = SchemaParser(schema_filename='flattentool/tests/fixtures/release-schema.json', rollup=True, root_id='ocid')
+            schema_parser.parse()
+        else:
+            schema_parser = None
+        parser = JSONParser(
+            json_filename='flattentool/tests/fixtures/tenders_releases_2_releases.json',
+            root_list_path='releases',
+            schema_parser=schema_parser,
+            workers=workers)
+        parser.parallel_chunk_size = 1
+        parser.parse()
+        return parser
+
+    serial_parser = parse(1)
+    parallel_parser = parse(2)
+    assert list(parallel_parser.main_sheet) == list(serial_parser.main_sheet)
+    assert parallel_parser.main_sheet.lines == serial_parser.main_sheet.lines
+    assert sorted(parallel_parser.sub_sheets) == sorted(serial_parser.sub_sheets)
+    for sheet_name, sheet in serial_parser.sub_sheets.items():
+        assert list(parallel_parser.sub_sheets[sheet_name]) == list(sheet)
+        assert parallel_parser.sub_sheets[sheet_name].lines == sheet.lines
+
+
+def test_jsonparser_memory_limit():
+    def parse(memory_limit):
+        parser = JSONParser(
+            json_filename='flattentool/tests/fixtures/tenders_releases_2_releases.json',
+            root_list_path='releases',
+            memory_limit=memory_limit)
+        parser.parse()
+        return parser
+
+    parser = parse(None)
+    # Small enough that the lines are spilled to disk after every line
+    spilled_parser = parse(0.0001)
+    assert spilled_parser.main_sheet.lines.spilled_count == len(parser.main_sheet.lines) == 2
+    assert spilled_parser.main_sheet.lines == parser.main_sheet.lines
+    assert spilled_parser.main_sheet.lines[1] == parser.main_sheet.lines[1]
+    for sheet_name, sheet in parser.sub_sheets.items():
+        assert spilled_parser.sub_sheets[sheet_name].lines == sheet.lines
+        assert list(spilled_parser.sub_sheets[sheet_name].lines.iter_rows(list(sheet))) == list(sheet.lines.iter_rows(list(sheet)))
+
+
+def test_jsonparser_parallel_warnings():
+    schema_parser = SchemaParser(root_schema_dict={'properties': {
+        'c': {'type': 'array', 'rollUp': ['d'], 'items': {'type': 'object', 'properties': {'d': {'type': 'string'}}}}
+    }}, rollup=True)
+    schema_parser.parse()
+    parser = JSONParser(root_json_dict=[
+        OrderedDict([('c', [OrderedDict([('d', 'e')]), OrderedDict([('d', 'f')])])]),
+    ], schema_parser=schema_parser, workers=2)
+    with pytest.warns(UserWarning, match='More than one value supplied for "c"'):
+        parser.parse()
+    assert parser.main_sheet.lines == [{'c/0/d': 'WARNING: More than one value supplied, consult the relevant sub-sheet for the data.'}]
+
+
+def test_jsonparser_json_lines(tmpdir):
+    test_jsonl = tmpdir.join('test.jsonl')
+    test_jsonl.write('{"a": "b", "c": 1.5}\n\n{"a": "d", "e": [{"f": "g"}]}\n')
+    parser = JSONParser(json_filename=test_jsonl.strpath, json_lines=True)
+    parser.parse()
+    assert list(parser.main_sheet) == ['a', 'c']
+    assert parser.main_sheet.lines == [{'a': 'b', 'c': Decimal('1.5')}, {'a': 'd'}]
+    assert parser.sub_sheets['e'].lines == [{'e/0/f': 'g'}]
+
+
+def test_jsonparser_json_lines_bad_line(tmpdir):
+    test_jsonl = tmpdir.join('test.jsonl')
+    test_jsonl.write('{"a": "b"}\n{"a": }\n')
+    parser = JSONParser(json_filename=test_jsonl.strpath, json_lines=True)
+    with pytest.raises(BadlyFormedJSONError) as excinfo:
+        parser.parse()
+    assert 'Line 2' in text_type(excinfo.value)
+
 class TestParseIDs(object):
     def test_parse_ids(self):
         parser = JSONParser(root_json_dict=[OrderedDict([
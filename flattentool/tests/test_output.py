@@ -4,6 +4,9 @@ import pytest
 import os
 from flattentool import output, schema
 from flattentool.sheet import Sheet
+from flattentool.xlsx_writer import XLSXWriter
+from flattentool.exceptions import DataErrorWarning
+from decimal import Decimal
 import openpyxl
 
 
@@ -157,3 +160,289 @@ def test_utf8(tmpdir):
     ])
     release_csv_text = tmpdir.join('release', 'release.csv').read_text(encoding='utf-8')
     assert release_csv_text.strip('\r\n').replace('\r', '') == 'é\néαГ😼𝒞人\ncell2'
+
+
+def test_streamed_lines_match_write_sheets(tmpdir):
+    """
+    Lines written with write_line as they're produced should give the same
+    output as write_sheets, even when columns are added to the sheets after
+    some lines have already been written.
+
+    """
+    def lines_and_columns():
+        yield 'main', 'a', {'a': 'cell1'}
+        yield 'b', 'c', {'c': 'cell3'}
+        yield 'main', 'e', {'a': 'cell2', 'e': 'cell5'}
+        yield 'b', 'd', {'c': 'cell4', 'd': 'new\r\nline'}
+
+    for streamed in [False, True]:
+        parser = MockParser([], {'b': []})
+        parser.sub_sheets['b'].root_id = 'ocid'
+        outputs = [
+            spreadsheet_output_class(
+                parser=parser,
+                main_sheet_name='release',
+                output_name=os.path.join(tmpdir.strpath, str(streamed)+'release'+output.FORMATS_SUFFIX[format_name]))
+            for format_name, spreadsheet_output_class in output.FORMATS.items()]
+        for sheet_name, column, line in lines_and_columns():
+            sheet = parser.main_sheet if sheet_name == 'main' else parser.sub_sheets[sheet_name]
+            sheet.append(column)
+            if sheet_name == 'b' and column == 'd':
+                # An id column turns up part way through, which goes before
+                # the existing columns
+                sheet.add_field('id', id_field=True)
+            if streamed:
+                for spreadsheet_output in outputs:
+                    spreadsheet_output.write_line(sheet, line)
+            else:
+                sheet.lines.append(line)
+        for spreadsheet_output in outputs:
+            if streamed:
+                spreadsheet_output.write_streamed_sheets()
+            else:
+                spreadsheet_output.write_sheets()
+
+    assert tmpdir.join('Truerelease', 'release.csv').read_binary() == tmpdir.join('Falserelease', 'release.csv').read_binary()
+    assert tmpdir.join('Truerelease', 'b.csv').read_binary() == tmpdir.join('Falserelease', 'b.csv').read_binary()
+    assert tmpdir.join('Truerelease', 'b.csv').read().replace('\r\n', '\n') == 'ocid,id,c,d\n,,cell3,\n,,cell4,"new\nline"\n'
+    assert set(tmpdir.join('Truerelease').listdir()) == set([
+        tmpdir.join('Truerelease').join('release.csv'),
+        tmpdir.join('Truerelease').join('b.csv')
+    ])
+
+    for sheet_name in ['release', 'b']:
+        wb_streamed = openpyxl.load_workbook(tmpdir.join('Truerelease.xlsx').strpath)
+        wb = openpyxl.load_workbook(tmpdir.join('Falserelease.xlsx').strpath)
+        assert wb_streamed.get_sheet_names() == wb.get_sheet_names() == ['release', 'b']
+        assert [[x.value for x in row] for row in wb_streamed[sheet_name].rows] == [[x.value for x in row] for row in wb[sheet_name].rows]
+
+
+def test_native_xlsx(tmpdir):
+    subsheet = Sheet(root_id='ocid')
+    subsheet.add_field('c')
+    parser = MockParser(['a', 'b'], {})
+    parser.main_sheet.lines = [
+        {'a': ' <tag> & space ', 'b': Decimal('1.5')},
+        {'a': True, 'b': 42},
+        {'b': 'é\x07'},
+    ]
+    subsheet.lines = [{'c': 'cell'}]
+    parser.sub_sheets['x & <y>'] = subsheet
+    spreadsheet_output = output.NativeXLSXOutput(
+        parser=parser,
+        main_sheet_name='release',
+        output_name=tmpdir.join('release.xlsx').strpath)
+    with pytest.warns(DataErrorWarning):
+        spreadsheet_output.write_sheets()
+
+    wb = openpyxl.load_workbook(tmpdir.join('release.xlsx').strpath)
+    assert wb.get_sheet_names() == ['release', 'x & <y>']
+    assert [[x.value for x in row] for row in wb['release'].rows] == [
+        ['a', 'b'],
+        [' <tag> & space ', 1.5],
+        [True, 42],
+        [None, 'é'],
+    ]
+    assert [[x.value for x in row] for row in wb['x & <y>'].rows] == [['ocid', 'c'], [None, 'cell']]
+
+
+@pytest.mark.parametrize('spreadsheet_output_class', [output.XLSXOutput, output.NativeXLSXOutput])
+def test_illegal_characters_warnings(tmpdir, recwarn, spreadsheet_output_class):
+    parser = MockParser(['a', 'b', 'c'], {})
+    parser.main_sheet.lines = [
+        {'a': 'cell{}\x07'.format(i), 'b': 'tab\tnewline\n', 'c': 'x\x00' if i == 3 else 'y'}
+        for i in range(10)]
+    spreadsheet_output_class(
+        parser=parser,
+        main_sheet_name='release',
+        output_name=tmpdir.join('release.xlsx').strpath).write_sheets()
+
+    # One warning per column, rather than per cell
+    assert [str(w.message) for w in recwarn if w.category is DataErrorWarning] == [
+        'Character(s) in 10 cell(s) of column "a" in sheet "release" are not allowed in a spreadsheet cell. Those character(s) will be removed. First found in A2, A3, A4.',
+        'Character(s) in 1 cell(s) of column "c" in sheet "release" are not allowed in a spreadsheet cell. Those character(s) will be removed. First found in C5.',
+    ]
+    wb = openpyxl.load_workbook(tmpdir.join('release.xlsx').strpath)
+    assert [x.value for x in wb['release'].rows[4]] == ['cell3', 'tab\tnewline\n', 'x']
+
+
+@pytest.mark.parametrize('spreadsheet_output_class', [output.XLSXOutput, output.NativeXLSXOutput])
+@pytest.mark.parametrize('sheet_name,message', [
+    ('a/b', 'Invalid character / found in sheet title'),
+    ('[a]', 'Invalid character [ found in sheet title'),
+    ('x' * 32, 'Maximum 31 characters allowed in sheet title'),
+])
+def test_invalid_sheet_titles(tmpdir, spreadsheet_output_class, sheet_name, message):
+    parser = MockParser(['a'], {})
+    parser.main_sheet.lines = [{'a': 'cell'}]
+    with pytest.raises(ValueError) as excinfo:
+        spreadsheet_output_class(
+            parser=parser,
+            main_sheet_name=sheet_name,
+            output_name=tmpdir.join('release.xlsx').strpath).write_sheets()
+    assert str(excinfo.value) == message
+
+
+def test_native_xlsx_duplicate_sheet_titles(tmpdir):
+    xlsx_writer = XLSXWriter(tmpdir.join('release.xlsx').strpath)
+    for sheet_name in ['main', 'main', 'main', 'x' * 31]:
+        xlsx_writer.write_sheet(sheet_name, [['a']])
+    for sheet_name in ['', 'x' * 31]:
+        with pytest.raises(ValueError):
+            xlsx_writer.add_sheet(sheet_name)
+    xlsx_writer.close()
+    wb = openpyxl.load_workbook(tmpdir.join('release.xlsx').strpath)
+    assert wb.get_sheet_names() == ['main', 'main1', 'main2', 'x' * 31]
+
+
+class Unwritable(object):
+    def __str__(self):
+        raise RuntimeError('unwritable')
+
+    __unicode__ = __str__
+
+
+@pytest.mark.parametrize('streamed', [False, True])
+def test_native_xlsx_failed_write_cleans_up(tmpdir, streamed):
+    parser = MockParser(['a'], {})
+    spreadsheet_output = output.NativeXLSXOutput(
+        parser=parser,
+        main_sheet_name='release',
+        output_name=tmpdir.join('release.xlsx').strpath)
+    with pytest.raises(RuntimeError):
+        if streamed:
+            spreadsheet_output.write_line(parser.main_sheet, {'a': Unwritable()})
+            spreadsheet_output.write_streamed_sheets()
+        else:
+            parser.main_sheet.lines = [{'a': Unwritable()}]
+            spreadsheet_output.write_sheets()
+    assert not os.path.exists(spreadsheet_output.workbook.part_directory)
+    assert not tmpdir.join('release.xlsx').exists()
+
+
+def test_csv_failed_streamed_write_cleans_up(tmpdir, monkeypatch):
+    parser = MockParser(['a'], {'b': ['c']})
+    spreadsheet_output = output.CSVOutput(
+        parser=parser,
+        main_sheet_name='release',
+        output_name=tmpdir.join('release').strpath)
+    spreadsheet_output.write_line(parser.main_sheet, {'a': 'cell1'})
+    spreadsheet_output.write_line(parser.sub_sheets['b'], {'c': 'cell2'})
+    csv_files = [stream['file'] for stream in spreadsheet_output.streamed_lines.values()]
+    # A column added after the lines were written means the file is rewritten
+    parser.main_sheet.add_field('d')
+
+    def rewrite_sheet_file(*args):
+        raise RuntimeError('rewrite failed')
+    monkeypatch.setattr(spreadsheet_output, 'rewrite_sheet_file', rewrite_sheet_file)
+    with pytest.raises(RuntimeError):
+        spreadsheet_output.write_streamed_sheets()
+
+    assert [csv_file.closed for csv_file in csv_files] == [True, True]
+    assert spreadsheet_output.streamed_lines == {}
+
+
+def test_failed_streamed_write_closes_spools(tmpdir):
+    parser = MockParser(['a'], {'b': ['c']})
+    spreadsheet_output = output.NativeXLSXOutput(
+        parser=parser,
+        main_sheet_name='release',
+        output_name=tmpdir.join('release.xlsx').strpath)
+    spreadsheet_output.write_line(parser.main_sheet, {'a': Unwritable()})
+    spreadsheet_output.write_line(parser.sub_sheets['b'], {'c': 'cell'})
+    spools = list(spreadsheet_output.streamed_lines.values())
+    with pytest.raises(RuntimeError):
+        spreadsheet_output.write_streamed_sheets()
+    assert [spool.file.closed for spool in spools] == [True, True]
+    assert spreadsheet_output.streamed_lines == {}
+
+
+@pytest.mark.parametrize('threads', [False, True])
+def test_fan_out(tmpdir, threads):
+    subsheet = Sheet(root_id='ocid')
+    subsheet.add_field('c')
+    parser = MockParser(['a', 'b'], {})
+    parser.main_sheet.lines = [{'a': 'cell{}'.format(i), 'b': 'bell\x07'} for i in range(2500)]
+    subsheet.lines = [{'c': 'cell'}]
+    parser.sub_sheets['b'] = subsheet
+
+    def outputs(prefix):
+        return [
+            spreadsheet_output_class(
+                parser=parser,
+                main_sheet_name='release',
+                output_name=tmpdir.join(prefix+'release'+output.FORMATS_SUFFIX[format_name]).strpath)
+            for format_name, spreadsheet_output_class in sorted(output.FORMATS.items())
+            if format_name != 'xlsx-native']
+
+    for spreadsheet_output in outputs('separate'):
+        spreadsheet_output.write_sheets()
+    output.FanOutOutput(outputs('fanout'), threads=threads).write_sheets()
+
+    for sheet_name in ['release', 'b']:
+        assert tmpdir.join('fanoutrelease', sheet_name+'.csv').read_binary() == tmpdir.join('separaterelease', sheet_name+'.csv').read_binary()
+    # Characters are only removed for the XLSX output
+    assert tmpdir.join('fanoutrelease', 'release.csv').read().splitlines()[1] == 'cell0,bell\x07'
+    wb_fanout = openpyxl.load_workbook(tmpdir.join('fanoutrelease.xlsx').strpath)
+    wb = openpyxl.load_workbook(tmpdir.join('separaterelease.xlsx').strpath)
+    assert wb_fanout.get_sheet_names() == wb.get_sheet_names() == ['release', 'b']
+    for sheet_name in ['release', 'b']:
+        assert [[x.value for x in row] for row in wb_fanout[sheet_name].rows] == [[x.value for x in row] for row in wb[sheet_name].rows]
+    assert wb_fanout['release'].rows[1][1].value == 'bell'
+
+
+def test_fan_out_threads_error():
+    class FailingSheetWriter(object):
+        def write_rows(self, rows):
+            raise ValueError('write failed')
+
+    class FailingOutput(output.SpreadsheetOutput):
+        def open_sheet(self, sheet_name, sheet):
+            return FailingSheetWriter()
+
+    parser = MockParser(['a'], {})
+    parser.main_sheet.lines = [{'a': 'cell'}]
+    # An error in a writer's thread is raised in the main thread
+    with pytest.raises(ValueError):
+        output.FanOutOutput([FailingOutput(parser=parser)], threads=True).write_sheets()
+
+
+@pytest.mark.parametrize('format_name', ['csv', 'xlsx-native'])
+@pytest.mark.parametrize('forks', [True, False])
+def test_parallel_sheets(tmpdir, recwarn, monkeypatch, format_name, forks):
+    if not forks:
+        # Send the sheets to the workers, as when they aren't forked
+        monkeypatch.setattr(output, 'start_method_forks', lambda: False)
+
+    def write_sheets(workers):
+        parser = MockParser(['a'], {})
+        parser.main_sheet.lines = [{'a': 'main\x07'}]
+        for i in range(10):
+            subsheet = Sheet(root_id='ocid')
+            subsheet.add_field('c')
+            subsheet.lines = [{'ocid': str(i), 'c': 'cell{}\x07'.format(j)} for j in range(i)]
+            parser.sub_sheets['sub{}'.format(i)] = subsheet
+        output.FORMATS[format_name](
+            parser=parser,
+            main_sheet_name='release',
+            output_name=tmpdir.join(str(workers)+'release'+output.FORMATS_SUFFIX[format_name]).strpath,
+            workers=workers).write_sheets()
+        return [str(w.message) for w in recwarn if w.category is DataErrorWarning]
+
+    warnings_one = write_sheets(1)
+    recwarn.clear()
+    warnings_parallel = write_sheets(4)
+    # Warnings are raised in the order of the sheets
+    assert warnings_parallel == warnings_one
+    assert len(warnings_parallel) == (10 if format_name == 'xlsx-native' else 0)
+
+    if format_name == 'csv':
+        assert len(tmpdir.join('4release').listdir()) == 11
+        for path in tmpdir.join('1release').listdir():
+            assert tmpdir.join('4release', path.basename).read_binary() == path.read_binary()
+    else:
+        wb_parallel = openpyxl.load_workbook(tmpdir.join('4release.xlsx').strpath)
+        wb = openpyxl.load_workbook(tmpdir.join('1release.xlsx').strpath)
+        assert wb_parallel.get_sheet_names() == wb.get_sheet_names() == ['release'] + sorted('sub{}'.format(i) for i in range(10))
+        for sheet_name in wb.get_sheet_names():
+            assert [[x.value for x in row] for row in wb_parallel[sheet_name].rows] == [[x.value for x in row] for row in wb[sheet_name].rows]
@@ -4,21 +4,24 @@ import pytest
 import sys
 
 
-@pytest.mark.parametrize('output_format', ['xlsx', 'csv'])
-def test_roundtrip(tmpdir, output_format):
+@pytest.mark.parametrize('stream,two_pass', [(False, False), (True, False), (True, True)])
+@pytest.mark.parametrize('output_format,input_format', [('xlsx', 'xlsx'), ('csv', 'csv'), ('xlsx-native', 'xlsx'), ('xlsx', 'xlsx-native'), ('xlsx-native', 'xlsx-native')])
+def test_roundtrip(tmpdir, output_format, input_format, stream, two_pass):
     input_name = 'flattentool/tests/fixtures/tenders_releases_2_releases.json'
     base_name = 'flattentool/tests/fixtures/tenders_releases_base.json'
     flatten(
         input_name=input_name,
-        output_name=tmpdir.join('flattened').strpath+'.'+output_format,
+        output_name=tmpdir.join('flattened').strpath+'.'+input_format,
         output_format=output_format,
         schema='flattentool/tests/fixtures/release-schema.json',
         root_list_path='releases',
-        main_sheet_name='releases')
+        main_sheet_name='releases',
+        stream=stream,
+        two_pass=two_pass)
     unflatten(
-        input_name=tmpdir.join('flattened').strpath+'.'+output_format,
+        input_name=tmpdir.join('flattened').strpath+'.'+input_format,
         output_name=tmpdir.join('roundtrip.json').strpath,
-        input_format=output_format,
+        input_format=input_format,
         base_json=base_name,
         schema='flattentool/tests/fixtures/release-schema.json',
         root_list_path='releases')
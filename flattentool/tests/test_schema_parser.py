@@ -2,7 +2,7 @@ import pytest
 from collections import OrderedDict
 from six import text_type
 from flattentool.schema import SchemaParser, get_property_type_set
-from flattentool.sheet import Sheet
+from flattentool.sheet import Sheet, SheetLines, Titles
 
 
 type_string = {'type': 'string'}
@@ -22,6 +22,66 @@ def test_sub_sheet_list_like():
     # but with the option to add an id_field, which appears at the start of the list
     sub_sheet.add_field('d', id_field=True)
     assert list(sub_sheet) == ['d', 'a', 'b', 'c']
+    # Adding a field that's already there does nothing
+    sub_sheet.add_field('a')
+    sub_sheet.add_field('d', id_field=True)
+    assert list(sub_sheet) == ['d', 'a', 'b', 'c']
+
+
+def test_sub_sheet_contains():
+    sub_sheet = Sheet(columns=['a'], root_id='ocid')
+    sub_sheet.add_field('b')
+    sub_sheet.add_field('c', id_field=True)
+    for field in ['ocid', 'a', 'b', 'c']:
+        assert field in sub_sheet
+    assert 'd' not in sub_sheet
+    assert '' not in Sheet()
+
+
+def test_sheet_titles_inverse():
+    sheet = Sheet()
+    assert sheet.titles.inverse == {}
+    sheet.titles['a'] = 'A'
+    sheet.titles['b'] = 'B'
+    assert sheet.titles.inverse == {'A': 'a', 'B': 'b'}
+    # Later keys win, as with a dict comprehension
+    sheet.titles['c'] = 'A'
+    assert sheet.titles.inverse == {'A': 'c', 'B': 'b'}
+    sheet.titles['c'] = 'C'
+    assert sheet.titles.inverse == {'A': 'a', 'B': 'b', 'C': 'c'}
+    del sheet.titles['a']
+    sheet.titles.update({'d': 'D'})
+    assert sheet.titles.inverse == {'B': 'b', 'C': 'c', 'D': 'd'}
+    sheet.titles = {'e': 'E'}
+    assert isinstance(sheet.titles, Titles)
+    assert sheet.titles.inverse == {'E': 'e'}
+
+
+def test_sheet_lines():
+    sheet = Sheet()
+    assert sheet.lines == []
+    sheet.lines.append({'a': 1, 'b': 'x'})
+    sheet.lines.append({'c': None})
+    sheet.lines.append({'b': 'y', 'a': 2})
+    assert sheet.lines == [{'a': 1, 'b': 'x'}, {'c': None}, {'a': 2, 'b': 'y'}]
+    assert sheet.lines[2] == {'a': 2, 'b': 'y'}
+    assert len(sheet.lines) == 3
+    # Column names and layouts are only stored once
+    assert sheet.lines.columns == ['a', 'b', 'c']
+    assert len(sheet.lines.layouts) == 3
+    sheet.lines.append({'a': 3, 'b': 'z'})
+    assert len(sheet.lines.layouts) == 3
+    assert list(sheet.lines.iter_rows(['b', 'c', 'a', 'd'])) == [
+        ['x', None, 1, None],
+        [None, None, None, None],
+        ['y', None, 2, None],
+        ['z', None, 3, None],
+    ]
+    assert list(sheet.lines.iter_rows(['a'])) == [[1], [None], [2], [3]]
+    sheet.lines = [{'d': 'e'}]
+    assert isinstance(sheet.lines, SheetLines)
+    assert sheet.lines == [{'d': 'e'}]
+    assert sheet.lines != [{'d': 'f'}]
 
 
 def test_get_property_type_set():
@@ -0,0 +1,229 @@
+"""
+A minimal XLSX reader, for reading the values of large sheets faster than
+openpyxl can.
+
+Only what's needed to get the value of each cell is read: the list of sheets,
+the shared strings, and which cell styles have date formats. Each worksheet
+is parsed with ``iterparse`` as its rows are iterated over, and each row is
+given as a list of values, so nothing but the shared strings and the current
+row is kept in memory.
+
+"""
+from __future__ import unicode_literals
+import posixpath
+import zipfile
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel
+from flattentool.xlsx_writer import PACKAGE_RELATIONSHIPS_NS, RELATIONSHIPS_NS, SPREADSHEETML_NS
+
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:  # Python 3.9+, where ElementTree is always the C version
+    from xml.etree.ElementTree import iterparse
+
+
+def tag(name, namespace=SPREADSHEETML_NS):
+    return '{' + namespace + '}' + name
+
+
+SHEET_TAG = tag('sheet')
+WORKBOOK_PR_TAG = tag('workbookPr')
+RELATIONSHIP_TAG = tag('Relationship', PACKAGE_RELATIONSHIPS_NS)
+RELATIONSHIP_ID_ATTRIBUTE = tag('id', RELATIONSHIPS_NS)
+SHARED_STRING_TAG = tag('si')
+TEXT_TAG = tag('t')
+PHONETIC_TAG = tag('rPh')
+NUMBER_FORMAT_TAG = tag('numFmt')
+CELL_XFS_TAG = tag('cellXfs')
+XF_TAG = tag('xf')
+SHEET_DATA_TAG = tag('sheetData')
+ROW_TAG = tag('row')
+CELL_TAG = tag('c')
+VALUE_TAG = tag('v')
+INLINE_STRING_TAG = tag('is')
+
+TRUE_VALUES = ('1', 'true')
+
+
+def cast_number(value):
+    """
+    Convert a number from a cell to an int or float, as openpyxl does.
+
+    """
+    if '.' in value or 'E' in value or 'e' in value:
+        return float(value)
+    return int(value)
+
+
+def column_number(column_letters):
+    """
+    Return the (zero based) column number of a column's letters, e.g. 27 for
+    "AB".
+
+    """
+    number = 0
+    for character in column_letters:
+        number = number * 26 + ord(character) - 64
+    return number - 1
+
+
+def string_text(element):
+    """
+    Return the text of a shared or inline string, which may be split into
+    runs. Phonetic hints aren't part of the text.
+
+    """
+    text = element.findtext(TEXT_TAG)
+    if text is not None:
+        return text
+    return ''.join(
+        run.findtext(TEXT_TAG) or ''
+        for run in element
+        if run.tag != PHONETIC_TAG)
+
+
+class XLSXReader(object):
+    """
+    Reads the values of the sheets of the XLSX file ``file_name``.
+
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with zipfile.ZipFile(file_name) as xlsx_file:
+            names = set(xlsx_file.namelist())
+            relationships = self.read_relationships(xlsx_file, 'xl/_rels/workbook.xml.rels')
+            self.base_date = CALENDAR_WINDOWS_1900
+            # The name of each sheet, in order, and the path of its part
+            self.sheet_paths = []
+            for _, element in iterparse(xlsx_file.open('xl/workbook.xml')):
+                if element.tag == WORKBOOK_PR_TAG and element.get('date1904') in TRUE_VALUES:
+                    self.base_date = CALENDAR_MAC_1904
+                elif element.tag == SHEET_TAG:
+                    path = self.part_path(relationships[element.get(RELATIONSHIP_ID_ATTRIBUTE)][1])
+                    if path in names:
+                        self.sheet_paths.append((element.get('name'), path))
+            self.sheet_names = [sheet_name for sheet_name, _ in self.sheet_paths]
+            self.shared_strings = []
+            self.date_styles = set()
+            for relationship_type, target in relationships.values():
+                path = self.part_path(target)
+                if path not in names:
+                    continue
+                if relationship_type.endswith('/sharedStrings'):
+                    self.shared_strings = self.read_shared_strings(xlsx_file.open(path))
+                elif relationship_type.endswith('/styles'):
+                    self.date_styles = self.read_date_styles(xlsx_file.open(path))
+
+    @staticmethod
+    def part_path(target):
+        if target.startswith('/'):
+            return target[1:]
+        return posixpath.normpath(posixpath.join('xl', target))
+
+    @staticmethod
+    def read_relationships(xlsx_file, path):
+        """
+        Return a dict of the type and target of each relationship, by id.
+
+        """
+        return dict(
+            (element.get('Id'), (element.get('Type'), element.get('Target')))
+            for _, element in iterparse(xlsx_file.open(path))
+            if element.tag == RELATIONSHIP_TAG)
+
+    @staticmethod
+    def read_shared_strings(strings_file):
+        shared_strings = []
+        for _, element in iterparse(strings_file):
+            if element.tag == SHARED_STRING_TAG:
+                shared_strings.append(string_text(element))
+                element.clear()
+        return shared_strings
+
+    @staticmethod
+    def read_date_styles(styles_file):
+        """
+        Return the set of the numbers of the cell styles that have a date
+        format, so that numbers in those cells can be read as dates.
+
+        """
+        number_formats = dict(BUILTIN_FORMATS)
+        date_styles = set()
+        for _, element in iterparse(styles_file):
+            if element.tag == NUMBER_FORMAT_TAG:
+                number_formats[int(element.get('numFmtId'))] = element.get('formatCode')
+            elif element.tag == CELL_XFS_TAG:
+                for i, xf in enumerate(element.iter(XF_TAG)):
+                    number_format = number_formats.get(int(xf.get('numFmtId', 0)))
+                    if number_format and is_date_format(number_format):
+                        date_styles.add(str(i))
+        return date_styles
+
+    def cell_value(self, cell):
+        cell_type = cell.get('t', 'n')
+        if cell_type == 'inlineStr':
+            inline_string = cell.find(INLINE_STRING_TAG)
+            return None if inline_string is None else string_text(inline_string)
+        value = cell.findtext(VALUE_TAG)
+        if not value:
+            return None
+        if cell_type == 'n':
+            value = cast_number(value)
+            if cell.get('s') in self.date_styles:
+                return from_excel(value, self.base_date)
+            return value
+        elif cell_type == 's':
+            return self.shared_strings[int(value)]
+        elif cell_type == 'b':
+            return value in TRUE_VALUES
+        # Formula strings ('str'), errors ('e') and ISO 8601 dates ('d')
+        return value
+
+    def iter_rows(self, sheet_name, max_column=None):
+        """
+        Yield a list of the values in each row of ``sheet_name``, with None
+        for empty cells. Rows end at their last cell with a value, or after
+        ``max_column`` values, and rows with no cells at all are empty lists.
+
+        """
+        path = dict(self.sheet_paths)[sheet_name]
+        with zipfile.ZipFile(self.file_name) as xlsx_file:
+            sheet_data = None
+            row_count = 0
+            # The column number for the letters of each cell reference
+            column_numbers = {}
+            for event, element in iterparse(xlsx_file.open(path), events=('start', 'end')):
+                if event == 'start':
+                    if element.tag == SHEET_DATA_TAG:
+                        sheet_data = element
+                    continue
+                if element.tag != ROW_TAG:
+                    continue
+                row_number = element.get('r')
+                row_number = int(row_number) if row_number else row_count + 1
+                # Rows that have no cells may have been left out altogether
+                while row_count + 1 < row_number:
+                    row_count += 1
+                    yield []
+                row_count = row_number
+                row = []
+                for cell in element.iter(CELL_TAG):
+                    reference = cell.get('r')
+                    if reference:
+                        column_letters = reference.rstrip('0123456789')
+                        column = column_numbers.get(column_letters)
+                        if column is None:
+                            column = column_numbers[column_letters] = column_number(column_letters)
+                        if max_column is not None and column >= max_column:
+                            break
+                        if column > len(row):
+                            row.extend([None] * (column - len(row)))
+                    # Cells without a reference just follow the one before
+                    if max_column is not None and len(row) >= max_column:
+                        break
+                    row.append(self.cell_value(cell))
+                yield row
+                # Rows that have been read aren't needed any more
+                if sheet_data is not None:
+                    sheet_data.clear()
@@ -0,0 +1,233 @@
+"""
+A minimal XLSX writer, for writing large flattened sheets faster than
+openpyxl can.
+
+Each worksheet is written to its own part file as its rows are given, with
+strings written inline, so nothing but the current row is kept in memory.
+``write_worksheet`` only needs the name of the part file and the rows, so the
+parts can be written independently of each other (e.g. by separate worker
+processes). The parts are assembled into the final zip file by ``close``.
+
+"""
+from __future__ import unicode_literals
+import io
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from decimal import Decimal
+from xml.sax.saxutils import escape, quoteattr
+from openpyxl.utils import get_column_letter
+from six import integer_types, text_type
+
+INFINITY = float('inf')
+
+# Characters that openpyxl (and Excel) don't allow in sheet titles
+INVALID_TITLE_RE = re.compile(r'[\\*?:/\[\]]')
+MAX_TITLE_LENGTH = 31
+
+SPREADSHEETML_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+RELATIONSHIPS_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PACKAGE_RELATIONSHIPS_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+CONTENT_TYPES_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+)
+CONTENT_TYPES_WORKSHEET = (
+    '<Override PartName="/xl/worksheets/sheet{}.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+)
+
+ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="' + PACKAGE_RELATIONSHIPS_NS + '">'
+    '<Relationship Id="rId1" Type="' + RELATIONSHIPS_NS + '/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+# Excel needs a styles part, even though every cell uses the default style
+STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="' + SPREADSHEETML_NS + '">'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+WORKSHEET_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="' + SPREADSHEETML_NS + '"><sheetData>'
+)
+WORKSHEET_END = '</sheetData></worksheet>'
+
+
+def cell_xml(reference, value):
+    """
+    Return the XML for a single cell. Strings are expected to have already
+    had any characters that aren't allowed in a spreadsheet removed.
+
+    """
+    if isinstance(value, bool):
+        return '<c r="{}" t="b"><v>{}</v></c>'.format(reference, int(value))
+    elif isinstance(value, integer_types + (Decimal,)) and value == value and abs(value) != INFINITY:
+        return '<c r="{}"><v>{}</v></c>'.format(reference, value)
+    elif isinstance(value, float) and value == value and abs(value) != INFINITY:
+        return '<c r="{}"><v>{}</v></c>'.format(reference, repr(value))
+    else:
+        # This includes NaN and infinity, which can't be stored as numbers
+        value = text_type(value)
+        if value != value.strip():
+            return '<c r="{}" t="inlineStr"><is><t xml:space="preserve">{}</t></is></c>'.format(reference, escape(value))
+        return '<c r="{}" t="inlineStr"><is><t>{}</t></is></c>'.format(reference, escape(value))
+
+
+class WorksheetWriter(object):
+    """
+    Writes a worksheet part, a row at a time. Values that are None are left
+    out.
+
+    """
+
+    def __init__(self, part_file_name):
+        self.part_file = io.open(part_file_name, 'w', encoding='utf-8')
+        self.part_file.write(WORKSHEET_START)
+        self.column_letters = []
+        self.row_count = 0
+
+    def write_row(self, row):
+        column_letters = self.column_letters
+        while len(column_letters) < len(row):
+            column_letters.append(get_column_letter(len(column_letters) + 1))
+        self.row_count += 1
+        row_number = text_type(self.row_count)
+        self.part_file.write('<row r="{}">'.format(row_number))
+        self.part_file.write(''.join(
+            cell_xml(column_letter + row_number, value)
+            for column_letter, value in zip(column_letters, row)
+            if value is not None))
+        self.part_file.write('</row>')
+
+    def close(self):
+        self.part_file.write(WORKSHEET_END)
+        self.part_file.close()
+
+
+def write_worksheet(part_file_name, rows):
+    """
+    Write a worksheet part, with a row for each list of values in ``rows``.
+
+    """
+    worksheet_writer = WorksheetWriter(part_file_name)
+    for row in rows:
+        worksheet_writer.write_row(row)
+    worksheet_writer.close()
+
+
+class XLSXWriter(object):
+    """
+    Writes an XLSX file to ``file_name``, with the worksheets in the order
+    they're added.
+
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.sheet_names = []
+        self.part_directory = tempfile.mkdtemp()
+
+    def add_sheet(self, sheet_name):
+        """
+        Add a worksheet, and return the name of the file to write its part
+        to, e.g. with ``write_worksheet``.
+
+        The title is checked, and a duplicate renamed, the same way that
+        openpyxl does, raising ValueError if it isn't allowed.
+
+        """
+        self.sheet_names.append(self.check_title(sheet_name))
+        return os.path.join(self.part_directory, 'sheet{}.xml'.format(len(self.sheet_names)))
+
+    def check_title(self, sheet_name):
+        if not sheet_name:
+            raise ValueError('Title must have at least one character')
+        match = INVALID_TITLE_RE.search(sheet_name)
+        if match:
+            raise ValueError('Invalid character {} found in sheet title'.format(match.group(0)))
+        if sheet_name in self.sheet_names:
+            # Add the next number after any already added to this title
+            counts = [
+                int(name[len(sheet_name):]) for name in self.sheet_names
+                if name.startswith(sheet_name) and name[len(sheet_name):].isdigit()]
+            sheet_name = '{}{}'.format(sheet_name, max(counts or [0]) + 1)
+        if len(sheet_name) > MAX_TITLE_LENGTH:
+            raise ValueError('Maximum {} characters allowed in sheet title'.format(MAX_TITLE_LENGTH))
+        return sheet_name
+
+    def write_sheet(self, sheet_name, rows):
+        write_worksheet(self.add_sheet(sheet_name), rows)
+
+    def workbook_xml(self):
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="' + SPREADSHEETML_NS + '" xmlns:r="' + RELATIONSHIPS_NS + '"><sheets>' +
+            ''.join(
+                '<sheet name={} sheetId="{}" r:id="rId{}"/>'.format(quoteattr(sheet_name), i, i)
+                for i, sheet_name in enumerate(self.sheet_names, 1)) +
+            '</sheets></workbook>'
+        )
+
+    def workbook_rels_xml(self):
+        sheet_count = len(self.sheet_names)
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="' + PACKAGE_RELATIONSHIPS_NS + '">' +
+            ''.join(
+                '<Relationship Id="rId{}" Type="{}/worksheet" Target="worksheets/sheet{}.xml"/>'.format(i, RELATIONSHIPS_NS, i)
+                for i in range(1, sheet_count + 1)) +
+            '<Relationship Id="rId{}" Type="{}/styles" Target="styles.xml"/>'.format(sheet_count + 1, RELATIONSHIPS_NS) +
+            '</Relationships>'
+        )
+
+    def content_types_xml(self):
+        return (
+            CONTENT_TYPES_START +
+            ''.join(CONTENT_TYPES_WORKSHEET.format(i) for i in range(1, len(self.sheet_names) + 1)) +
+            '</Types>'
+        )
+
+    def close(self):
+        """
+        Assemble the worksheet parts, and the parts that describe them, into
+        the XLSX file.
+
+        """
+        try:
+            with zipfile.ZipFile(self.file_name, 'w', zipfile.ZIP_DEFLATED) as xlsx_file:
+                xlsx_file.writestr('[Content_Types].xml', self.content_types_xml().encode('utf-8'))
+                xlsx_file.writestr('_rels/.rels', ROOT_RELS.encode('utf-8'))
+                xlsx_file.writestr('xl/workbook.xml', self.workbook_xml().encode('utf-8'))
+                xlsx_file.writestr('xl/_rels/workbook.xml.rels', self.workbook_rels_xml().encode('utf-8'))
+                xlsx_file.writestr('xl/styles.xml', STYLES.encode('utf-8'))
+                for i in range(1, len(self.sheet_names) + 1):
+                    xlsx_file.write(
+                        os.path.join(self.part_directory, 'sheet{}.xml'.format(i)),
+                        'xl/worksheets/sheet{}.xml'.format(i))
+        finally:
+            self.clean_up()
+
+    def clean_up(self):
+        """
+        Remove the worksheet parts, whether or not the XLSX file has been
+        written.
+
+        """
+        shutil.rmtree(self.part_directory, ignore_errors=True)